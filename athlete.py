@@ -11,7 +11,7 @@ env = Environment(
     )
 )
 
-config = Config()
+config = Config.instance()
 
 def root_view(params):
     template = env.get_template("graph.html",)
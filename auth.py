@@ -1,21 +1,22 @@
-import json
-import urllib.request
-from jose import jwk, jwt
+from jose import jwt
 from jose.utils import base64url_decode
 import time
 from config import Config
+from lib.cache import LRUCache
+from lib.jwks_cache import JwksCache
 
-config = Config()
+config = Config.instance()
 
 keys_url = "https://cognito-idp.{region}.amazonaws.com/{userpool_id}/.well-known/jwks.json".format(
     region=config.aws_region, userpool_id=config.cognito_user_pool_id
 )
-# # instead of re-downloading the public keys every time
-# # we download them only on cold start
-# # https://aws.amazon.com/blogs/compute/container-reuse-in-lambda/
-with urllib.request.urlopen(keys_url) as f:
-    response = f.read()
-keys = json.loads(response.decode("utf-8"))["keys"]
+# public keys are downloaded on first use and kept for the life of the
+# container, an unknown kid (key rotation) triggers a refetch
+# https://aws.amazon.com/blogs/compute/container-reuse-in-lambda/
+jwks = JwksCache(keys_url)
+# claims of tokens whose signature already verified, each kept until the
+# token's own exp so repeat requests skip the RSA verify
+verified_tokens = LRUCache(maxsize=1024)
 
 
 # https://hasura.io/blog/best-practices-of-using-jwt-with-graphql/#jwt_structure
@@ -37,24 +38,17 @@ def generate_policy(principal_id, effect, resource, context=None):
     return response
 
 
-def main(event, context):
-    if "authorizationToken" not in event:
-        return generate_policy("DENY", "deny", event["methodArn"])
-    token = event["authorizationToken"][7:]
+def verify_token(token):
+    # returns the claims if the signature verifies, None if it doesn't and
+    # False if the signing key is unknown
     # get the kid from the headers prior to verification
     headers = jwt.get_unverified_headers(token)
     kid = headers["kid"]
-    # search for the kid in the downloaded public keys
-    key_index = -1
-    for i in range(len(keys)):
-        if kid == keys[i]["kid"]:
-            key_index = i
-            break
-    if key_index == -1:
+    # look up the constructed public key for the kid
+    public_key = jwks.get(kid)
+    if public_key is None:
         print("Public key not found in jwks.json")
         return False
-    # construct the public key
-    public_key = jwk.construct(keys[key_index])
     # get the last two sections of the token,
     # message and signature (encoded in base64)
     message, encoded_signature = str(token).rsplit(".", 1)
@@ -63,12 +57,25 @@ def main(event, context):
     # verify the signature
     if not public_key.verify(message.encode("utf8"), decoded_signature):
         print("Signature verification failed")
-        # return False
-        return generate_policy("ENY", "Deny", event["methodArn"])
+        return None
     print("Signature successfully verified")
     # since we passed the verification, we can now safely
     # use the unverified claims
-    claims = jwt.get_unverified_claims(token)
+    return jwt.get_unverified_claims(token)
+
+
+def main(event, context):
+    if "authorizationToken" not in event:
+        return generate_policy("DENY", "deny", event["methodArn"])
+    token = event["authorizationToken"][7:]
+    claims = verified_tokens.get(token)
+    if claims is None:
+        claims = verify_token(token)
+        if claims is None:
+            return generate_policy("ENY", "Deny", event["methodArn"])
+        if claims is False:
+            return False
+        verified_tokens.set(token, claims, expires_at=claims["exp"])
     # additionally we can verify the token expiration
     if time.time() > claims["exp"]:
         print("Token is expired")
@@ -0,0 +1,133 @@
+# measures what a cold container pays in SSM round trips before a handler
+# can run: each handler module is imported in a fresh interpreter with the
+# SSM client swapped for one that counts calls and sleeps a fixed latency.
+#
+#   python -m benchmarks.cold_start [--latency-ms 40] [--call]
+#
+# --call also touches the strava secrets, as a handler that uses them would
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HANDLER_MODULES = [
+    "auth", "graph", "index", "athlete", "process_streams", "ingest_strava",
+]
+
+BENCH_ENV = {
+    "STRAVA_AUTH_TABLE": "bench-strava-auth",
+    "RECENT_ATHLETE_PEAKS_TABLE": "bench-recent-athlete-peak",
+    "LEADERBOARD_TABLE": "bench-leaderboard",
+    "STRAVA_API_QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/0/bench-strava-api.fifo",
+    "SQS_QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/0/bench-backfill",
+    "RECENT_ATHLETE_PEAKS_QUEUE": "https://sqs.us-east-1.amazonaws.com/0/bench-recent.fifo",
+    "PEAKS_TABLE": "bench-peaks",
+    "ACTIVITIES_TABLE": "bench-activities",
+    "BUCKET": "bench-bucket",
+    "USER_POOL": "bench-pool",
+    "USER_POOL_CLIENT_ID": "bench-client",
+    "USER_POOL_ID": "us-east-1_bench",
+    "COGNITO_LOGIN_URL": "https://login.example.com/login",
+    "COGNITO_URL": "https://login.example.com",
+    "URL": "http://localhost:3000/dev/",
+    "STAGE": "bench",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "bench",
+    "AWS_SECRET_ACCESS_KEY": "bench",
+}
+
+CHILD = r"""
+import json, sys, time
+import boto3
+
+latency = float(sys.argv[1]) / 1000
+module_name = sys.argv[2]
+touch_secrets = sys.argv[3] == "1"
+calls = {"clients": 0, "round_trips": 0}
+
+class CountingSSM():
+    def get_parameter(self, Name, WithDecryption=False):
+        calls["round_trips"] += 1
+        time.sleep(latency)
+        return {"Parameter": {"Name": Name, "Value": "bench"}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        calls["round_trips"] += 1
+        time.sleep(latency)
+        return {"Parameters": [{"Name": n, "Value": "bench"} for n in Names],
+                "InvalidParameters": []}
+
+real_client = boto3.client
+def client(service, *args, **kwargs):
+    if service == "ssm":
+        calls["clients"] += 1
+        return CountingSSM()
+    return real_client(service, *args, **kwargs)
+boto3.client = client
+
+# auth.py downloads the jwks at import in older revisions
+import urllib.request
+class Jwks():
+    def __enter__(self): return self
+    def __exit__(self, *a): return False
+    def read(self): return b'{"keys": []}'
+urllib.request.urlopen = lambda *a, **k: Jwks()
+
+started = time.perf_counter()
+module = __import__(module_name)
+imported = time.perf_counter()
+if touch_secrets:
+    import config as config_module
+    cfg = config_module.Config.instance() if hasattr(
+        config_module.Config, "instance") else module.config
+    cfg.strava_client_id, cfg.strava_client_secret
+finished = time.perf_counter()
+print(json.dumps({
+    "module": module_name,
+    "import_ms": round((imported - started) * 1000, 1),
+    "total_ms": round((finished - started) * 1000, 1),
+    "ssm_clients": calls["clients"],
+    "ssm_round_trips": calls["round_trips"],
+}))
+"""
+
+
+def run(module_name, latency_ms, touch_secrets):
+    env = dict(os.environ)
+    env.update(BENCH_ENV)
+    proc = subprocess.run(
+        [sys.executable, "-c", CHILD, str(latency_ms), module_name,
+         "1" if touch_secrets else "0"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        last_line = (proc.stderr.strip().splitlines() or ["failed"])[-1]
+        return {"module": module_name, "error": last_line}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--call", action="store_true")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("modules", nargs="*", default=HANDLER_MODULES)
+    args = parser.parse_args(argv)
+
+    results = [run(m, args.latency_ms, args.call) for m in args.modules]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return results
+    for r in results:
+        if "error" in r:
+            print("{module:<16} skipped: {error}".format(**r))
+            continue
+        print("{module:<16} ssm clients {ssm_clients:>2}  round trips {ssm_round_trips:>2}"
+              "  import {import_ms:>7.1f} ms  total {total_ms:>7.1f} ms".format(**r))
+    return results
+
+
+if __name__ == "__main__":
+    main()
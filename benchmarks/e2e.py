@@ -0,0 +1,422 @@
+# replays the whole ingest pipeline locally, from BACKFILL_ATHLETE to the
+# recent peaks table, for a set of athletes:
+#
+#   backfill -> enqueueStravaBackfill -> strava api queue -> fetchStravaApi
+#     -> bucket (streams_*) -> processStravaStreamsFromS3 -> recent queue
+#     -> calculatePeaksForAthlete -> bucket (peaks_*) -> processPeaksToRecent
+#
+# the handlers run unmodified, their module-level boto3 clients swapped for
+# the stand-ins in tests/local_aws.py and the strava session mounted on
+# benchmarks/fake_strava.py. functions are invoked like the sqs event source
+# does, with their serverless.yml batch sizes, one invocation at a time
+# (lib.metrics keeps per invocation state), and report end-to-end
+# throughput, per function latency and queue depth over time.
+#
+#   python -m benchmarks.e2e [--athletes 3] [--activities 20] [--days 120]
+#   python -m benchmarks.e2e --fixtures <dir of recorded strava responses>
+#   python -m benchmarks.e2e --sync --expired-tokens
+#
+# everything it writes (bucket, sqlite tables, handler output, report.json)
+# is left in --workdir
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+from benchmarks.cold_start import BENCH_ENV
+
+from tests.local_aws import PEAKS_QUEUE_URL, REGION, ROOT, STREAMS_QUEUE_URL, LocalAws
+
+LOCAL_ENV = {
+    "RATE_LIMIT_TABLE": "bench-rate-limit",
+    "XRAY_ENABLED": "false",
+}
+
+# the sqs triggered functions in serverless.yml: name, queue, handler,
+# batchSize, timeout (s)
+FUNCTIONS = [
+    ("enqueueStravaBackfill", "backfill", "ingest_strava.enqueue_strava_backfill", 10, 300),
+    ("fetchStravaApi", "strava_api", "ingest_strava.fetch_strava_api", 10, 300),
+    ("processStravaStreamsFromS3", "streams", "process_streams.main", 10, 300),
+    ("calculatePeaksForAthlete", "recent", "ingest_strava.calculate_peaks_for_athlete", 1, 60),
+    ("processPeaksToRecent", "peaks", "ingest_strava.process_peaks", 1, 60),
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+class LambdaContext():
+    def __init__(self, function_name, timeout):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - time.time()) * 1000)
+
+
+class Function():
+    def __init__(self, name, queue_url, handler, batch_size, timeout):
+        self.name = name
+        self.queue_url = queue_url
+        self.handler = handler
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.invocations = []
+        self.waits = []
+        self.spans = {}
+        self.counters = {}
+
+    def collect(self, records):
+        # the handler's EMF record(s), spans summed and counters added up
+        for record in records:
+            for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]:
+                name = metric["Name"]
+                if metric["Unit"] == "Milliseconds":
+                    self.spans[name] = self.spans.get(name, 0) + sum(record[name])
+                else:
+                    self.counters[name] = self.counters.get(name, 0) + record[name]
+
+    def summary(self):
+        durations = [i["ms"] for i in self.invocations]
+        return {
+            "invocations": len(self.invocations),
+            "messages": sum(i["messages"] for i in self.invocations),
+            "failed": sum(1 for i in self.invocations if not i["ok"]),
+            "handler_ms": {"median": round(statistics.median(durations), 1) if durations else 0,
+                           "p95": round(percentile(durations, 95), 1),
+                           "max": round(max(durations), 1) if durations else 0,
+                           "total": round(sum(durations), 1)},
+            "wait_ms": {"median": round(statistics.median(self.waits), 1) if self.waits else 0,
+                        "p95": round(percentile(self.waits, 95), 1)},
+            "spans_ms": {k: round(v, 1) for k, v in sorted(self.spans.items())},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+class Harness():
+    def __init__(self, args):
+        self.args = args
+        self.workdir = args.workdir or tempfile.mkdtemp(prefix="sts1-e2e-")
+        for name in ("bucket", "tables.db", "tables.db-wal", "tables.db-shm"):
+            path = os.path.join(self.workdir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        os.makedirs(self.workdir, exist_ok=True)
+        self.log = open(os.path.join(self.workdir, "handlers.log"), "w")
+        self.depths = []
+        self.errors = []
+        self.scheduled = []
+        self.started_at = None
+
+    def setup(self):
+        # env first, Config reads it once when the handlers are imported
+        for name, value in BENCH_ENV.items():
+            os.environ.setdefault(name, value)
+        os.environ.update(LOCAL_ENV)
+        os.environ["PEAKS_RECOMPUTE_QUIET_SECONDS"] = str(self.args.quiet_seconds)
+        sys.path.insert(0, ROOT)
+
+        from config import Config
+        from benchmarks import fake_strava
+        from lib import metrics
+        from lib.http_session import strava_session
+
+        self.config = config = Config.instance()
+        self.aws = LocalAws(config, self.workdir, max_receives=self.args.max_receives)
+        self.s3, self.sqs, self.dynamodb = self.aws.s3, self.aws.sqs, self.aws.dynamodb
+
+        fixtures = self.args.fixtures
+        if fixtures is None:
+            fixtures = os.path.join(self.workdir, "fixtures")
+            shutil.rmtree(fixtures, ignore_errors=True)
+            fake_strava.write_fixtures(fixtures, self.args.athletes, self.args.activities,
+                                       self.args.days, seed=self.args.seed)
+        self.strava = fake_strava.FakeStrava(fixtures, latency=self.args.strava_latency_ms / 1000.0)
+        strava_session.mount("https://", self.strava)
+        strava_session.mount("http://", self.strava)
+
+        queues = {
+            "backfill": config.backfill_athlete_queue,
+            "strava_api": config.strava_api_queue_url,
+            "recent": config.recent_athlete_peaks_to_s3,
+            "streams": STREAMS_QUEUE_URL,
+            "peaks": PEAKS_QUEUE_URL,
+        }
+        self.functions = []
+        for name, queue, handler, batch_size, timeout in FUNCTIONS:
+            module_name, function_name = handler.rsplit(".", 1)
+            module = importlib.import_module(module_name)
+            self.functions.append(Function(name, queues[queue],
+                                           getattr(module, function_name), batch_size, timeout))
+
+        self.aws.install()
+        self.sink = metrics.MemorySink()
+        metrics.metrics.sink = self.sink
+
+    def seed(self):
+        # an authorized user per fixture athlete, then the message
+        # index.backfill_athlete sends when they ask for a backfill
+        auth_table = self.dynamodb.Table(self.config.strava_auth_table)
+        self.users = {}
+        for athlete_id in self.strava.athlete_ids:
+            expires_at = int(time.time()) - 60 if self.args.expired_tokens else None
+            access_token, refresh_token, expires_at = self.strava.grant(athlete_id, expires_at)
+            user_id = "local-user-{athlete_id}".format(athlete_id=athlete_id)
+            auth_table.put_item(Item={
+                "user_id": user_id,
+                "athlete_id": str(athlete_id),
+                "access_token": access_token,
+                "refresh_token": refresh_token,
+                "expires_at": expires_at,
+            })
+            self.users[athlete_id] = user_id
+        self.started_at = time.time()
+        for athlete_id, user_id in self.users.items():
+            self.sqs.send_message(
+                QueueUrl=self.config.backfill_athlete_queue,
+                DelaySeconds=0,
+                MessageAttributes={
+                    "Job": {"DataType": "String", "StringValue": "BACKFILL_ATHLETE"},
+                    "UserId": {"DataType": "String", "StringValue": user_id},
+                    "AthleteId": {"DataType": "String", "StringValue": str(athlete_id)},
+                },
+                MessageBody="Backfill athlete for user {user_id}".format(user_id=user_id),
+            )
+
+    def sample(self, stop):
+        while not stop.wait(self.args.sample_ms / 1000.0):
+            self.depths.append((round(time.time() - self.started_at, 3), self.sqs.depth()))
+
+    def invoke(self, function, messages):
+        queue = self.sqs.queue(function.queue_url)
+        received_at = time.time()
+        for message in messages:
+            if message.receive_count == 1:
+                function.waits.append((received_at - message.sent_at) * 1000)
+        event = {"Records": [m.record(queue.arn, REGION) for m in messages]}
+        ok = True
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(self.log):
+            print("==> {name} {count} messages".format(name=function.name, count=len(messages)))
+            try:
+                function.handler(event, LambdaContext(function.name, function.timeout))
+            except Exception as e:
+                ok = False
+                traceback.print_exc(file=self.log)
+                self.errors.append({"function": function.name, "error": repr(e)})
+        ms = (time.perf_counter() - start) * 1000
+        if ok:
+            # lambda deletes the batch when the handler returns
+            for message in messages:
+                if message.in_flight:
+                    self.sqs.delete(queue, message.receipt_handle)
+        else:
+            # whatever the handler didn't delete itself comes back after
+            # the visibility timeout
+            self.sqs.release(function.queue_url, messages, self.args.retry_seconds)
+        function.invocations.append({"at": round(time.time() - self.started_at, 3),
+                                     "ms": ms, "messages": len(messages), "ok": ok})
+        function.collect(self.sink.records)
+        self.sink.clear()
+
+    def drain(self, deadline):
+        # round robin over the functions, a batch each, until every queue
+        # is empty. returns False if the deadline came first
+        while time.time() < deadline:
+            invoked = False
+            for function in self.functions:
+                messages = self.sqs.receive(function.queue_url, function.batch_size)
+                if messages:
+                    self.invoke(function, messages)
+                    invoked = True
+            if invoked:
+                continue
+            next_visible_at = self.sqs.next_visible_at()
+            if next_visible_at is None:
+                return True
+            time.sleep(min(max(next_visible_at - time.time(), 0.001), 0.25))
+        return False
+
+    def sync(self, deadline):
+        # the scheduled enqueueStravaAthleteSync, then whatever it queues
+        import ingest_strava
+        function = Function("enqueueStravaAthleteSync", None,
+                            ingest_strava.enqueue_strava_athlete_sync, 0, 300)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(self.log):
+            function.handler({}, LambdaContext(function.name, function.timeout))
+        function.invocations.append({"at": round(time.time() - self.started_at, 3),
+                                     "ms": (time.perf_counter() - start) * 1000,
+                                     "messages": 0, "ok": True})
+        function.collect(self.sink.records)
+        self.sink.clear()
+        self.scheduled.append(function)
+        return self.drain(deadline)
+
+    def outcome(self):
+        # per athlete: activities with peaks saved, and when their recent
+        # peaks were last written (the RECENT_PEAKS stamp)
+        from boto3.dynamodb.conditions import Key
+        from lib.athlete_stamp import AthleteStamp
+        activities_table = self.dynamodb.Table(self.config.activities_table)
+        athletes = {}
+        for athlete_id in self.strava.athlete_ids:
+            items = activities_table.query(
+                KeyConditionExpression=Key("athlete_id").eq(str(athlete_id)))["Items"]
+            recent_at = AthleteStamp.fetch_all(athlete_id).get(AthleteStamp.RECENT_PEAKS)
+            athletes[athlete_id] = {
+                "activities": self.strava.activity_count(athlete_id),
+                "peaked": sum(1 for i in items if "peaks_digest" in i),
+                "recent_peaks_s": round(recent_at / 1000.0 - self.started_at, 3)
+                if recent_at else None,
+            }
+        return athletes
+
+    def run(self):
+        self.setup()
+        self.seed()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self.sample, args=(stop,), daemon=True)
+        sampler.start()
+        deadline = self.started_at + self.args.timeout
+        drained = self.drain(deadline)
+        elapsed = time.time() - self.started_at
+        athletes = self.outcome()
+        synced = None
+        if self.args.sync and drained:
+            sync_started_at = time.time()
+            drained = self.sync(deadline)
+            synced = round(time.time() - sync_started_at, 3)
+        stop.set()
+        sampler.join()
+        self.log.close()
+        return self.report(drained, elapsed, athletes, synced)
+
+    def report(self, drained, elapsed, athletes, synced):
+        activities = sum(a["activities"] for a in athletes.values())
+        peaked = sum(a["peaked"] for a in athletes.values())
+        recent = [a["recent_peaks_s"] for a in athletes.values() if a["recent_peaks_s"]]
+        dead_letters = {name: len(q.dead_letters) for name, q in self.sqs.queues.items()
+                        if q.dead_letters}
+        report = {
+            "drained": drained,
+            "elapsed_s": round(elapsed, 3),
+            "athletes": len(athletes),
+            "activities": activities,
+            "activities_peaked": peaked,
+            "activities_per_s": round(peaked / elapsed, 2) if elapsed else 0,
+            "recent_peaks_s": {"first": min(recent) if recent else None,
+                               "median": statistics.median(recent) if recent else None,
+                               "last": max(recent) if recent else None},
+            "sync_s": synced,
+            "functions": {f.name: f.summary() for f in self.scheduled + self.functions},
+            "queues": {name: {"sent": q.sent, "deduplicated": q.deduplicated,
+                              "dead_letters": len(q.dead_letters)}
+                       for name, q in self.sqs.queues.items()},
+            "queue_depth": [{"t": t, "depth": d} for t, d in self.depths],
+            "strava": self.strava.stats(),
+            "dynamodb": self.dynamodb.stats(),
+            "s3": {"puts": self.s3.puts, "gets": self.s3.gets, "bytes_read": self.s3.bytes_read},
+            "per_athlete": {str(k): v for k, v in athletes.items()},
+            "errors": self.errors,
+        }
+        with open(os.path.join(self.workdir, "report.json"), "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+        print("{athletes} athletes, {peaked} of {activities} activities peaked in {elapsed:.2f} s "
+              "({rate:.1f} activities/s){incomplete}".format(
+                  athletes=len(athletes), peaked=peaked, activities=activities, elapsed=elapsed,
+                  rate=report["activities_per_s"],
+                  incomplete="" if drained else ", timed out with messages left"))
+        if recent:
+            print("recent peaks written for {n} of {total} athletes, first {first:.2f} s, "
+                  "median {median:.2f} s, last {last:.2f} s after the backfill request".format(
+                      n=len(recent), total=len(athletes), **report["recent_peaks_s"]))
+        if synced is not None:
+            print("athlete sync and its follow up work took {s:.2f} s".format(s=synced))
+        print()
+        print("{name:<28} {calls:>6} {msgs:>6} {failed:>6}  {handler:>24}  {wait:>16}".format(
+            name="function", calls="calls", msgs="msgs", failed="failed",
+            handler="handler ms med/p95/max", wait="wait ms med/p95"))
+        for name, s in report["functions"].items():
+            print("{name:<28} {invocations:>6} {messages:>6} {failed:>6}  {h:>24}  {w:>16}".format(
+                name=name, h="{median:.1f} / {p95:.1f} / {max:.1f}".format(**s["handler_ms"]),
+                w="{median:.0f} / {p95:.0f}".format(**s["wait_ms"]), **s))
+        print()
+        self.print_depths()
+        print()
+        strava = report["strava"]["requests"]
+        print("strava: {total} requests ({routes})".format(
+            total=sum(strava.values()),
+            routes=", ".join("{k} {v}".format(k=k, v=v) for k, v in sorted(strava.items()))))
+        for name, stats in report["dynamodb"].items():
+            print("dynamodb {name}: {reads} reads, {writes} writes, {batch_writes} batch writes, "
+                  "{condition_failures} condition failures".format(name=name, **stats))
+        print("dead letters: {d}".format(d=dead_letters or "none"))
+        if self.errors:
+            print("{n} failed invocations, see handlers.log".format(n=len(self.errors)))
+        print("report: {path}".format(path=os.path.join(self.workdir, "report.json")))
+        return report
+
+    def print_depths(self, rows=15):
+        # messages waiting (visible + delayed) / in flight per queue
+        if not self.depths:
+            return
+        names = sorted(self.depths[0][1])
+        print("queue depth, waiting/in flight")
+        print("{t:>8}  ".format(t="t (s)") + "  ".join(
+            "{name:>14}".format(name=name.replace("bench-", "")[0:14]) for name in names))
+        step = max(1, len(self.depths) // rows)
+        for t, depth in self.depths[::step]:
+            print("{t:>8.2f}  ".format(t=t) + "  ".join("{d:>14}".format(d="{w}/{f}".format(
+                w=depth[n]["visible"] + depth[n]["delayed"], f=depth[n]["in_flight"]))
+                for n in names))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="local end-to-end pipeline replay")
+    parser.add_argument("--athletes", type=int, default=3)
+    parser.add_argument("--activities", type=int, default=20, help="per athlete")
+    parser.add_argument("--days", type=int, default=120, help="history the activities span")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fixtures", help="recorded strava responses, see benchmarks/fake_strava.py")
+    parser.add_argument("--workdir")
+    parser.add_argument("--quiet-seconds", type=int, default=1,
+                        help="PEAKS_RECOMPUTE_QUIET_SECONDS, 300 deployed")
+    parser.add_argument("--strava-latency-ms", type=float, default=0)
+    parser.add_argument("--retry-seconds", type=float, default=1,
+                        help="visibility timeout for failed messages")
+    parser.add_argument("--max-receives", type=int, default=3)
+    parser.add_argument("--sample-ms", type=int, default=250)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--sync", action="store_true",
+                        help="run the scheduled athlete sync once the backfill has drained")
+    parser.add_argument("--expired-tokens", action="store_true",
+                        help="start every athlete with an expired access token")
+    args = parser.parse_args(argv)
+
+    report = Harness(args).run()
+    ok = report["drained"] and report["activities_peaked"] == report["activities"] and \
+        not any(q["dead_letters"] for q in report["queues"].values())
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
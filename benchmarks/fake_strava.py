@@ -0,0 +1,272 @@
+# a strava api served from fixtures, mounted as the transport adapter of a
+# requests session (lib.http_session.strava_session) so stravalib and the
+# token refresh talk to it without any network. fixtures are strava's own
+# response bodies, one directory per athlete:
+#
+#   <fixtures>/<athlete_id>/activities.json           GET /athlete/activities items
+#   <fixtures>/<athlete_id>/streams/<activity_id>.json GET /activities/{id}/streams?key_by_type=true
+#
+# so responses recorded from the real api can be dropped in. write_fixtures()
+# generates a set from benchmarks/synthetic.py
+import calendar
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from threading import Lock
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from benchmarks import synthetic
+from lib.rate_limiter import window_starts
+
+# generated activities, kept short so a replay of many stays quick
+GENERATORS = [
+    (synthetic.ride, {"hours": 1}),
+    (synthetic.ride, {"hours": 2, "smart": True}),
+    (synthetic.run, {"hours": 0.75}),
+    (synthetic.row, {"hours": 0.5}),
+]
+TOKEN_TTL = 6 * 60 * 60
+RATE_LIMIT = (600, 30000)
+
+
+def strava_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def write_fixtures(root, athletes, activities, days, seed=1):
+    # `activities` per athlete spread over the last `days`, newest first as
+    # strava lists them without `after`
+    rng = np.random.default_rng(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    athlete_ids = []
+    for a in range(athletes):
+        athlete_id = 1000 + a
+        athlete_ids.append(athlete_id)
+        streams_dir = os.path.join(root, str(athlete_id), "streams")
+        os.makedirs(streams_dir, exist_ok=True)
+        summaries = []
+        for i in range(activities):
+            generator, kwargs = GENERATORS[int(rng.integers(0, len(GENERATORS)))]
+            streams, summary = generator(seed=int(rng.integers(1, 100000)), **kwargs)
+            start = now - timedelta(seconds=int(rng.integers(3600, days * 86400)))
+            activity_id = athlete_id * 100000 + i
+            summaries.append(activity_summary(activity_id, athlete_id, summary, streams, start))
+            with open(os.path.join(streams_dir, "{id}.json".format(id=activity_id)), "w") as f:
+                json.dump(activity_streams(streams), f)
+        summaries.sort(key=lambda s: s["start_date"], reverse=True)
+        with open(os.path.join(root, str(athlete_id), "activities.json"), "w") as f:
+            json.dump(summaries, f, indent=1)
+    return athlete_ids
+
+
+def activity_summary(activity_id, athlete_id, summary, streams, start):
+    elapsed = int(streams["time"][-1])
+    return {
+        "resource_state": 2,
+        "id": activity_id,
+        "athlete": {"id": athlete_id, "resource_state": 1},
+        "name": summary["name"],
+        "type": summary["type"],
+        "sport_type": summary["type"],
+        "start_date": strava_time(start),
+        "start_date_local": strava_time(start),
+        "timezone": "(GMT+00:00) Africa/Abidjan",
+        "utc_offset": 0.0,
+        "elapsed_time": elapsed,
+        "moving_time": elapsed,
+        "distance": summary["distance"],
+        "total_elevation_gain": 0.0,
+        "average_speed": round(summary["distance"] / max(elapsed, 1), 3),
+        "trainer": summary["trainer"],
+        "commute": False,
+        "manual": False,
+        "private": False,
+        "has_heartrate": "heartrate" in streams,
+        "device_watts": "watts" in streams,
+        "suffer_score": summary["suffer_score"],
+    }
+
+
+def activity_streams(streams):
+    time_stream = np.asarray(streams["time"])
+    velocity = np.asarray(streams["velocity_smooth"])
+    distance = np.concatenate([[0.0], np.cumsum(velocity[1:] * np.diff(time_stream))])
+    body = dict(streams, distance=np.round(distance, 1).tolist())
+    return {name: {"data": data, "series_type": "distance", "original_size": len(data),
+                   "resolution": "high"} for name, data in body.items()}
+
+
+class FakeStrava(BaseAdapter):
+    # routes the handful of endpoints the pipeline calls. tokens are handed
+    # out by grant() and the refresh endpoint, anything else is a 401 as
+    # strava would answer. responses carry X-RateLimit headers counted here
+    def __init__(self, fixtures, latency=0.0, token_ttl=TOKEN_TTL):
+        super(FakeStrava, self).__init__()
+        self.fixtures = fixtures
+        self.latency = latency
+        self.token_ttl = token_ttl
+        self.lock = Lock()
+        self.activities = {}
+        self.owners = {}
+        for name in sorted(os.listdir(fixtures)):
+            path = os.path.join(fixtures, name, "activities.json")
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                summaries = json.load(f)
+            athlete_id = int(name)
+            for summary in summaries:
+                summary["_start"] = calendar.timegm(
+                    time.strptime(summary["start_date"], "%Y-%m-%dT%H:%M:%SZ"))
+                self.owners[int(summary["id"])] = athlete_id
+            self.activities[athlete_id] = sorted(summaries, key=lambda s: s["_start"])
+        self.tokens = {}
+        self.refresh_tokens = {}
+        self.usage = {"short_window": None, "short": 0, "long_window": None, "long": 0}
+        self.requests = {}
+        self.statuses = {}
+
+    @property
+    def athlete_ids(self):
+        return sorted(self.activities)
+
+    def activity_count(self, athlete_id):
+        return len(self.activities[athlete_id])
+
+    def grant(self, athlete_id, expires_at=None):
+        access_token, refresh_token = uuid.uuid4().hex, uuid.uuid4().hex
+        if expires_at is None:
+            expires_at = int(time.time()) + self.token_ttl
+        with self.lock:
+            self.tokens[access_token] = (athlete_id, expires_at)
+            self.refresh_tokens[refresh_token] = athlete_id
+        return access_token, refresh_token, expires_at
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.url)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        path = unquote(url.path).rstrip("/")
+        if path.endswith("/oauth/token"):
+            route, (status, body) = "token", self.refresh(request)
+        else:
+            athlete_id = self.authorize(request, params)
+            parts = path.split("/")
+            if athlete_id is None:
+                route, (status, body) = "unauthorized", (401, {
+                    "message": "Authorization Error",
+                    "errors": [{"resource": "Athlete", "field": "access_token",
+                                "code": "invalid"}]})
+            elif path.endswith("/athlete/activities"):
+                route, (status, body) = "activities", self.list_activities(athlete_id, params)
+            elif "streams" in parts and parts[parts.index("streams") - 2] == "activities":
+                activity_id = parts[parts.index("streams") - 1]
+                types = parts[parts.index("streams") + 1] if parts[-1] != "streams" else \
+                    params.get("keys", "")
+                route, (status, body) = "streams", self.streams(
+                    athlete_id, activity_id, types.split(","), parts[-1] == "streams", params)
+            else:
+                route, (status, body) = "not_found", self.not_found()
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            usage = self.count_usage() if route != "token" else None
+        return self.response(request, status, body, usage)
+
+    def count_usage(self):
+        short_window, long_window = window_starts(time.time())
+        if self.usage["short_window"] != short_window:
+            self.usage.update(short_window=short_window, short=0)
+        if self.usage["long_window"] != long_window:
+            self.usage.update(long_window=long_window, long=0)
+        self.usage["short"] += 1
+        self.usage["long"] += 1
+        return self.usage["short"], self.usage["long"]
+
+    def response(self, request, status, body, usage):
+        response = Response()
+        response.status_code = status
+        response.reason = {200: "OK", 400: "Bad Request", 401: "Unauthorized",
+                           404: "Not Found"}.get(status, "")
+        response._content = json.dumps(body).encode("utf8")
+        response.encoding = "utf-8"
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json; charset=utf-8"})
+        if usage is not None:
+            response.headers["X-RateLimit-Limit"] = "{0},{1}".format(*RATE_LIMIT)
+            response.headers["X-RateLimit-Usage"] = "{0},{1}".format(*usage)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def authorize(self, request, params):
+        token = params.get("access_token")
+        header = request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            token = header[len("Bearer "):]
+        with self.lock:
+            athlete_id, expires_at = self.tokens.get(token, (None, 0))
+        return athlete_id if expires_at > time.time() else None
+
+    def refresh(self, request):
+        form = {k: v[-1] for k, v in parse_qs(request.body or "").items()}
+        with self.lock:
+            athlete_id = self.refresh_tokens.get(form.get("refresh_token"))
+        if form.get("grant_type") != "refresh_token" or athlete_id is None:
+            return 400, {"message": "Bad Request",
+                         "errors": [{"resource": "RefreshToken", "field": "refresh_token",
+                                     "code": "invalid"}]}
+        access_token, refresh_token, expires_at = self.grant(athlete_id)
+        return 200, {"token_type": "Bearer", "access_token": access_token,
+                     "refresh_token": refresh_token, "expires_at": expires_at,
+                     "expires_in": expires_at - int(time.time())}
+
+    def list_activities(self, athlete_id, params):
+        # strava lists newest first, or oldest first once `after` is given
+        before = float(params["before"]) if "before" in params else None
+        after = float(params["after"]) if "after" in params else None
+        page = int(params.get("page", 1))
+        per_page = min(int(params.get("per_page", 30)), 200)
+        matching = [a for a in self.activities[athlete_id]
+                    if (before is None or a["_start"] < before)
+                    and (after is None or a["_start"] > after)]
+        if after is None:
+            matching.reverse()
+        page_items = matching[(page - 1) * per_page:page * per_page]
+        return 200, [{k: v for k, v in a.items() if k != "_start"} for a in page_items]
+
+    def streams(self, athlete_id, activity_id, types, key_by_type, params):
+        if not activity_id.isdigit() or self.owners.get(int(activity_id)) != athlete_id:
+            return self.not_found()
+        path = os.path.join(self.fixtures, str(athlete_id), "streams",
+                            "{id}.json".format(id=activity_id))
+        if not os.path.exists(path):
+            return self.not_found()
+        # stravalib before 1.0 pages through streams like any other list
+        if int(params.get("page", 1)) > 1:
+            return 200, []
+        with open(path) as f:
+            streams = json.load(f)
+        wanted = {t: s for t, s in streams.items() if t in types}
+        if key_by_type or params.get("key_by_type") == "true":
+            return 200, wanted
+        return 200, [dict(s, type=t) for t, s in wanted.items()]
+
+    def not_found(self):
+        return 404, {"message": "Record Not Found",
+                     "errors": [{"resource": "Activity", "field": "id", "code": "not found"}]}
+
+    def stats(self):
+        with self.lock:
+            return {"requests": dict(self.requests),
+                    "statuses": {str(k): v for k, v in self.statuses.items()}}
@@ -0,0 +1,263 @@
+# latency and peak memory of the stream -> peaks pipeline on synthetic
+# activities (benchmarks/synthetic.py), run against the local stand-ins in
+# tests/local_aws.py. results are written to benchmarks/results/<commit>.json
+# so two commits can be compared:
+#
+#   python -m benchmarks.pipeline [--repeat 5] [--cases ride_4h row_1h]
+#   python -m benchmarks.pipeline --compare <commit or results file> [--threshold 10]
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from benchmarks.cold_start import BENCH_ENV
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+BUCKET = BENCH_ENV["BUCKET"]
+ATHLETE_ID = "42"
+
+for name, value in BENCH_ENV.items():
+    os.environ.setdefault(name, value)
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+from config import Config  # noqa: E402
+from benchmarks import synthetic  # noqa: E402
+from tests.local_aws import LocalAws  # noqa: E402
+from lib import metrics  # noqa: E402
+from lib.stream_file import StreamFile  # noqa: E402
+import process_streams  # noqa: E402
+
+
+def measure(func, repeat, memory=True):
+    # wall clock of each run, then one more run under tracemalloc for the
+    # peak python allocation (numpy buffers included)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        timings.append((time.perf_counter() - start) * 1000)
+    result = {
+        "runs": repeat,
+        "median_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "p95_ms": round(sorted(timings)[max(0, int(round(0.95 * len(timings))) - 1)], 3),
+    }
+    if memory:
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_kb"] = round(peak / 1024, 1)
+    return result
+
+
+def stream_event(key):
+    body = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]}
+    return {"Records": [{
+        "messageId": "bench-1",
+        "receiptHandle": "bench-1",
+        "eventSourceARN": "arn:aws:sqs:us-east-1:0:bench-peaks",
+        "body": json.dumps(body),
+    }]}
+
+
+def stream_cases(aws, names, repeat):
+    results = {}
+    pause_gap = Config.instance().pause_gap_seconds
+    for name in names:
+        streams, activity = synthetic.generate(name)
+        activity_id = activity["id"]
+        time_stream = streams["time"]
+        statistics_present = [s for s in process_streams.STATISTICS if s in streams]
+
+        def fill():
+            for statistic in statistics_present:
+                process_streams.fill_values(time_stream, streams[statistic], pause_gap)
+
+        filled = process_streams.fill_values(
+            time_stream, streams[statistics_present[0]], pause_gap)
+
+        def peaks():
+            for duration in process_streams.PEAK_DURATIONS:
+                process_streams.calc_peak(duration, filled, activity_id)
+
+        aws.s3.put_object(Body=json.dumps(activity), Bucket=BUCKET,
+                          Key="activity_{a}_{b}.json".format(a=ATHLETE_ID, b=activity_id))
+        key = StreamFile.filename(ATHLETE_ID, activity_id)
+        aws.s3.put_object(Body=StreamFile.to_bytes(streams), Bucket=BUCKET, Key=key)
+        event = stream_event(key)
+
+        def record():
+            # a first time activity each run, so every peak row is written
+            aws.activities.truncate()
+            process_streams.main(event, None)
+
+        results["fill_values/" + name] = measure(fill, repeat)
+        results["calc_peak/" + name] = measure(peaks, repeat)
+        results["process_streams_record/" + name] = measure(record, repeat)
+        results["process_streams_record/" + name]["samples"] = len(time_stream)
+    return results
+
+
+def seed_peaks(aws, activities):
+    # `activities` worth of peak rows for one athlete, a third of them recent
+    from lib.activity_peak import ActivityPeak
+    rng = np.random.default_rng(7)
+    now = datetime.now()
+    aws.peaks.truncate()
+    with aws.peaks.batch_writer() as batch:
+        for i in range(activities):
+            start = now - timedelta(days=int(rng.integers(0, 90 if i % 3 == 0 else 2000)))
+            for statistic in process_streams.STATISTICS:
+                for duration in process_streams.PEAK_DURATIONS:
+                    value = float(rng.gamma(4, 50))
+                    peak_type = "Ride_{s}_{d}".format(s=statistic, d=duration)
+                    batch.put_item(Item={
+                        "athlete_id": ATHLETE_ID,
+                        "activity_id": str(i),
+                        "peak_id": "{i}_{s}_{d}".format(i=i, s=statistic, d=duration),
+                        "peak_type": peak_type,
+                        "attribute": statistic,
+                        "duration": duration,
+                        "name": "Synthetic Ride",
+                        "start_date_local": start.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "value": Decimal(str(round(value, 2))),
+                        "value_sort": ActivityPeak.value_sort(peak_type, value),
+                    })
+
+
+def athlete_cases(aws, sizes, repeat):
+    from lib.activity_peak import ActivityPeak
+    import ingest_strava
+
+    results = {}
+    for activities in sizes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            seed_peaks(aws, activities)
+        results["get_top/{n}_activities".format(n=activities)] = measure(
+            lambda: ActivityPeak.get_top(ATHLETE_ID), repeat)
+
+        aws.leaderboard.truncate()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ActivityPeak.seed_leaderboards(ATHLETE_ID)
+        key = "peaks_{athlete_id}.json".format(athlete_id=ATHLETE_ID)
+        event = {"Records": [{"body": json.dumps({"Records": [
+            {"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]})}]}
+
+        def recent():
+            # nothing stored yet, so every recent peak type is written
+            aws.recent.truncate()
+            ingest_strava.process_peaks(event, None)
+
+        results["process_peaks/{n}_activities".format(n=activities)] = measure(recent, repeat)
+    return results
+
+
+def commit_id():
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                             capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return "unknown"
+    return sha + ("-dirty" if dirty else "") if sha else "unknown"
+
+
+def save(results):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    commit = commit_id()
+    path = os.path.join(RESULTS_DIR, "{commit}.json".format(commit=commit))
+    with open(path, "w") as f:
+        json.dump({
+            "commit": commit,
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+    return path
+
+
+def load(reference):
+    path = reference if os.path.exists(reference) else os.path.join(
+        RESULTS_DIR, "{ref}.json".format(ref=reference))
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(base, head, threshold):
+    # prints the change in median latency and peak memory per benchmark,
+    # flagging anything more than threshold % worse
+    regressions = []
+    print("{name:<44} {base:>10} {head:>10} {delta:>8} {mem:>8}".format(
+        name="benchmark", base=base["commit"], head=head["commit"],
+        delta="time", mem="memory"))
+    for name in sorted(set(base["results"]) & set(head["results"])):
+        b, h = base["results"][name], head["results"][name]
+        delta = (h["median_ms"] - b["median_ms"]) / b["median_ms"] * 100 if b["median_ms"] else 0
+        mem = ((h.get("peak_kb", 0) - b.get("peak_kb", 0)) / b["peak_kb"] * 100
+               if b.get("peak_kb") else 0)
+        flag = ""
+        if delta > threshold or mem > threshold:
+            flag = "  <-- regression"
+            regressions.append(name)
+        print("{name:<44} {b:>8.2f}ms {h:>8.2f}ms {delta:>+7.1f}% {mem:>+7.1f}%{flag}".format(
+            name=name, b=b["median_ms"], h=h["median_ms"], delta=delta, mem=mem, flag=flag))
+    return regressions
+
+
+def run(args):
+    aws = LocalAws(Config.instance(), tempfile.mkdtemp(prefix="sts1-bench-")).install()
+    metrics.metrics.sink = metrics.MemorySink()
+    results = {}
+    results.update(stream_cases(aws, args.cases, args.repeat))
+    results.update(athlete_cases(aws, args.activities, args.repeat))
+    for name, result in sorted(results.items()):
+        print("{name:<44} median {median_ms:>9.2f} ms  p95 {p95_ms:>9.2f} ms  peak {peak_kb:>9.1f} KB".format(
+            name=name, **result))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="stream pipeline benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cases", nargs="*", default=list(synthetic.CASES))
+    parser.add_argument("--activities", nargs="*", type=int, default=[200, 2000])
+    parser.add_argument("--compare", metavar="BASE",
+                        help="commit or results file to compare the current results with")
+    parser.add_argument("--head", help="results to compare against BASE instead of a new run")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.head:
+        head = load(args.head)
+    else:
+        results = run(args)
+        if not args.no_save:
+            print("saved", save(results))
+        head = {"commit": commit_id(), "results": results}
+    if args.compare:
+        regressions = compare(load(args.compare), head, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
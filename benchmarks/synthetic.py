@@ -0,0 +1,127 @@
+# synthetic activities shaped like what strava hands back: 1 Hz or smart
+# recorded (irregular 1-7 s samples) streams with auto-pause gaps, and the
+# activity summary fields process_streams reads. everything is seeded so a
+# given case produces the same data on every run
+from datetime import datetime, timedelta
+import numpy as np
+
+START = datetime(2020, 6, 1, 7, 30)
+
+
+def time_stream(rng, seconds, smart=False, pauses=0):
+    # `seconds` of moving time, as samples every second or every few
+    if smart:
+        steps = rng.choice([1, 1, 2, 3, 4, 5, 7], size=seconds)
+        steps = steps[np.cumsum(steps) <= seconds]
+    else:
+        steps = np.ones(seconds, dtype=np.int64)
+    # auto-pause: a few long gaps (coffee stops, traffic lights)
+    for idx in rng.integers(1, len(steps), size=pauses):
+        steps[idx] += int(rng.integers(45, 900))
+    return np.concatenate([[0], np.cumsum(steps)])
+
+
+def smooth(rng, n, base, spread, period):
+    # slow drifting effort with intervals plus sample noise
+    x = np.arange(n)
+    effort = base + spread * np.sin(x / period) + spread * 0.5 * np.sin(x / (period * 7.3))
+    effort += rng.normal(0, spread * 0.15, n)
+    return effort
+
+
+def lagged(values, alpha):
+    out = np.empty_like(values)
+    acc = values[0]
+    for i, v in enumerate(values):
+        acc += alpha * (v - acc)
+        out[i] = acc
+    return out
+
+
+def ride(hours, seed=1, smart=False, pauses=None):
+    rng = np.random.default_rng(seed)
+    seconds = int(hours * 3600)
+    pauses = int(hours * 2) if pauses is None else pauses
+    t = time_stream(rng, seconds, smart, pauses)
+    n = len(t)
+    watts = np.clip(smooth(rng, n, 210, 60, 240), 0, None)
+    # coasting and the odd sprint
+    watts[rng.random(n) < 0.08] = 0
+    sprints = rng.integers(0, n, size=max(1, int(hours * 3)))
+    for s in sprints:
+        watts[s:s + 15] += 600
+    heartrate = lagged(110 + watts * 0.25, 0.02)
+    velocity = np.clip(smooth(rng, n, 9.0, 1.5, 400), 0.5, None)
+    streams = {
+        "time": t.tolist(),
+        "watts": np.round(watts).astype(int).tolist(),
+        "heartrate": np.round(heartrate).astype(int).tolist(),
+        "velocity_smooth": np.round(velocity, 2).tolist(),
+    }
+    return streams, summary("Ride", t, velocity, seed)
+
+
+def run(hours, seed=2, smart=True, pauses=None):
+    rng = np.random.default_rng(seed)
+    seconds = int(hours * 3600)
+    pauses = int(hours) if pauses is None else pauses
+    t = time_stream(rng, seconds, smart, pauses)
+    n = len(t)
+    velocity = np.clip(smooth(rng, n, 3.3, 0.4, 300), 0.5, None)
+    heartrate = lagged(100 + velocity * 20, 0.03)
+    streams = {
+        "time": t.tolist(),
+        "heartrate": np.round(heartrate).astype(int).tolist(),
+        "velocity_smooth": np.round(velocity, 2).tolist(),
+    }
+    return streams, summary("Run", t, velocity, seed)
+
+
+def row(hours, seed=3, smart=False, pauses=None):
+    rng = np.random.default_rng(seed)
+    seconds = int(hours * 3600)
+    pauses = int(hours * 4) if pauses is None else pauses
+    t = time_stream(rng, seconds, smart, pauses)
+    n = len(t)
+    # power pulses with the stroke, roughly every 2-3 s
+    stroke = 0.5 + 0.5 * np.sin(np.arange(n) * 2 * np.pi / 2.4)
+    watts = np.clip(smooth(rng, n, 170, 30, 600) * (0.4 + stroke), 0, None)
+    heartrate = lagged(100 + watts * 0.3, 0.02)
+    velocity = np.clip(smooth(rng, n, 4.0, 0.3, 500), 0.5, None)
+    streams = {
+        "time": t.tolist(),
+        "watts": np.round(watts).astype(int).tolist(),
+        "heartrate": np.round(heartrate).astype(int).tolist(),
+        "velocity_smooth": np.round(velocity, 2).tolist(),
+    }
+    return streams, summary("Rowing", t, velocity, seed)
+
+
+def summary(activity_type, t, velocity, seed):
+    return {
+        "id": 100000 + seed,
+        "athlete": {"id": 42},
+        "type": activity_type,
+        "name": "Synthetic {type}".format(type=activity_type),
+        "start_date_local": (START + timedelta(days=seed)).strftime("%Y-%m-%dT%H:%M:%S"),
+        "elapsed_time": str(timedelta(seconds=int(t[-1]))),
+        "distance": float(np.round(velocity.mean() * t[-1], 1)),
+        "suffer_score": 50 + seed,
+        "trainer": False,
+    }
+
+
+# name -> (generator, kwargs)
+CASES = {
+    "ride_1h": (ride, {"hours": 1}),
+    "ride_4h": (ride, {"hours": 4}),
+    "ride_12h": (ride, {"hours": 12}),
+    "ride_4h_smart": (ride, {"hours": 4, "smart": True}),
+    "run_1h_smart": (run, {"hours": 1}),
+    "row_1h": (row, {"hours": 1}),
+}
+
+
+def generate(name):
+    generator, kwargs = CASES[name]
+    return generator(**kwargs)
@@ -1,11 +1,34 @@
 import os
 import json
+import time
+from threading import Lock
 import boto3
 
+# fetched together in one GetParameters call the first time any is used
+SECRET_NAMES = ["STRAVA_CLIENT_ID", "STRAVA_CLIENT_SECRET"]
+
 
 class Config():
+    # one Config per container, shared through Config.instance(). clients
+    # and secrets are created / fetched on first use rather than at import
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
     def __init__(self):
-        self.ssm_client = boto3.client("ssm", region_name="us-east-1")
+        self._ssm_client = None
+        self._secrets = {}
+        self._secrets_fetched_at = None
+        self._secrets_lock = Lock()
+        # 0 keeps secrets for the lifetime of the container
+        self.secrets_ttl = int(os.getenv("CONFIG_SECRETS_TTL", "0"))
         self.strava_auth_table = os.environ["STRAVA_AUTH_TABLE"]
         self.recent_athlete_peaks_table = os.environ["RECENT_ATHLETE_PEAKS_TABLE"]
 
@@ -14,10 +37,10 @@ class Config():
         self.recent_athlete_peaks_to_s3 = os.environ["RECENT_ATHLETE_PEAKS_QUEUE"]
 
         self.athlete_peaks_table = os.environ["PEAKS_TABLE"]
+        self.activities_table = os.environ["ACTIVITIES_TABLE"]
+        self.athlete_leaderboard_table = os.environ["LEADERBOARD_TABLE"]
         self.strava_api_uri = "https://www.strava.com/api/v3"
         self.strava_api_s3_bucket = os.getenv("BUCKET").split(".")[0]
-        self.strava_client_id = self.get_secret("STRAVA_CLIENT_ID")
-        self.strava_client_secret = self.get_secret("STRAVA_CLIENT_SECRET")
         self.cognito_user_pool = os.environ["USER_POOL"]
         self.cognito_user_pool_client_id = os.environ["USER_POOL_CLIENT_ID"]
         self.cognito_login_url = os.environ["COGNITO_LOGIN_URL"]
@@ -26,11 +49,68 @@ class Config():
         self.callback_url = os.environ["URL"]
         self.stage = os.environ["STAGE"]
         self.aws_region = "us-east-1"
+        # recording gaps longer than this are auto-pause and get zero filled
+        self.pause_gap_seconds = int(os.getenv("PAUSE_GAP_SECONDS", "30"))
+        self.process_streams_workers = int(os.getenv("PROCESS_STREAMS_WORKERS", "8"))
+        # seconds a cached peaks response is served before checking its stamp
+        self.peak_cache_ttl = int(os.getenv("PEAK_CACHE_TTL", "30"))
+        # a stamp younger than this may be ahead of the indexes a response
+        # is read from, so that response isn't cached
+        self.peak_cache_settle_seconds = int(os.getenv("PEAK_CACHE_SETTLE_SECONDS", "5"))
+        # shared strava budget, without a table each process limits itself
+        self.rate_limit_table = os.getenv("RATE_LIMIT_TABLE")
+        self.strava_rate_limit_short = int(os.getenv("STRAVA_RATE_LIMIT_15MIN", "600"))
+        self.strava_rate_limit_long = int(os.getenv("STRAVA_RATE_LIMIT_DAILY", "30000"))
+        # longest a worker waits for budget before giving the message back
+        self.strava_rate_limit_max_wait = int(os.getenv("STRAVA_RATE_LIMIT_MAX_WAIT", "240"))
+        self.strava_fetch_workers = int(os.getenv("STRAVA_FETCH_WORKERS", "8"))
+        self.strava_sync_workers = int(os.getenv("STRAVA_SYNC_WORKERS", "8"))
+        self.strava_auth_scan_segments = int(os.getenv("STRAVA_AUTH_SCAN_SEGMENTS", "4"))
+        # an athlete's peaks are recomputed once they've been unchanged this
+        # long, or at the latest max_wait after the first pending change
+        self.peaks_recompute_quiet_seconds = int(os.getenv("PEAKS_RECOMPUTE_QUIET_SECONDS", "300"))
+        self.peaks_recompute_max_wait_seconds = int(os.getenv("PEAKS_RECOMPUTE_MAX_WAIT_SECONDS", "3600"))
+
+    @property
+    def ssm_client(self):
+        if self._ssm_client is None:
+            self._ssm_client = boto3.client("ssm", region_name=self.aws_region)
+        return self._ssm_client
+
+    @property
+    def strava_client_id(self):
+        return self.get_secret("STRAVA_CLIENT_ID")
+
+    @property
+    def strava_client_secret(self):
+        return self.get_secret("STRAVA_CLIENT_SECRET")
+
+    def secrets_expired(self):
+        if self._secrets_fetched_at is None:
+            return True
+        if not self.secrets_ttl:
+            return False
+        return time.time() - self._secrets_fetched_at > self.secrets_ttl
 
     def get_secret(self, key):
-        resp = self.ssm_client.get_parameter(
-            Name=key, WithDecryption=True)
-        return resp["Parameter"]["Value"]
+        if key not in self._secrets or self.secrets_expired():
+            with self._secrets_lock:
+                if key not in self._secrets or self.secrets_expired():
+                    self.fetch_secrets([key])
+        return self._secrets[key]
+
+    def fetch_secrets(self, keys):
+        names = SECRET_NAMES + [k for k in keys if k not in SECRET_NAMES]
+        resp = self.ssm_client.get_parameters(
+            Names=names, WithDecryption=True)
+        for param in resp["Parameters"]:
+            self._secrets[param["Name"]] = param["Value"]
+        if resp.get("InvalidParameters"):
+            raise KeyError("missing parameters: {names}".format(
+                names=", ".join(resp["InvalidParameters"])))
+        self._secrets_fetched_at = time.time()
 
     def __str__(self):
-        return json.dumps(self.__dict__, default=str)
+        return json.dumps(
+            {k: v for k, v in self.__dict__.items() if not k.startswith("_")},
+            default=str)
@@ -1,22 +1,42 @@
 import datetime
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
 import json
 from pprint import pprint
 from botocore.exceptions import ClientError
 from config import Config
+from lib.activity_peak import ActivityPeak
+from lib.athlete_stamp import AthleteStamp
+from lib.athlete_ids import get_athlete_id
+from lib.peak_cache import PeakCache, cached_response, if_none_match
+from lib.metrics import count, instrument
 
-config = Config()
+config = Config.instance()
 
-dynamodb = boto3.resource("dynamodb", region_name=config.aws_region)
-peaks_table = dynamodb.Table(config.athlete_peaks_table)
-strava_auth_table = dynamodb.Table(config.strava_auth_table)
+peak_cache = PeakCache(AthleteStamp.PEAKS)
 
 
+def load_peaks(athlete_id, peaks_type, params):
+    # the peaks_value index is ordered by value within a peak_type, so
+    # only the top `limit` items are read
+    peaks = ActivityPeak.query_top(
+        athlete_id, peaks_type, int(params["limit"]))
+
+    for peak in peaks:
+        peak["start_date_local"] = datetime.datetime.strptime(
+            peak["start_date_local"], "%Y-%m-%dT%H:%M:%S"
+        )
+
+        if params["attribute"] == "velocity_smooth":
+            peak["value"] = 2.23694 * float(peak["value"])
+            # peak["converted"] = True
+
+    return json.dumps(peaks, default=str)
+
+
+@instrument
 def main(event, context):
     user_id = event["requestContext"]["authorizer"]["principalId"]
     try:
-        response = strava_auth_table.get_item(Key={"user_id": user_id})
+        athlete_id = get_athlete_id(user_id)
     except ClientError as e:
         print(e.response["Error"]["Message"])
     else:
@@ -31,45 +51,18 @@ def main(event, context):
             if event["queryStringParameters"] and p in event["queryStringParameters"]:
                 params[p] = event["queryStringParameters"][p]
 
-        athlete_id = response["Item"]["athlete_id"]
         peaks_type = "{type}_{attribute}_{duration}".format(
             type=params["type"],
             attribute=params["attribute"],
             duration=params["duration"]
         )
         print(athlete_id, peaks_type)
-        peaks_response = peaks_table.query(
-            IndexName='peaks_type',  # example key = Ride_velocity_smooth_300
-            KeyConditionExpression=Key('athlete_id').eq(
-                athlete_id) & Key('peak_type').eq(peaks_type),
-            Select='ALL_PROJECTED_ATTRIBUTES',
-            ReturnConsumedCapacity='INDEXES',
-            ScanIndexForward=False,  # return results in descending order of sort key
-        )
-        peaks = peaks_response["Items"]
-
-        max_limit = (
-            int(params["limit"]) if int(
-                params["limit"]) <= len(peaks) else len(peaks)
+        body, etag, status = peak_cache.get(
+            athlete_id,
+            (peaks_type, params["limit"]),
+            lambda: load_peaks(athlete_id, peaks_type, params),
+            client_etag=if_none_match(event),
         )
-
-        for peak in peaks:
-            if isinstance(peak["start_date_local"], datetime.datetime):
-                continue
-
-            peak["start_date_local"] = datetime.datetime.strptime(
-                peak["start_date_local"], "%Y-%m-%dT%H:%M:%S"
-            )
-
-            if params["attribute"] == "velocity_smooth":
-                peak["value"] = 2.23694 * float(peak["value"])
-                # peak["converted"] = True
-
-        sorted_filter_peaks = sorted(peaks, key=lambda i: i["value"], reverse=True)[
-            0: int(max_limit)
-        ]
-
-        return {
-            "statusCode": 200,
-            "body": json.dumps(sorted_filter_peaks, default=str),
-        }
+        print('peak cache', status, peak_cache.stats())
+        count("cache_{status}".format(status=status.lower()))
+        return cached_response(event, body, etag, status)
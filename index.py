@@ -7,12 +7,18 @@ from stravalib.client import Client as StravaClient
 from pprint import pprint
 from config import Config
 from lib.recent_athlete_peak import RecentAthletePeak
+from lib.athlete_stamp import AthleteStamp
+from lib.athlete_ids import get_athlete_id, forget_athlete_id
+from lib.peak_cache import PeakCache, cached_response, if_none_match
+from lib.metrics import count, instrument
 
-config = Config()
+config = Config.instance()
 dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
 strava_auth_table = dynamodb.Table(config.strava_auth_table)
 sqs = boto3.client("sqs")
 
+recent_peaks_cache = PeakCache(AthleteStamp.RECENT_PEAKS)
+
 
 env = Environment(
     loader=FileSystemLoader(
@@ -28,47 +34,53 @@ HTML_HEADERS = {
     "Content-Type": "text/html",
 }
 
-params = {
-    "strava_client_id": config.strava_client_id,
-    "user_pool": config.cognito_user_pool,
-    "callback_url": config.callback_url,
-    "user_pool_client_id": config.cognito_user_pool_client_id,
-    "cognito_login_url": config.cognito_login_url,
-    "stage": config.stage,
-    "cognito_url": config.cognito_url
-}
+def template_params():
+    # built per render so the strava secret is only fetched when a page
+    # actually needs it
+    return {
+        "strava_client_id": config.strava_client_id,
+        "user_pool": config.cognito_user_pool,
+        "callback_url": config.callback_url,
+        "user_pool_client_id": config.cognito_user_pool_client_id,
+        "cognito_login_url": config.cognito_login_url,
+        "stage": config.stage,
+        "cognito_url": config.cognito_url
+    }
 
 
 def root_view():
     template = env.get_template("main.html")
 
-    return template.render(title=u"STS-1", params=params)
+    return template.render(title=u"STS-1", params=template_params())
 
 
 def strava_auth_view(authorize_url):
     template = env.get_template("strava_auth.html")
-    return template.render(title=u"STS-1 Strava Auth", authorize_url=authorize_url, params=params)
+    return template.render(title=u"STS-1 Strava Auth", authorize_url=authorize_url, params=template_params())
 
 
+@instrument
 def strava_callback(event, context):
     template = env.get_template("strava_callback.html")
 
     return {
         "statusCode": 200,
         "headers": HTML_HEADERS,
-        "body": template.render(title=u"STS-1 Strava Callback", params=params),
+        "body": template.render(title=u"STS-1 Strava Callback", params=template_params()),
     }
 
 
+@instrument
 def logout(event, context):
     template = env.get_template("logout.html")
     return {
         "statusCode": 200,
         "headers": HTML_HEADERS,
-        "body": template.render(title=u"STS-1 Logout", params=params),
+        "body": template.render(title=u"STS-1 Logout", params=template_params()),
     }
 
 
+@instrument
 def backfill_athlete(event, context):
     user_id = event["requestContext"]["authorizer"]["principalId"]
     auth_response = strava_auth_table.get_item(Key={"user_id": user_id})
@@ -89,6 +101,7 @@ def backfill_athlete(event, context):
     return {"statusCode": 200, "body": json.dumps(response)}
 
 
+@instrument
 def strava_authorized(event, context):
     payload = json.loads(event["body"])
     strava_client = StravaClient()
@@ -118,6 +131,7 @@ def strava_authorized(event, context):
         "athlete_id": str(athlete.id),
     }
     response = strava_auth_table.put_item(Item=strava_auth_record)
+    forget_athlete_id(user_id)
     print('saved strava auth credentials', response)
     # TODO - if no auth response it should return error
 
@@ -139,6 +153,7 @@ def strava_authorized(event, context):
     }
 
 
+@instrument
 def strava_auth(event, context):
     strava_client = StravaClient()
     redirect_uri = "{callback_url}strava-callback".format(
@@ -154,6 +169,7 @@ def strava_auth(event, context):
     }
 
 
+@instrument
 def profile(event, context):
     user_id = event["requestContext"]["authorizer"]["principalId"]
     response = strava_auth_table.query(
@@ -169,13 +185,7 @@ def profile(event, context):
     }
 
 
-def recent_peaks(event, context):
-    user_id = event["requestContext"]["authorizer"]["principalId"]
-    response = strava_auth_table.query(
-        KeyConditionExpression=Key("user_id").eq(user_id)
-    )
-    # print(response)
-    athlete_id = response["Items"][0]["athlete_id"]
+def load_recent_peaks(athlete_id):
     res = RecentAthletePeak.fetch(athlete_id)
     formatted_items = []
     for item in res['Items']:
@@ -183,12 +193,24 @@ def recent_peaks(event, context):
 
     formatted_items.sort(
         key=lambda x: int(x['date_timestamp']), reverse=True)
+    return json.dumps(formatted_items, default=str)
 
-    return {
-        "statusCode": 200,
-        "body": json.dumps(formatted_items, default=str),
-    }
+
+@instrument
+def recent_peaks(event, context):
+    user_id = event["requestContext"]["authorizer"]["principalId"]
+    athlete_id = get_athlete_id(user_id)
+    body, etag, status = recent_peaks_cache.get(
+        athlete_id,
+        ("recent",),
+        lambda: load_recent_peaks(athlete_id),
+        client_etag=if_none_match(event),
+    )
+    print('recent peaks cache', status, recent_peaks_cache.stats())
+    count("cache_{status}".format(status=status.lower()))
+    return cached_response(event, body, etag, status)
 
 
+@instrument
 def main(event, context):
     return {"statusCode": 200, "headers": HTML_HEADERS, "body": root_view()}
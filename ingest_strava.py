@@ -2,13 +2,21 @@ import boto3
 from stravalib.client import Client as StravaClient
 from datetime import datetime, timedelta
 import json
-from ratelimiter import RateLimiter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import Config
 from lib.strava_activity import StravaActivity
 from lib.strava_athlete import StravaAthlete
-from lib.strava_enqueue import EnqStravaApiActivities
+from lib.backfill_planner import BackfillPlanner
 from lib.activity_peak import ActivityPeak
+from lib.activity_ledger import ActivityLedger
 from lib.recent_athlete_peak import RecentAthletePeak
+from lib.athlete_stamp import AthleteStamp
+from lib.stream_file import StreamFile
+from lib.rate_limiter import strava_rate_limiter
+from lib.http_session import strava_session
+from lib.sqs_batch import SqsBatch
+from lib.sqs_producer import SqsBatchProducer
+from lib.metrics import count, instrument
 from pprint import pprint
 
 STREAM_TYPES = [
@@ -21,8 +29,9 @@ STREAM_TYPES = [
     "heartrate",
     "watts",
 ]
-strava_client = StravaClient()
-config = Config()
+# stop starting athlete syncs this close to the lambda timeout
+SYNC_TIME_MARGIN_MS = 60 * 1000
+config = Config.instance()
 
 s3_client = boto3.client("s3")
 ssm_client = boto3.client("ssm")
@@ -31,70 +40,144 @@ dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
 strava_auth_table = dynamodb.Table(config.strava_auth_table)
 
 
-def get_and_save_strava_streams(strava_client, activity_id, athlete_id):
-    streams_filename = "streams_{athlete_id}_{activity_id}.json".format(
-        athlete_id=athlete_id, activity_id=activity_id)
+def get_and_save_strava_streams(strava_client, activity_id, athlete_id, fingerprint=None):
+    # the activity's fingerprint goes in the ledger only once its streams
+    # are saved (or strava has none), a fetch that fails or never runs
+    # leaves the activity to be picked up by the next sync
     streams = strava_client.get_activity_streams(
         activity_id, types=STREAM_TYPES
     )
     formatted_streams = {}
-    if streams is None:
-        return False
+    if streams is not None:
+        for stream in streams.keys():
+            formatted_streams[stream] = streams[stream].data
+        StreamFile.save(formatted_streams, athlete_id, activity_id)
 
-    for stream in streams.keys():
-        formatted_streams[stream] = streams[stream].data
-
-    s3_client.put_object(
-        Body=json.dumps(formatted_streams, default=str),
-        Bucket=config.strava_api_s3_bucket,
-        Key=streams_filename,
-    )
-    print('saving streams to {bucket}:{key}'.format(
-        bucket=config.strava_api_s3_bucket, key=streams_filename))
-    return True
+    if fingerprint is not None:
+        ActivityLedger.record(athlete_id, {activity_id: fingerprint})
+    return streams is not None
 
 
-@RateLimiter(max_calls=600, period=900)
-def strava_api_call(job_type, message_attribs, athlete_id, user_id):
+@strava_rate_limiter.limit
+def strava_api_call(job_type, message_attribs, athlete, strava_client):
     if job_type == "FETCH_STRAVA_ACTIVITY":
-        athlete = StravaAthlete(user_id=user_id)
+        before = datetime.strptime(
+            message_attribs['BeforeDate']['stringValue'], "%m/%d/%Y")
+        after = datetime.strptime(
+            message_attribs['AfterDate']['stringValue'], "%m/%d/%Y")
         stravaActivities = StravaActivity.fetch(
-            athlete=athlete,
-            before=datetime.strptime(
-                message_attribs['BeforeDate']['stringValue'], "%m/%d/%Y"),
-            after=datetime.strptime(
-                message_attribs['AfterDate']['stringValue'], "%m/%d/%Y"))
+            athlete=athlete, before=before, after=after)
+        save_changed_activities(athlete, stravaActivities)
 
-        for stravaActivity in stravaActivities:
-            stravaActivity.saveToS3()
-            stravaActivity.enqueueStreamFetch()
+        if "Backfill" in message_attribs:
+            BackfillPlanner(athlete).advance(before, after, len(stravaActivities))
 
     elif job_type == "FETCH_STRAVA_STREAM":
+        athlete_id = message_attribs['AthleteId']['stringValue']
         activity_id = message_attribs['ActivityId']['stringValue']
+        fingerprint = message_attribs.get('Fingerprint', {}).get('stringValue')
         get_and_save_strava_streams(
-            strava_client=strava_client, athlete_id=athlete_id, activity_id=activity_id)
+            strava_client=strava_client, athlete_id=athlete_id, activity_id=activity_id,
+            fingerprint=fingerprint)
+
+
+def save_changed_activities(athlete, stravaActivities):
+    # only activities that are new or edited since they were last seen are
+    # saved and get a stream fetch, the rest are already in the pipeline.
+    # the fingerprint travels with the stream fetch, which records it
+    if not stravaActivities:
+        return 0
+    by_id = {str(a.data.id): a for a in stravaActivities}
+    changed = ActivityLedger.changed(
+        athlete.athlete_id, {activity_id: a.data.to_dict() for activity_id, a in by_id.items()})
+
+    with SqsBatchProducer(config.strava_api_queue_url) as producer:
+        for activity_id, fingerprint in changed.items():
+            stravaActivity = by_id[activity_id]
+            print('enqueue stream fetch and save activity to s3: ', stravaActivity)
+            stravaActivity.saveToS3()
+            stravaActivity.enqueueStreamFetch(producer=producer, fingerprint=fingerprint)
 
+    count("activities_listed", len(by_id))
+    count("activities_changed", len(changed))
+    print('{changed} of {total} activities new or changed for {athlete_id}'.format(
+        changed=len(changed), total=len(by_id), athlete_id=athlete.athlete_id))
+    return len(changed)
 
-def enqueue_strava_athlete_sync(event, context):
-    athletes = StravaAthlete.get_all()
-    for athlete in athletes:
-        stravaActivities = StravaActivity.fetch(athlete=athlete)
 
-        for stravaActivity in stravaActivities:
-            print('enqueue stream fetch and save activity to s3: ', stravaActivity)
-            stravaActivity.saveToS3()
-            stravaActivity.enqueueStreamFetch()
+@strava_rate_limiter.limit
+def sync_athlete(athlete):
+    sync_started_at = datetime.now().timestamp()
+    stravaActivities = StravaActivity.fetch(athlete=athlete)
+    # last_sync_at only moves once the athlete's stream fetches are queued
+    changed = save_changed_activities(athlete, stravaActivities)
 
-        athlete.last_sync_at = datetime.now().timestamp()
-        athlete.save()
+    athlete.last_sync_at = sync_started_at
+    athlete.save_sync()
+    return changed
 
 
+@instrument
+def enqueue_strava_athlete_sync(event, context):
+    # athletes are synced on a bounded pool, stalest first, each saving its
+    # own last_sync_at. once the invocation is close to its timeout no new
+    # athletes are started, the rest are first in line on the next run
+    athletes = StravaAthlete.get_all()
+    athletes.sort(key=lambda athlete: athlete.last_sync_at or 0)
+
+    def sync(athlete):
+        if context is not None and \
+                context.get_remaining_time_in_millis() < SYNC_TIME_MARGIN_MS:
+            return None
+        return sync_athlete(athlete)
+
+    synced = skipped = failed = activities = 0
+    with ThreadPoolExecutor(max_workers=config.strava_sync_workers) as pool:
+        futures = {pool.submit(sync, athlete): athlete for athlete in athletes}
+        for future in as_completed(futures):
+            try:
+                changed = future.result()
+            except Exception as e:
+                failed += 1
+                print('failed to sync {athlete_id}: {error}'.format(
+                    athlete_id=futures[future].athlete_id, error=repr(e)))
+                continue
+            if changed is None:
+                skipped += 1
+            else:
+                synced += 1
+                activities += changed
+    print('synced {synced} athletes ({activities} new or changed activities), {skipped} left for the next run, {failed} failed'.format(
+        synced=synced, activities=activities, skipped=skipped, failed=failed))
+
+
+def recompute_due(athlete_id):
+    # debounce: wait until the athlete's peaks have been quiet for the
+    # window, but never hold a recompute back longer than max wait
+    stamps = AthleteStamp.fetch_all(athlete_id)
+    now = AthleteStamp.now()
+    updated_at = stamps.get(AthleteStamp.PEAKS, 0)
+    pending_at = stamps.get(AthleteStamp.RECOMPUTE_PENDING, now)
+    quiet = now - updated_at >= config.peaks_recompute_quiet_seconds * 1000
+    overdue = now - pending_at >= config.peaks_recompute_max_wait_seconds * 1000
+    return quiet or overdue
+
+
+@instrument
 def calculate_peaks_for_athlete(event, context):
     for athlete in event["Records"]:
         athlete_id = athlete["messageAttributes"]["AthleteId"]["stringValue"]
 
         print(athlete_id)
-        results = ActivityPeak.get_top(athlete_id)
+        if not recompute_due(athlete_id):
+            print('peaks still changing for {athlete_id}, requeueing'.format(
+                athlete_id=athlete_id))
+            RecentAthletePeak.enqueue(athlete_id, force=True)
+            continue
+        # cleared before reading so changes landing during the recompute
+        # queue another one
+        AthleteStamp.clear(athlete_id, AthleteStamp.RECOMPUTE_PENDING)
+        results = ActivityPeak.get_leaderboard(athlete_id)
         # pprint(results)
         peaks_filename = "peaks_{athlete_id}.json".format(
             athlete_id=athlete_id)
@@ -108,63 +191,125 @@ def calculate_peaks_for_athlete(event, context):
             filename=peaks_filename))
 
 
+def recent_peaks_for_athlete(athlete_id, days=30, top=9):
+    # peaks from the last `days` that rank in the athlete's top `top` for
+    # their type, straight off the leaderboards whose rows carry their
+    # activity's date. start_date_local is an ISO string so it sorts as one
+    since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%S")
+    recent_peaks = {}
+    for peak_type, peaks in ActivityPeak.get_leaderboard(athlete_id).items():
+        for i, peak in enumerate(peaks[0:top], 1):
+            if peak["start_date_local"] <= since:
+                continue
+            peak_date = datetime.strptime(
+                peak["start_date_local"], "%Y-%m-%dT%H:%M:%S")
+            peak = dict(peak, date_timestamp=int(peak_date.timestamp()), rank=i)
+            recent_peaks.setdefault(peak_type, []).append(peak)
+    return recent_peaks
+
+
+@instrument
 def process_peaks(event, context):
     # print(event)
     for record in event["Records"]:
         body = json.loads(record['body'])
         for s3_file in body['Records']:
-            bucket = s3_file['s3']['bucket']['name']
             key = s3_file['s3']['object']['key']
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            res_body = json.load(response["Body"])
-
-            recent_peaks = {}
-            for peak_type in res_body:
-                for i, peak in enumerate(res_body[peak_type][0:9], 1):
-                    peak_date = datetime.strptime(
-                        peak["start_date_local"], "%Y-%m-%dT%H:%M:%S")
-                    if peak_date > (datetime.now() - timedelta(days=30)):
-                        peak["date_timestamp"] = int(peak_date.timestamp())
-                        peak["rank"] = i
-                        if peak_type not in recent_peaks:
-                            recent_peaks[peak_type] = []
-                        recent_peaks[peak_type].append(peak)
-
-            RecentAthletePeak.bulk_save(recent_peaks)
-
-
+            # peaks_{athlete_id}.json, only the name is needed
+            athlete_id = key[len("peaks_"):-len(".json")]
+            recent_peaks = recent_peaks_for_athlete(athlete_id)
+            changes = RecentAthletePeak.save_changed(athlete_id, recent_peaks)
+            print('{changes} recent peak types changed for {athlete_id}'.format(
+                changes=changes, athlete_id=athlete_id))
+
+
+def fetch_strava_message(record):
+    print(record)
+    message_attribs = record['messageAttributes']
+    job_type = message_attribs['Job']['stringValue']
+    user_id = message_attribs['UserId']['stringValue']
+
+    # a client per message, so concurrent messages never share a token,
+    # all of them on the one keep-alive session
+    athlete = StravaAthlete.cached(user_id)
+    client = StravaClient(access_token=athlete.access_token,
+                          rate_limiter=strava_rate_limiter,
+                          requests_session=strava_session)
+    strava_api_call(job_type=job_type, message_attribs=message_attribs,
+                    athlete=athlete, strava_client=client)
+    return job_type
+
+
+def fetch_strava_group(records):
+    # one FIFO message group's records, in order. once one fails the rest
+    # of the group isn't run, they fail with it and come back behind it
+    results = []
+    failed_id = None
+    for record in records:
+        if failed_id is not None:
+            results.append((record, "skipped, {message_id} failed before it".format(
+                message_id=failed_id)))
+            continue
+        try:
+            fetch_strava_message(record)
+            results.append((record, None))
+        except Exception as e:
+            failed_id = record['messageId']
+            results.append((record, repr(e)))
+    return results
+
+
+@instrument
 def fetch_strava_api(event, context):
-    for record in event['Records']:
-        print(record)
-        message_attribs = record['messageAttributes']
-        job_type = message_attribs['Job']['stringValue']
-        athlete_id = message_attribs['AthleteId']['stringValue']
-        user_id = message_attribs['UserId']['stringValue']
-
-        strava_client.access_token = StravaAthlete(user_id).access_token
-        strava_api_call(job_type=job_type, message_attribs=message_attribs,
-                        athlete_id=athlete_id, user_id=user_id)
-
-
+    # runs the message groups of the batch (one per athlete) on a bounded
+    # pool, each group's messages in order on one worker, all of them
+    # taking their requests from the shared rate budget. messages succeed
+    # or fail on their own and a per message report is logged
+    records = event['Records']
+    batch = SqsBatch(records)
+    groups = {}
+    for record in records:
+        group_id = SqsBatch.group_id(record) or record['messageId']
+        groups.setdefault(group_id, []).append(record)
+    report = []
+    workers = max(1, min(config.strava_fetch_workers, len(groups)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_strava_group, group) for group in groups.values()]
+        for future in as_completed(futures):
+            for record, error in future.result():
+                result = {
+                    "message_id": record['messageId'],
+                    "job": record['messageAttributes']['Job']['stringValue'],
+                }
+                if error is None:
+                    result["status"] = "ok"
+                    count("messages_ok")
+                else:
+                    count("messages_failed")
+                    batch.fail(record['messageId'])
+                    result["status"] = "failed"
+                    result["error"] = error
+                report.append(result)
+    print('fetch report', json.dumps(report))
+    batch.complete()
+
+
+@instrument
 def enqueue_strava_backfill(event, context):
     print(event)
-    message_attributes = event["Records"][0]["messageAttributes"]
-    job = message_attributes["Job"]["stringValue"]
-    user_id = message_attributes["UserId"]["stringValue"]
-    athlete_id = message_attributes["AthleteId"]["stringValue"]
-
-    if job == "BACKFILL_ATHLETE":
-        enqueue_activity = EnqStravaApiActivities(user_id, athlete_id)
-        after = datetime.strptime("01/01/2015", "%m/%d/%Y")
-
-        while True:
-            before = after + timedelta(days=7)
-            response = enqueue_activity.queue(before, after)
-            print(response)
-            after += timedelta(days=7)
-
-            if after > datetime.now():
-                break
+    # every record of the batch, lambda deletes them all when this returns
+    for record in event["Records"]:
+        message_attributes = record["messageAttributes"]
+        job = message_attributes["Job"]["stringValue"]
+        user_id = message_attributes["UserId"]["stringValue"]
+        athlete_id = message_attributes["AthleteId"]["stringValue"]
+
+        if job == "BACKFILL_ATHLETE":
+            # the planner queues the first window, each window queues the next
+            athlete = StravaAthlete(user_id)
+            window = BackfillPlanner(athlete).start()
+            print('backfill for {athlete_id} starting with window'.format(
+                athlete_id=athlete_id), window)
 
     return {"status": "enqueued"}
 
@@ -0,0 +1,83 @@
+import boto3
+import hashlib
+import json
+from datetime import datetime
+from config import Config
+from lib.stream_file import VERSION as STREAM_FILE_VERSION
+
+config = Config.instance()
+dynamodb = boto3.resource("dynamodb", config.aws_region)
+activities_table = dynamodb.Table(config.activities_table)
+
+# the activity summary fields that end up in the activity file or the peaks,
+# an edit to any of them means the activity has to go through again
+FINGERPRINT_FIELDS = [
+    "name",
+    "type",
+    "start_date_local",
+    "distance",
+    "elapsed_time",
+    "moving_time",
+    "trainer",
+    "manual",
+    "suffer_score",
+    "device_watts",
+    "has_heartrate",
+    "upload_id",
+]
+BATCH_GET_SIZE = 100
+
+
+class ActivityLedger():
+    # fingerprint per activity, kept on its item in the activities table, so
+    # the incremental sync can skip activities it has already handled. a
+    # fingerprint is recorded by the stream fetch once the streams are
+    # saved. lib.stream_file.VERSION, the version of the columnar stream
+    # format, is part of every fingerprint, so bumping it sends everything
+    # through again as it's next listed
+    @classmethod
+    def fingerprint(cls, activity):
+        fields = {name: activity.get(name) for name in FINGERPRINT_FIELDS}
+        payload = json.dumps(fields, sort_keys=True, default=str)
+        digest = hashlib.sha1(payload.encode("utf8")).hexdigest()
+        return "{digest}:v{version}".format(digest=digest, version=STREAM_FILE_VERSION)
+
+    @classmethod
+    def fetch(cls, athlete_id, activity_ids):
+        fingerprints = {}
+        activity_ids = list(activity_ids)
+        for i in range(0, len(activity_ids), BATCH_GET_SIZE):
+            request = {config.activities_table: {
+                "Keys": [{"athlete_id": str(athlete_id), "activity_id": str(activity_id)}
+                         for activity_id in activity_ids[i:i + BATCH_GET_SIZE]],
+                "ProjectionExpression": "activity_id, fingerprint",
+            }}
+            while request:
+                res = dynamodb.batch_get_item(RequestItems=request)
+                for item in res["Responses"].get(config.activities_table, []):
+                    if "fingerprint" in item:
+                        fingerprints[item["activity_id"]] = item["fingerprint"]
+                request = res.get("UnprocessedKeys")
+        return fingerprints
+
+    @classmethod
+    def changed(cls, athlete_id, activities):
+        # activities is {activity_id: activity dict}, returns the ids whose
+        # fingerprint differs from the ledger along with the new fingerprints
+        fingerprints = {str(activity_id): cls.fingerprint(activity)
+                        for activity_id, activity in activities.items()}
+        known = cls.fetch(athlete_id, fingerprints.keys())
+        return {activity_id: fingerprint for activity_id, fingerprint in fingerprints.items()
+                if known.get(activity_id) != fingerprint}
+
+    @classmethod
+    def record(cls, athlete_id, fingerprints):
+        for activity_id, fingerprint in fingerprints.items():
+            activities_table.update_item(
+                Key={"athlete_id": str(athlete_id), "activity_id": str(activity_id)},
+                UpdateExpression="SET fingerprint = :fingerprint, fingerprinted_at = :now",
+                ExpressionAttributeValues={
+                    ":fingerprint": fingerprint,
+                    ":now": int(datetime.now().timestamp()),
+                },
+            )
@@ -3,37 +3,308 @@ from config import Config
 from boto3.dynamodb.conditions import Key
 from datetime import datetime
 from decimal import Decimal
+import hashlib
+import json
+import struct
+from functools import partial
+from lib.athlete_leaderboard import AthleteLeaderboard, LEADERBOARD_SIZE
+from lib.athlete_stamp import AthleteStamp
+from lib.metrics import span, count
 
-config = Config()
+config = Config.instance()
 dynamodb = boto3.resource("dynamodb", config.aws_region)
 peaks_table = dynamodb.Table(config.athlete_peaks_table)
+activities_table = dynamodb.Table(config.activities_table)
+BATCH_GET_SIZE = 100
 
 
 class ActivityPeak():
     def __init__(self, dataset):
         self.dataset = dataset
+        self.digests = {}
 
-    def save(self):
-        with peaks_table.batch_writer() as batch:
-            for row in self.dataset:
-                print("batch saving activity => ",
-                      row["activity_id"], " peak_id: ", row["peak_id"])
-                batch.put_item({
-                    "activity_id": row["activity_id"],
-                    "athlete_id": row["athlete_id"],
-                    "attribute": row["attribute"],
-                    "distance": Decimal(row["distance"]),
-                    "duration": int(row["duration"]),
-                    "elapsed_time": row["elapsed_time"],
-                    "name": row["name"],
-                    "peak_id": row["peak_id"],
-                    "peak_type": row["peak_type"],
-                    "start_date_local": row["start_date_local"],
-                    "trainer": row["trainer"],
-                    "type": row["type"],
-                    "value": Decimal(row["value"]),
-                    "last_updated": int(datetime.now().timestamp())
-                })
+    def save(self, save_digests=True):
+        # writes only rows whose content differs from the activity's peaks
+        # digest, a compact {peak_id: row hash} kept on the activity's item
+        # in the activities table. leaderboards and the peaks stamp are only
+        # touched when something was written. with save_digests=False the
+        # new digests are left for save_digests(), for a caller that has
+        # more to do before the rows count as saved
+        by_activity = {}
+        for row in self.dataset:
+            item = self.to_item(row)
+            by_activity.setdefault((item["athlete_id"], item["activity_id"]), []).append(item)
+
+        rows = []
+        digests = {}
+        skipped = 0
+        last_updated = int(datetime.now().timestamp())
+        for (athlete_id, activity_id), items in by_activity.items():
+            digest = self.fetch_digest(athlete_id, activity_id)
+            new_digest = {item["peak_id"]: self.row_hash(item) for item in items}
+            changed = [item for item in items
+                       if digest.get(item["peak_id"]) != new_digest[item["peak_id"]]]
+            skipped += len(items) - len(changed)
+            if not changed:
+                continue
+            with span("dynamodb_write"), peaks_table.batch_writer() as batch:
+                for item in changed:
+                    item["last_updated"] = last_updated
+                    batch.put_item(item)
+            rows.extend(changed)
+            digests[(athlete_id, activity_id)] = dict(digest, **new_digest)
+
+        print('peaks written: {written}, unchanged: {skipped}'.format(
+            written=len(rows), skipped=skipped))
+        count("peak_rows_written", len(rows))
+        count("peak_rows_skipped", skipped)
+        if rows:
+            self.update_leaderboards(rows)
+            for athlete_id in set(row["athlete_id"] for row in rows):
+                AthleteStamp.touch(athlete_id, AthleteStamp.PEAKS)
+        self.digests = digests
+        if save_digests:
+            self.save_digests()
+        return {"written": len(rows), "skipped": skipped}
+
+    def save_digests(self):
+        # last, so a failure before it leaves the rows to be written again
+        for (athlete_id, activity_id), digest in self.digests.items():
+            self.save_digest(athlete_id, activity_id, digest)
+        self.digests = {}
+
+    def replace(self, athlete_id, activity_ids):
+        # bulk counterpart of save() for recomputing an athlete: each of
+        # activity_ids is taken to have exactly the peaks in the dataset, so
+        # its rows in the peaks partition that the dataset no longer has are
+        # deleted, digest or not. digests only decide which rows are
+        # unchanged. every put and delete goes through one batch writer,
+        # de-duplicated on the table key, and the athlete's leaderboards
+        # are rebuilt from the whole partition after
+        items = {}
+        for row in self.dataset:
+            item = self.to_item(row)
+            items[item["peak_id"]] = item
+        by_activity = {str(activity_id): {} for activity_id in activity_ids}
+        for item in items.values():
+            by_activity.setdefault(item["activity_id"], {})[item["peak_id"]] = item
+
+        digests = self.fetch_digests(athlete_id, by_activity.keys())
+        existing = self.peak_ids_by_activity(str(athlete_id))
+        changed = {}
+        written = deleted = skipped = 0
+        last_updated = int(datetime.now().timestamp())
+        with span("dynamodb_write"), peaks_table.batch_writer(
+                overwrite_by_pkeys=["athlete_id", "peak_id"]) as batch:
+            for activity_id, activity_items in by_activity.items():
+                digest = digests.get(activity_id, {})
+                new_digest = {peak_id: self.row_hash(item)
+                              for peak_id, item in activity_items.items()}
+                stored = existing.get(activity_id, set())
+                stale = [peak_id for peak_id in stored if peak_id not in new_digest]
+                for peak_id, item in activity_items.items():
+                    if peak_id in stored and digest.get(peak_id) == new_digest[peak_id]:
+                        skipped += 1
+                        continue
+                    item["last_updated"] = last_updated
+                    batch.put_item(item)
+                    written += 1
+                for peak_id in stale:
+                    batch.delete_item(Key={"athlete_id": str(athlete_id), "peak_id": peak_id})
+                    deleted += 1
+                if new_digest != digest or stale:
+                    changed[activity_id] = new_digest
+
+        count("peak_rows_written", written)
+        count("peak_rows_deleted", deleted)
+        count("peak_rows_skipped", skipped)
+        if changed:
+            self.seed_leaderboards(str(athlete_id))
+            AthleteStamp.touch(str(athlete_id), AthleteStamp.PEAKS)
+        for activity_id, digest in changed.items():
+            self.save_digest(athlete_id, activity_id, digest)
+        return {"written": written, "deleted": deleted, "skipped": skipped}
+
+    @classmethod
+    def peak_ids_by_activity(cls, athlete_id):
+        # {activity_id: {peak_id}} of every row in the athlete's partition
+        peak_ids = {}
+        query = {
+            "KeyConditionExpression": Key("athlete_id").eq(athlete_id),
+            "ProjectionExpression": "peak_id, activity_id",
+        }
+        while True:
+            results = peaks_table.query(**query)
+            for item in results["Items"]:
+                peak_ids.setdefault(item["activity_id"], set()).add(item["peak_id"])
+            if "LastEvaluatedKey" not in results:
+                break
+            query["ExclusiveStartKey"] = results["LastEvaluatedKey"]
+        return peak_ids
+
+    @classmethod
+    def to_item(cls, row):
+        return {
+            "activity_id": row["activity_id"],
+            "athlete_id": row["athlete_id"],
+            "attribute": row["attribute"],
+            "distance": Decimal(row["distance"]),
+            "duration": int(row["duration"]),
+            "elapsed_time": row["elapsed_time"],
+            "name": row["name"],
+            "peak_id": row["peak_id"],
+            "peak_type": row["peak_type"],
+            "start_date_local": row["start_date_local"],
+            "trainer": row["trainer"],
+            "type": row["type"],
+            "value": Decimal(row["value"]),
+            "value_sort": cls.value_sort(row["peak_type"], row["value"]),
+        }
+
+    @classmethod
+    def row_hash(cls, item):
+        payload = json.dumps(item, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode("utf8")).hexdigest()[0:12]
+
+    @classmethod
+    def fetch_digest(cls, athlete_id, activity_id):
+        res = activities_table.get_item(
+            Key={"athlete_id": str(athlete_id), "activity_id": str(activity_id)},
+            ProjectionExpression="peaks_digest",
+        )
+        return res.get("Item", {}).get("peaks_digest", {})
+
+    @classmethod
+    def fetch_digests(cls, athlete_id, activity_ids):
+        # {activity_id: digest} for many activities, BATCH_GET_SIZE at a time
+        digests = {}
+        activity_ids = list(activity_ids)
+        for i in range(0, len(activity_ids), BATCH_GET_SIZE):
+            request = {config.activities_table: {
+                "Keys": [{"athlete_id": str(athlete_id), "activity_id": str(activity_id)}
+                         for activity_id in activity_ids[i:i + BATCH_GET_SIZE]],
+                "ProjectionExpression": "activity_id, peaks_digest",
+            }}
+            while request:
+                res = dynamodb.batch_get_item(RequestItems=request)
+                for item in res["Responses"].get(config.activities_table, []):
+                    digests[item["activity_id"]] = item.get("peaks_digest", {})
+                request = res.get("UnprocessedKeys")
+        return digests
+
+    @classmethod
+    def save_digest(cls, athlete_id, activity_id, digest):
+        activities_table.update_item(
+            Key={"athlete_id": str(athlete_id), "activity_id": str(activity_id)},
+            UpdateExpression="SET peaks_digest = :digest",
+            ExpressionAttributeValues={":digest": digest},
+        )
+
+    @classmethod
+    def encode_value(cls, value):
+        # hex of the big endian IEEE 754 double with the sign bit flipped
+        # for positives and every bit flipped for negatives, so the strings
+        # sort the same way as the numbers they encode
+        (bits,) = struct.unpack(">Q", struct.pack(">d", float(value)))
+        if bits & (1 << 63):
+            bits ^= 0xFFFFFFFFFFFFFFFF
+        else:
+            bits |= 1 << 63
+        return "{:016x}".format(bits)
+
+    @classmethod
+    def value_sort(cls, peak_type, value):
+        # sort key of the peaks_value index, e.g. Ride_watts_300#c072c00000000000
+        return "{peak_type}#{value}".format(
+            peak_type=peak_type, value=cls.encode_value(value))
+
+    @classmethod
+    def query_top(cls, athlete_id, peak_type, limit):
+        # highest `limit` peaks of a type straight off the value ordered index
+        return peaks_table.query(
+            IndexName="peaks_value",
+            KeyConditionExpression=Key("athlete_id").eq(athlete_id) & Key(
+                "value_sort").begins_with(cls.value_sort_prefix(peak_type)),
+            ProjectionExpression="athlete_id, peak_id, activity_id, #name, peak_type, "
+                                 "start_date_local, #value",
+            ExpressionAttributeNames={"#name": "name", "#value": "value"},
+            ScanIndexForward=False,
+            Limit=limit,
+        )["Items"]
+
+    @classmethod
+    def value_sort_prefix(cls, peak_type):
+        return "{peak_type}#".format(peak_type=peak_type)
+
+    @classmethod
+    def backfill_value_sort(cls, athlete_id):
+        # peaks written before the peaks_value index existed have no
+        # value_sort and so are missing from it until they are updated
+        exclusive_start_key = None
+        updated = 0
+        while True:
+            results = cls.get_all(athlete_id, exclusive_start_key)
+            for item in results["Items"]:
+                if "value_sort" in item:
+                    continue
+                peaks_table.update_item(
+                    Key={"athlete_id": item["athlete_id"], "peak_id": item["peak_id"]},
+                    UpdateExpression="SET value_sort = :value_sort",
+                    ExpressionAttributeValues={
+                        ":value_sort": cls.value_sort(item["peak_type"], item["value"])},
+                )
+                updated += 1
+            if "LastEvaluatedKey" not in results:
+                break
+            exclusive_start_key = results["LastEvaluatedKey"]
+        print('backfilled value_sort on {num} peaks for {athlete_id}'.format(
+            num=updated, athlete_id=athlete_id))
+        return updated
+
+    @classmethod
+    def update_leaderboards(cls, rows):
+        by_type = {}
+        for row in rows:
+            key = (row["athlete_id"], row["peak_type"])
+            by_type.setdefault(key, []).append(row)
+        for (athlete_id, peak_type), peak_rows in by_type.items():
+            AthleteLeaderboard.merge(athlete_id, peak_type, peak_rows, seed=partial(
+                cls.top_of_type, athlete_id, peak_type, LEADERBOARD_SIZE))
+
+    @classmethod
+    def top_of_type(cls, athlete_id, peak_type, limit):
+        # the athlete's best `limit` rows of one peak type. the peaks_type
+        # index has every row, with or without a value_sort, the winners are
+        # then read whole from the table
+        candidates = []
+        query = {
+            "IndexName": "peaks_type",
+            "KeyConditionExpression": Key("athlete_id").eq(athlete_id) & Key(
+                "peak_type").eq(peak_type),
+            "ProjectionExpression": "peak_id, #value",
+            "ExpressionAttributeNames": {"#value": "value"},
+        }
+        while True:
+            results = peaks_table.query(**query)
+            candidates.extend(results["Items"])
+            if "LastEvaluatedKey" not in results:
+                break
+            query["ExclusiveStartKey"] = results["LastEvaluatedKey"]
+        candidates.sort(key=lambda x: x["value"], reverse=True)
+        peak_ids = [p["peak_id"] for p in candidates[0:limit]]
+
+        rows = []
+        for i in range(0, len(peak_ids), BATCH_GET_SIZE):
+            request = {config.athlete_peaks_table: {
+                "Keys": [{"athlete_id": athlete_id, "peak_id": peak_id}
+                         for peak_id in peak_ids[i:i + BATCH_GET_SIZE]],
+            }}
+            while request:
+                res = dynamodb.batch_get_item(RequestItems=request)
+                rows.extend(res["Responses"].get(config.athlete_peaks_table, []))
+                request = res.get("UnprocessedKeys")
+        rows.sort(key=lambda x: x["value"], reverse=True)
+        return rows
 
     @classmethod
     def get_all(cls, athlete_id, exclusive_start_key=None):
@@ -60,7 +331,7 @@ class ActivityPeak():
         while True:
             print('querying results from dynamo', exclusive_start_key)
             results = cls.get_all(athlete_id, exclusive_start_key)
-            items = items + results['Items']
+            items.extend(results['Items'])
             if "LastEvaluatedKey" not in results:
                 break
             else:
@@ -83,3 +354,24 @@ class ActivityPeak():
             peaks_organized[key] = peaks_organized[key]
 
         return peaks_organized
+
+    @classmethod
+    def get_leaderboard(cls, athlete_id):
+        # top peaks per peak_type from the incrementally maintained
+        # leaderboard. boards merged before the athlete's were ever seeded
+        # only cover the types saved since, so until the seeded stamp is
+        # set every board is rebuilt from the full peaks partition
+        if AthleteStamp.fetch(athlete_id, AthleteStamp.LEADERBOARDS_SEEDED):
+            return AthleteLeaderboard.fetch(athlete_id)
+        print('leaderboards for {athlete_id} not seeded, rebuilding'.format(
+            athlete_id=athlete_id))
+        return cls.seed_leaderboards(athlete_id)
+
+    @classmethod
+    def seed_leaderboards(cls, athlete_id, peaks_organized=None):
+        if peaks_organized is None:
+            peaks_organized = cls.get_top(athlete_id)
+        AthleteLeaderboard.replace_all(athlete_id, peaks_organized)
+        AthleteStamp.touch(athlete_id, AthleteStamp.LEADERBOARDS_SEEDED)
+        return {peak_type: peaks[0:LEADERBOARD_SIZE]
+                for peak_type, peaks in peaks_organized.items()}
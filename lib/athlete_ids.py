@@ -0,0 +1,24 @@
+import boto3
+from config import Config
+from lib.cache import LRUCache
+
+config = Config.instance()
+dynamodb = boto3.resource("dynamodb", region_name=config.aws_region)
+strava_auth_table = dynamodb.Table(config.strava_auth_table)
+
+# user_id -> athlete_id only changes if a user reconnects strava
+athlete_ids = LRUCache(maxsize=1024, ttl=3600)
+
+
+def get_athlete_id(user_id):
+    athlete_id = athlete_ids.get(user_id)
+    if athlete_id is None:
+        response = strava_auth_table.get_item(Key={"user_id": user_id})
+        athlete_id = response["Item"]["athlete_id"]
+        athlete_ids.set(user_id, athlete_id)
+    return athlete_id
+
+
+def forget_athlete_id(user_id):
+    # after the user's strava auth record is rewritten
+    athlete_ids.invalidate(user_id)
@@ -0,0 +1,119 @@
+import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+from datetime import datetime
+from config import Config
+from lib.athlete_stamp import STAMP_KEY
+from lib.metrics import span, count
+
+config = Config.instance()
+dynamodb = boto3.resource("dynamodb", config.aws_region)
+leaderboard_table = dynamodb.Table(config.athlete_leaderboard_table)
+
+# process_peaks only looks at the top 9, keep some headroom for reprocessed
+# activities dropping down the board
+LEADERBOARD_SIZE = 25
+MAX_MERGE_ATTEMPTS = 5
+
+
+class AthleteLeaderboard():
+    # top LEADERBOARD_SIZE peaks per (athlete, peak_type), kept up to date as
+    # peaks are written so reading an athlete's bests never has to scan the
+    # whole peaks partition. each item carries a version for optimistic
+    # locking, concurrent writers retry their merge on a conditional failure
+    @classmethod
+    def merge_peaks(cls, current, new_rows, size=LEADERBOARD_SIZE):
+        new_ids = set(row["peak_id"] for row in new_rows)
+        merged = [p for p in current if p["peak_id"] not in new_ids] + list(new_rows)
+        merged.sort(key=lambda x: x["value"], reverse=True)
+        return merged[0:size]
+
+    @classmethod
+    def merge(cls, athlete_id, peak_type, new_rows, seed=None):
+        # seed() returns the athlete's existing best peaks of the type, a
+        # board that doesn't exist yet starts from those rather than from
+        # only the rows being merged
+        peak_type = peak_type.lower()
+        for _ in range(MAX_MERGE_ATTEMPTS):
+            res = leaderboard_table.get_item(
+                Key={"athlete_id": athlete_id, "peak_type": peak_type},
+                ConsistentRead=True,
+            )
+            item = res.get("Item")
+            if item:
+                current = item["peaks"]
+            else:
+                current = seed() if seed is not None else []
+                count("leaderboard_seeds")
+            merged = cls.merge_peaks(current, new_rows)
+            if item and merged == current:
+                return False
+
+            if item:
+                condition = {
+                    "ConditionExpression": "version = :version",
+                    "ExpressionAttributeValues": {":version": item["version"]},
+                }
+            else:
+                condition = {
+                    "ConditionExpression": "attribute_not_exists(athlete_id)",
+                }
+            try:
+                with span("dynamodb_write"):
+                    leaderboard_table.put_item(
+                        Item={
+                            "athlete_id": athlete_id,
+                            "peak_type": peak_type,
+                            "peaks": merged,
+                            "version": (item["version"] + 1) if item else 1,
+                            "last_updated": int(datetime.now().timestamp()),
+                        },
+                        **condition
+                    )
+                return True
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                count("leaderboard_retries")
+                print('leaderboard {athlete_id}:{peak_type} changed, retrying merge'.format(
+                    athlete_id=athlete_id, peak_type=peak_type))
+        raise RuntimeError("unable to merge leaderboard {athlete_id}:{peak_type}".format(
+            athlete_id=athlete_id, peak_type=peak_type))
+
+    @classmethod
+    def replace_all(cls, athlete_id, peaks_organized):
+        # writes every board of the athlete at once. boards may be in use,
+        # so each one's version is bumped and a merge that read the old one
+        # retries on the new one. boards of peak types the athlete no
+        # longer has are deleted
+        versions = {item["peak_type"]: item["version"] for item in cls.fetch_items(athlete_id)}
+        boards = {peak_type.lower(): peaks for peak_type, peaks in peaks_organized.items()}
+        with leaderboard_table.batch_writer() as batch:
+            for peak_type, peaks in boards.items():
+                batch.put_item(Item={
+                    "athlete_id": athlete_id,
+                    "peak_type": peak_type,
+                    "peaks": peaks[0:LEADERBOARD_SIZE],
+                    "version": versions.get(peak_type, 0) + 1,
+                    "last_updated": int(datetime.now().timestamp()),
+                })
+            for peak_type in versions:
+                if peak_type not in boards:
+                    batch.delete_item(Key={"athlete_id": athlete_id, "peak_type": peak_type})
+
+    @classmethod
+    def fetch_items(cls, athlete_id):
+        # the athlete's leaderboard items, without the stamp item
+        items = []
+        query = {"KeyConditionExpression": Key("athlete_id").eq(athlete_id)}
+        while True:
+            results = leaderboard_table.query(**query)
+            items.extend(results["Items"])
+            if "LastEvaluatedKey" not in results:
+                break
+            query["ExclusiveStartKey"] = results["LastEvaluatedKey"]
+        return [item for item in items if item["peak_type"] != STAMP_KEY]
+
+    @classmethod
+    def fetch(cls, athlete_id):
+        return {item["peak_type"]: item["peaks"] for item in cls.fetch_items(athlete_id)}
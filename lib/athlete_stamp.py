@@ -0,0 +1,82 @@
+import boto3
+from botocore.exceptions import ClientError
+from datetime import datetime
+from config import Config
+
+config = Config.instance()
+dynamodb = boto3.resource("dynamodb", config.aws_region)
+leaderboard_table = dynamodb.Table(config.athlete_leaderboard_table)
+
+# stored alongside the athlete's leaderboards, "#" sorts before any peak type
+STAMP_KEY = "#stamp"
+
+
+class AthleteStamp():
+    # per athlete "last changed" stamps (epoch ms) that readers use to tell
+    # whether a cached response is still current
+    PEAKS = "peaks_updated_at"
+    RECENT_PEAKS = "recent_updated_at"
+    # set while a peaks recompute is queued for the athlete
+    RECOMPUTE_PENDING = "recompute_pending_at"
+    # set once every leaderboard was built from the whole peaks partition
+    LEADERBOARDS_SEEDED = "leaderboards_seeded_at"
+
+    @classmethod
+    def now(cls):
+        return int(datetime.now().timestamp() * 1000)
+
+    @classmethod
+    def touch(cls, athlete_id, attribute, timestamp=None):
+        if timestamp is None:
+            timestamp = cls.now()
+        leaderboard_table.update_item(
+            Key={"athlete_id": str(athlete_id), "peak_type": STAMP_KEY},
+            UpdateExpression="SET #attr = :timestamp",
+            ExpressionAttributeNames={"#attr": attribute},
+            ExpressionAttributeValues={":timestamp": timestamp},
+        )
+
+    @classmethod
+    def fetch(cls, athlete_id, attribute):
+        res = leaderboard_table.get_item(
+            Key={"athlete_id": str(athlete_id), "peak_type": STAMP_KEY},
+            ProjectionExpression="#attr",
+            ExpressionAttributeNames={"#attr": attribute},
+        )
+        return int(res.get("Item", {}).get(attribute, 0))
+
+    @classmethod
+    def fetch_all(cls, athlete_id):
+        res = leaderboard_table.get_item(
+            Key={"athlete_id": str(athlete_id), "peak_type": STAMP_KEY},
+            ConsistentRead=True,
+        )
+        item = res.get("Item", {})
+        return {k: int(v) for k, v in item.items() if k not in ("athlete_id", "peak_type")}
+
+    @classmethod
+    def claim(cls, athlete_id, attribute, stale_before):
+        # sets attribute to now unless it's already set more recently than
+        # stale_before, returns whether this caller set it
+        try:
+            leaderboard_table.update_item(
+                Key={"athlete_id": str(athlete_id), "peak_type": STAMP_KEY},
+                UpdateExpression="SET #attr = :timestamp",
+                ConditionExpression="attribute_not_exists(#attr) OR #attr < :stale_before",
+                ExpressionAttributeNames={"#attr": attribute},
+                ExpressionAttributeValues={
+                    ":timestamp": cls.now(), ":stale_before": stale_before},
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+
+    @classmethod
+    def clear(cls, athlete_id, attribute):
+        leaderboard_table.update_item(
+            Key={"athlete_id": str(athlete_id), "peak_type": STAMP_KEY},
+            UpdateExpression="REMOVE #attr",
+            ExpressionAttributeNames={"#attr": attribute},
+        )
@@ -0,0 +1,114 @@
+from stravalib.client import Client as StravaClient
+from datetime import datetime, timedelta
+from lib.rate_limiter import strava_rate_limiter
+from lib.http_session import strava_session
+from lib.strava_enqueue import EnqStravaApiActivities
+
+# strava's maximum per_page for /athlete/activities
+PAGE_SIZE = 200
+INITIAL_WINDOW_DAYS = 30
+MIN_WINDOW_DAYS = 1
+MAX_WINDOW_DAYS = 365
+# strava didn't exist before this, anything earlier is a bad start date
+EARLIEST = datetime(2008, 1, 1)
+
+
+class BackfillPlanner():
+    # walks an athlete's history from their first activity in windows that
+    # adapt to how busy they were: a window that filled a page or more is
+    # halved for the next one, a sparse window doubles, so each
+    # FETCH_STRAVA_ACTIVITY message costs about one full page request.
+    # windows are chained, each one enqueuing the next when it's done, and
+    # progress is checkpointed on the athlete record as
+    #
+    #   backfill = {after, window_days, activities, requests, started_at, completed_at}
+    #
+    # so a repeated BACKFILL_ATHLETE resumes rather than starting over
+    def __init__(self, athlete):
+        self.athlete = athlete
+        self.enqueue = EnqStravaApiActivities(str(athlete.user_id), str(athlete.athlete_id))
+
+    @classmethod
+    def day(cls, value):
+        return datetime(value.year, value.month, value.day)
+
+    @classmethod
+    def next_window_days(cls, window_days, count):
+        if count >= PAGE_SIZE:
+            window_days = window_days // 2
+        elif count < PAGE_SIZE // 4:
+            window_days = window_days * 2
+        return max(MIN_WINDOW_DAYS, min(MAX_WINDOW_DAYS, window_days))
+
+    @classmethod
+    def page_requests(cls, count):
+        # stravalib stops at the first short page
+        return count // PAGE_SIZE + 1
+
+    def first_activity_date(self):
+        # with only `after` set strava lists oldest first
+        strava_rate_limiter.acquire()
+        client = StravaClient(access_token=self.athlete.access_token,
+                              rate_limiter=strava_rate_limiter,
+                              requests_session=strava_session)
+        for activity in client.get_activities(after=EARLIEST, limit=1):
+            return activity.start_date_local.replace(tzinfo=None)
+        return None
+
+    def start(self):
+        backfill = self.athlete.backfill
+        if backfill and "completed_at" not in backfill:
+            print('resuming backfill for {athlete_id}'.format(
+                athlete_id=self.athlete.athlete_id), backfill)
+            after = datetime.fromtimestamp(int(backfill["after"]))
+            return self.queue_window(after, int(backfill["window_days"]))
+
+        first = self.first_activity_date()
+        if first is None:
+            print('no activities to backfill for {athlete_id}'.format(
+                athlete_id=self.athlete.athlete_id))
+            return None
+        after = self.day(first) - timedelta(days=1)
+        self.athlete.save_backfill({
+            "after": int(after.timestamp()),
+            "window_days": INITIAL_WINDOW_DAYS,
+            "activities": 0,
+            "requests": 1,
+            "started_at": int(datetime.now().timestamp()),
+        })
+        return self.queue_window(after, INITIAL_WINDOW_DAYS)
+
+    def queue_window(self, after, window_days):
+        before = after + timedelta(days=window_days)
+        self.enqueue.queue(before, after, backfill=True)
+        return before, after
+
+    def advance(self, before, after, count):
+        # called once a backfill window has been fetched. a redelivered
+        # window no longer matches the checkpoint and is left alone
+        backfill = self.athlete.load_backfill()
+        if not backfill or int(backfill["after"]) != int(after.timestamp()):
+            print('stale backfill window {after} for {athlete_id}'.format(
+                after=after, athlete_id=self.athlete.athlete_id))
+            return None
+
+        window_days = self.next_window_days((before - after).days, count)
+        backfill = dict(
+            backfill,
+            after=int(before.timestamp()),
+            window_days=window_days,
+            activities=int(backfill["activities"]) + count,
+            requests=int(backfill["requests"]) + self.page_requests(count),
+        )
+        if before > datetime.now():
+            backfill["completed_at"] = int(datetime.now().timestamp())
+            print('backfill complete for {athlete_id}: {activities} activities in {requests} requests'.format(
+                athlete_id=self.athlete.athlete_id, **backfill))
+            self.athlete.save_backfill(backfill)
+            return None
+
+        # queue before checkpointing, a failure in between redelivers this
+        # window and the duplicate next window is dropped by FIFO dedup
+        window = self.queue_window(before, window_days)
+        self.athlete.save_backfill(backfill)
+        return window
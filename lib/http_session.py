@@ -0,0 +1,41 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import Config
+from lib.metrics import span, count
+
+config = Config.instance()
+
+
+class InstrumentedSession(requests.Session):
+    # times every request as strava_http and counts urllib3's retries
+    def request(self, *args, **kwargs):
+        with span("strava_http"):
+            response = super(InstrumentedSession, self).request(*args, **kwargs)
+        count("strava_requests")
+        retries = getattr(response.raw, "retries", None)
+        if retries is not None and retries.history:
+            count("strava_http_retries", len(retries.history))
+        return response
+
+
+def build_session(pool_size, retries=3, backoff_factor=0.5):
+    # keep-alive pool shared by every thread of the container. failed
+    # connects are retried with backoff for any method, read errors and 5xx
+    # responses only for idempotent ones so a token refresh POST is never
+    # sent twice. 429s are left to the rate limiter
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = InstrumentedSession()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+strava_session = build_session(
+    pool_size=max(config.strava_fetch_workers, config.strava_sync_workers) * 2)
@@ -0,0 +1,50 @@
+import json
+import time
+import urllib.request
+from threading import Lock
+from jose import jwk
+
+
+class JwksCache():
+    # public keys from a JWKS endpoint, constructed once and indexed by kid.
+    # keys are fetched on first use and refetched when a token names a kid
+    # we haven't seen (key rotation), at most once per min_refresh_interval
+    def __init__(self, url, min_refresh_interval=60, timeout=5):
+        self.url = url
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.fetched_at = None
+        self.lock = Lock()
+
+    def refresh(self):
+        # a failed fetch keeps the last good keys, so a token whose kid is
+        # unknown is denied rather than failing the authorizer, and the
+        # next attempt waits out min_refresh_interval like any other
+        self.fetched_at = time.time()
+        try:
+            with urllib.request.urlopen(self.url, timeout=self.timeout) as f:
+                response = f.read()
+            keys = json.loads(response.decode("utf-8"))["keys"]
+            keys = {key["kid"]: jwk.construct(key) for key in keys}
+        except Exception as e:
+            print('failed to fetch public keys from {url}: {error}'.format(
+                url=self.url, error=repr(e)))
+            return False
+        self.keys = keys
+        print('fetched {num} public keys from {url}'.format(
+            num=len(self.keys), url=self.url))
+        return True
+
+    def can_refresh(self):
+        return self.fetched_at is None or \
+            time.time() - self.fetched_at >= self.min_refresh_interval
+
+    def get(self, kid):
+        key = self.keys.get(kid)
+        if key is not None or not self.can_refresh():
+            return key
+        with self.lock:
+            if kid not in self.keys and self.can_refresh():
+                self.refresh()
+        return self.keys.get(kid)
@@ -0,0 +1,100 @@
+import struct
+import boto3
+import numpy as np
+from config import Config
+from lib.peak_engine import mean_max_curve
+
+config = Config.instance()
+s3_client = boto3.client("s3")
+
+# file layout (little endian):
+#   header:    magic "MMC1", version u8, number of statistics u8
+#   per stat:  name length u8, name utf8, point count u32,
+#              durations u32[count], values f32[count]
+MAGIC = b"MMC1"
+VERSION = 1
+HEADER = struct.Struct("<4sBB")
+STAT_HEADER = struct.Struct("<B")
+COUNT = struct.Struct("<I")
+
+
+class MeanMaxCurve():
+    def __init__(self, curves=None):
+        # {statistic: (durations, values)}
+        self.curves = curves if curves is not None else {}
+
+    @classmethod
+    def from_streams(cls, streams, extra=()):
+        curves = {}
+        for statistic, data_stream in streams.items():
+            curve = mean_max_curve(data_stream, extra=extra)
+            if curve is not None:
+                curves[statistic] = curve
+        return cls(curves)
+
+    def value_at(self, statistic, duration):
+        # exact at the stored points, log-linear interpolation in between.
+        # the curve never increases with duration, so neither does this
+        if statistic not in self.curves:
+            return None
+        durations, values = self.curves[statistic]
+        if duration < 1 or duration > durations[-1]:
+            return None
+        return float(np.interp(
+            np.log(duration), np.log(durations), values))
+
+    def to_bytes(self):
+        parts = [HEADER.pack(MAGIC, VERSION, len(self.curves))]
+        for statistic, (durations, values) in self.curves.items():
+            name = statistic.encode("utf8")
+            parts.append(STAT_HEADER.pack(len(name)))
+            parts.append(name)
+            parts.append(COUNT.pack(len(durations)))
+            parts.append(np.asarray(durations, dtype="<u4").tobytes())
+            parts.append(np.asarray(values, dtype="<f4").tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        buf = memoryview(data)
+        magic, version, num_stats = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a mean max curve file")
+        offset = HEADER.size
+        curves = {}
+        for _ in range(num_stats):
+            (name_len,) = STAT_HEADER.unpack_from(buf, offset)
+            offset += STAT_HEADER.size
+            statistic = bytes(buf[offset:offset + name_len]).decode("utf8")
+            offset += name_len
+            (count,) = COUNT.unpack_from(buf, offset)
+            offset += COUNT.size
+            durations = np.frombuffer(buf, dtype="<u4", count=count, offset=offset)
+            offset += 4 * count
+            values = np.frombuffer(buf, dtype="<f4", count=count, offset=offset)
+            offset += 4 * count
+            curves[statistic] = (durations, values)
+        return cls(curves)
+
+    @classmethod
+    def filename(cls, athlete_id, activity_id):
+        return "curves_{athlete_id}_{activity_id}.bin".format(
+            athlete_id=athlete_id, activity_id=activity_id)
+
+    def save(self, athlete_id, activity_id):
+        curves_filename = self.filename(athlete_id, activity_id)
+        s3_client.put_object(
+            Body=self.to_bytes(),
+            Bucket=config.strava_api_s3_bucket,
+            Key=curves_filename,
+        )
+        print('saving mean max curves to {bucket}:{key}'.format(
+            bucket=config.strava_api_s3_bucket, key=curves_filename))
+
+    @classmethod
+    def fetch(cls, athlete_id, activity_id):
+        response = s3_client.get_object(
+            Bucket=config.strava_api_s3_bucket,
+            Key=cls.filename(athlete_id, activity_id),
+        )
+        return cls.from_bytes(response["Body"].read())
@@ -0,0 +1,146 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+try:
+    from aws_xray_sdk.core import xray_recorder
+except ImportError:
+    xray_recorder = None
+
+NAMESPACE = os.getenv("METRICS_NAMESPACE", "sts1")
+# subsegments need an active trace, so x-ray is opt in on top of the sdk
+XRAY_ENABLED = xray_recorder is not None and os.getenv("XRAY_ENABLED") == "true"
+# cloudwatch takes at most 100 values per metric in one EMF record
+MAX_VALUES = 100
+
+
+class EmfSink():
+    # one CloudWatch embedded metric format line per invocation on stdout,
+    # which lambda ships to logs and cloudwatch turns into metrics
+    def emit(self, record):
+        print(json.dumps(record, default=str))
+
+
+class MemorySink():
+    # keeps emitted records for tests and benchmarks
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records = []
+
+
+class Metrics():
+    # collects timing spans (ms) and counters for the current invocation
+    # from any thread, flushed as one record when the handler returns
+    def __init__(self, sink=None, namespace=NAMESPACE):
+        self.sink = sink or EmfSink()
+        self.namespace = namespace
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+            self.properties = {}
+
+    def record(self, name, ms):
+        with self.lock:
+            self.spans.setdefault(name, []).append(ms)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_property(self, name, value):
+        with self.lock:
+            self.properties[name] = value
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        if XRAY_ENABLED:
+            with xray_recorder.in_subsegment(name):
+                try:
+                    yield
+                finally:
+                    self.record(name, (time.perf_counter() - start) * 1000)
+        else:
+            try:
+                yield
+            finally:
+                self.record(name, (time.perf_counter() - start) * 1000)
+
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        with self.lock:
+            return {
+                "spans": {name: {"count": len(values), "total_ms": sum(values),
+                                 "max_ms": max(values)}
+                          for name, values in self.spans.items()},
+                "counters": dict(self.counters),
+            }
+
+    def flush(self, handler):
+        with self.lock:
+            spans, counters, properties = self.spans, self.counters, self.properties
+            self.spans, self.counters, self.properties = {}, {}, {}
+        definitions = [{"Name": name, "Unit": "Milliseconds"} for name in spans]
+        definitions += [{"Name": name, "Unit": "Count"} for name in counters]
+        record = dict(properties)
+        record.update({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["handler"]],
+                    "Metrics": definitions,
+                }],
+            },
+            "handler": handler,
+        })
+        for name, values in spans.items():
+            record[name] = [round(v, 3) for v in values[0:MAX_VALUES]]
+        record.update(counters)
+        self.sink.emit(record)
+        return record
+
+    def instrument(self, func):
+        # handler wrapper, times the whole invocation as "invocation" and
+        # emits everything collected even when the handler raises
+        handler = "{module}.{name}".format(module=func.__module__, name=func.__name__)
+
+        @wraps(func)
+        def wrapper(event, context):
+            self.reset()
+            try:
+                with self.span("invocation"):
+                    return func(event, context)
+            except Exception:
+                self.count("errors")
+                raise
+            finally:
+                self.flush(handler)
+        return wrapper
+
+
+metrics = Metrics()
+span = metrics.span
+count = metrics.count
+timed = metrics.timed
+instrument = metrics.instrument
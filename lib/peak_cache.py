@@ -0,0 +1,89 @@
+import hashlib
+import time
+from config import Config
+from lib.athlete_stamp import AthleteStamp
+from lib.cache import LRUCache
+
+config = Config.instance()
+
+
+class PeakCache():
+    # read-through cache for the peaks read APIs. a cached response is
+    # served as is for ttl seconds, after that it is revalidated against the
+    # athlete's stamp (a single GetItem) and only reloaded if the stamp moved.
+    # the loaders read eventually consistent indexes, so a response loaded
+    # within settle seconds of the stamp is returned but not cached, and
+    # its etag is one no later request will match
+    def __init__(self, stamp_attribute, maxsize=256, ttl=None, settle=None):
+        self.stamp_attribute = stamp_attribute
+        self.ttl = config.peak_cache_ttl if ttl is None else ttl
+        self.settle = config.peak_cache_settle_seconds if settle is None else settle
+        self.responses = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.bypassed = 0
+
+    def get(self, athlete_id, key, loader, client_etag=None):
+        # returns (value, etag, cache status). value is None when nothing is
+        # cached but the client's etag is still current, i.e. a 304
+        cache_key = (str(athlete_id),) + tuple(key)
+        entry = self.responses.get(cache_key)
+        now = time.time()
+        if entry is not None and entry["checked_at"] + self.ttl > now:
+            self.hits += 1
+            return entry["value"], entry["etag"], "HIT"
+
+        stamp = AthleteStamp.fetch(athlete_id, self.stamp_attribute)
+        if entry is not None and entry["stamp"] == stamp:
+            entry["checked_at"] = now
+            self.revalidated += 1
+            return entry["value"], entry["etag"], "REVALIDATED"
+
+        etag = self.etag(cache_key, stamp)
+        if entry is None and client_etag == etag:
+            self.revalidated += 1
+            return None, etag, "REVALIDATED"
+
+        if stamp > (now - self.settle) * 1000:
+            self.bypassed += 1
+            return loader(), self.etag(cache_key, "{stamp}-{now}".format(
+                stamp=stamp, now=now)), "BYPASS"
+
+        self.misses += 1
+        value = loader()
+        self.responses.set(cache_key, {
+            "value": value, "stamp": stamp, "etag": etag, "checked_at": now})
+        return value, etag, "MISS"
+
+    @classmethod
+    def etag(cls, cache_key, stamp):
+        digest = hashlib.sha1(
+            "{key}:{stamp}".format(key=cache_key, stamp=stamp).encode("utf8"))
+        return '"{}"'.format(digest.hexdigest())
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "bypassed": self.bypassed,
+            "size": len(self.responses.entries),
+        }
+
+
+def if_none_match(event):
+    headers = event.get("headers") or {}
+    for name, value in headers.items():
+        if name.lower() == "if-none-match":
+            return value
+    return None
+
+
+def cached_response(event, body, etag, status, extra_headers=None):
+    headers = dict(extra_headers or {})
+    headers["ETag"] = etag
+    headers["X-Cache"] = status
+    if if_none_match(event) == etag:
+        return {"statusCode": 304, "headers": headers, "body": ""}
+    return {"statusCode": 200, "headers": headers, "body": body}
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def to_array(data_stream):
+    # integer streams (watts, heartrate) keep an integer dtype so the prefix
+    # sums are exact; anything else is summed as float64
+    arr = np.asarray(data_stream)
+    if arr.dtype.kind in ("i", "u", "b"):
+        return arr.astype(np.int64, copy=False)
+    return arr.astype(np.float64, copy=False)
+
+
+def prefix_sums(arr):
+    sums = np.empty(len(arr) + 1, dtype=arr.dtype)
+    sums[0] = 0
+    np.cumsum(arr, out=sums[1:])
+    return sums
+
+
+def window_max(sums, num_seconds):
+    return (sums[num_seconds:] - sums[:-num_seconds]).max()
+
+
+def calc_peaks(durations, data_stream, activity_id):
+    # returns {duration: peak average} for every duration using one prefix
+    # sum over the stream, matching the old calc_peak edge cases: an empty
+    # stream peaks at 0, a duration longer than the stream is None and a
+    # stream that cannot be summed is 0
+    if data_stream is None:
+        return {duration: None for duration in durations}
+    if len(data_stream) == 0:
+        return {duration: 0 for duration in durations}
+
+    sums = None
+    try:
+        arr = to_array(data_stream)
+        if arr.ndim == 1 and (arr.dtype.kind != "f" or np.isfinite(arr).all()):
+            sums = prefix_sums(arr)
+    except (TypeError, ValueError):
+        pass
+    if sums is None:
+        print("unable to sum datastream for {}".format(activity_id))
+
+    peaks = {}
+    for duration in durations:
+        if duration > len(data_stream):
+            peaks[duration] = None
+        elif sums is None:
+            peaks[duration] = 0
+        else:
+            peaks[duration] = float(window_max(sums, duration)) / duration
+    return peaks
+
+
+def curve_durations(length, points_per_decade=32, dense_until=60, extra=()):
+    # every second up to dense_until, then log spaced out to the full length
+    if length < 1:
+        return np.empty(0, dtype=np.int64)
+    dense = np.arange(1, min(dense_until, length) + 1)
+    sparse = np.empty(0)
+    if length > dense_until:
+        decades = np.log10(length / dense_until)
+        sparse = np.geomspace(
+            dense_until, length, max(2, int(np.ceil(decades * points_per_decade)) + 1))
+    durations = np.concatenate([
+        dense, np.rint(sparse), [d for d in extra if d <= length], [length]])
+    return np.unique(durations.astype(np.int64))
+
+
+def mean_max_curve(data_stream, extra=()):
+    # exact mean maximal values at log spaced durations from 1s to the
+    # length of the stream, all read off a single prefix sum
+    if data_stream is None:
+        return None
+    try:
+        arr = to_array(data_stream)
+    except (TypeError, ValueError):
+        return None
+    if arr.ndim != 1 or len(arr) == 0:
+        return None
+    if arr.dtype.kind == "f" and not np.isfinite(arr).all():
+        return None
+    sums = prefix_sums(arr)
+    durations = curve_durations(len(arr), extra=extra)
+    values = np.array(
+        [window_max(sums, d) / d for d in durations], dtype=np.float64)
+    return durations, values
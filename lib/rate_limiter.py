@@ -0,0 +1,195 @@
+import time
+from functools import wraps
+from threading import Lock
+import boto3
+from botocore.exceptions import ClientError
+from config import Config
+
+config = Config.instance()
+
+SHORT_WINDOW = 15 * 60
+LONG_WINDOW = 24 * 60 * 60
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def window_starts(now):
+    # strava's windows are fixed, resetting on the quarter hour and at
+    # midnight UTC, so the counters here are kept the same way
+    return int(now // SHORT_WINDOW * SHORT_WINDOW), int(now // LONG_WINDOW * LONG_WINDOW)
+
+
+class LocalRateLimitStore():
+    # in process stand-in for DynamoRateLimitStore, for tests and local runs
+    def __init__(self):
+        self.items = {}
+        self.lock = Lock()
+
+    def try_acquire(self, limiter_id, short_window, short_limit, long_window, long_limit):
+        with self.lock:
+            item = self.items.setdefault(limiter_id, {
+                "short_window": 0, "short_count": 0, "long_window": 0, "long_count": 0})
+            if item["long_window"] < long_window:
+                item.update(long_window=long_window, long_count=0)
+            if item["short_window"] < short_window:
+                item.update(short_window=short_window, short_count=0)
+            if item["short_count"] >= short_limit or item["long_count"] >= long_limit:
+                return False
+            item["short_count"] += 1
+            item["long_count"] += 1
+            return True
+
+    def observe(self, limiter_id, short_window, short_usage, long_window, long_usage):
+        with self.lock:
+            item = self.items.get(limiter_id)
+            if item is None:
+                return
+            if item["short_window"] == short_window:
+                item["short_count"] = max(item["short_count"], short_usage)
+            if item["long_window"] == long_window:
+                item["long_count"] = max(item["long_count"], long_usage)
+
+    def usage(self, limiter_id):
+        return dict(self.items.get(limiter_id, {}))
+
+
+class DynamoRateLimitStore():
+    # one item per limiter holding the current window starts and counts,
+    # every change is a conditional update so any number of workers can
+    # share the same budget
+    def __init__(self, table_name):
+        self.table = boto3.resource("dynamodb", config.aws_region).Table(table_name)
+
+    def conditional_update(self, **kwargs):
+        try:
+            self.table.update_item(**kwargs)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+
+    def try_acquire(self, limiter_id, short_window, short_limit, long_window, long_limit):
+        key = {"limiter_id": limiter_id}
+        values = {
+            ":sw": short_window, ":sl": short_limit,
+            ":lw": long_window, ":ll": long_limit, ":one": 1,
+        }
+        # both windows current and under their limits
+        if self.conditional_update(
+                Key=key,
+                UpdateExpression="ADD short_count :one, long_count :one",
+                ConditionExpression="short_window = :sw AND short_count < :sl "
+                                    "AND long_window = :lw AND long_count < :ll",
+                ExpressionAttributeValues=values):
+            return True
+        # a new 15 minute window within the same day
+        if self.conditional_update(
+                Key=key,
+                UpdateExpression="SET short_window = :sw, short_count = :one "
+                                 "ADD long_count :one",
+                ConditionExpression="short_window < :sw "
+                                    "AND long_window = :lw AND long_count < :ll",
+                ExpressionAttributeValues={
+                    k: v for k, v in values.items() if k != ":sl"}):
+            return True
+        # a new day, or the first request ever
+        return self.conditional_update(
+            Key=key,
+            UpdateExpression="SET short_window = :sw, short_count = :one, "
+                             "long_window = :lw, long_count = :one",
+            ConditionExpression="attribute_not_exists(long_window) OR long_window < :lw",
+            ExpressionAttributeValues={
+                ":sw": short_window, ":lw": long_window, ":one": 1})
+
+    def observe(self, limiter_id, short_window, short_usage, long_window, long_usage):
+        key = {"limiter_id": limiter_id}
+        self.conditional_update(
+            Key=key,
+            UpdateExpression="SET short_count = :usage",
+            ConditionExpression="short_window = :window AND short_count < :usage",
+            ExpressionAttributeValues={":window": short_window, ":usage": short_usage})
+        self.conditional_update(
+            Key=key,
+            UpdateExpression="SET long_count = :usage",
+            ConditionExpression="long_window = :window AND long_count < :usage",
+            ExpressionAttributeValues={":window": long_window, ":usage": long_usage})
+
+    def usage(self, limiter_id):
+        res = self.table.get_item(Key={"limiter_id": limiter_id}, ConsistentRead=True)
+        return res.get("Item", {})
+
+
+class StravaRateLimiter():
+    # shared budget for strava's 15 minute and daily limits. acquire() takes
+    # one request from both windows (waiting for the next window if either
+    # is spent), and the instance is also passed to stravalib as its
+    # rate_limiter, which hands it the headers of every response so the
+    # counts follow X-RateLimit-Usage / X-RateLimit-Limit
+    def __init__(self, store, limiter_id="strava", short_limit=600, long_limit=30000,
+                 max_wait=None, clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.limiter_id = limiter_id
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        # the configured limits stay a ceiling on what the headers report
+        self.configured_limits = (short_limit, long_limit)
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+
+    def acquire(self):
+        waited = 0
+        while True:
+            now = self.clock()
+            short_window, long_window = window_starts(now)
+            if self.store.try_acquire(self.limiter_id, short_window, self.short_limit,
+                                      long_window, self.long_limit):
+                return waited
+            usage = self.store.usage(self.limiter_id)
+            if int(usage.get("long_count", 0)) >= self.long_limit:
+                wait = long_window + LONG_WINDOW - now
+            else:
+                wait = short_window + SHORT_WINDOW - now
+            if self.max_wait is not None and waited + wait > self.max_wait:
+                raise RateLimitExceeded(
+                    "strava rate limit spent, next window in {wait:.0f}s".format(wait=wait))
+            print('strava rate limit reached, waiting {wait:.0f}s'.format(wait=wait))
+            self.sleep(wait)
+            waited += wait
+
+    def limit(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self.acquire()
+            return func(*args, **kwargs)
+        return wrapper
+
+    def __call__(self, headers, *args):
+        limit = headers.get("X-RateLimit-Limit")
+        if limit:
+            short_limit, long_limit = [int(v) for v in limit.split(",")[:2]]
+            self.short_limit = min(short_limit, self.configured_limits[0])
+            self.long_limit = min(long_limit, self.configured_limits[1])
+        usage = headers.get("X-RateLimit-Usage")
+        if usage:
+            short_usage, long_usage = [int(v) for v in usage.split(",")[:2]]
+            short_window, long_window = window_starts(self.clock())
+            self.store.observe(self.limiter_id, short_window, short_usage,
+                               long_window, long_usage)
+
+
+def rate_limit_store():
+    if config.rate_limit_table:
+        return DynamoRateLimitStore(config.rate_limit_table)
+    return LocalRateLimitStore()
+
+
+strava_rate_limiter = StravaRateLimiter(
+    rate_limit_store(),
+    short_limit=config.strava_rate_limit_short,
+    long_limit=config.strava_rate_limit_long,
+    max_wait=config.strava_rate_limit_max_wait,
+)
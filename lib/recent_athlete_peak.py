@@ -1,31 +1,67 @@
 from pprint import pprint
 import boto3
+import json
 from config import Config
 from boto3.dynamodb.conditions import Key
-from pprint import pprint
-from config import Config
+from lib.athlete_stamp import AthleteStamp
 
-config = Config()
+config = Config.instance()
 dynamodb = boto3.resource("dynamodb", config.aws_region)
 recent_peaks_table = dynamodb.Table(config.recent_athlete_peaks_table)
 sqs = boto3.client("sqs")
-config = Config()
 
 
 class RecentAthletePeak():
     @classmethod
-    def enqueue(cls, athlete_id):
-        sqs.send_message(
-            QueueUrl=config.recent_athlete_peaks_to_s3,
+    def enqueue(cls, athlete_id, producer=None, force=False):
+        # at most one recompute is pending per athlete, the pending flag on
+        # the athlete's stamp item is claimed here and cleared when the
+        # recompute starts, or released when the message can't be sent. a
+        # flag older than any message could be is treated as lost and
+        # claimed again. force re-queues a pending one. a producer should
+        # be built with on_undelivered=RecentAthletePeak.release
+        quiet_ms = config.peaks_recompute_quiet_seconds * 1000
+        now = AthleteStamp.now()
+        stale_before = now - (config.peaks_recompute_max_wait_seconds * 1000 + 2 * quiet_ms + 600000)
+        claimed = not force and AthleteStamp.claim(
+            athlete_id, AthleteStamp.RECOMPUTE_PENDING, stale_before)
+        if not force and not claimed:
+            print('recent peaks already pending for {athlete_id}'.format(
+                athlete_id=athlete_id))
+            return False
+
+        message = dict(
             MessageAttributes={
                 "AthleteId": {"DataType": "String", "StringValue": str(athlete_id)}
             },
             MessageBody=(
                 "recent-athlete-peak-{athlete_id}".format(athlete_id=athlete_id)),
-            MessageGroupId="RECENT-ATHLETE-PEAKS"
+            MessageGroupId="RECENT-ATHLETE-PEAKS-{athlete_id}".format(athlete_id=athlete_id),
+            # one per quiet window, so a re-queue isn't taken for a duplicate
+            MessageDeduplicationId="{athlete_id}-{bucket}".format(
+                athlete_id=athlete_id, bucket=now // max(quiet_ms, 1))
         )
+        if producer is not None:
+            producer.send(**message)
+        else:
+            try:
+                sqs.send_message(QueueUrl=config.recent_athlete_peaks_to_s3, **message)
+            except Exception:
+                if claimed:
+                    AthleteStamp.clear(athlete_id, AthleteStamp.RECOMPUTE_PENDING)
+                raise
         print('queuing recent peaks for {athlete_id}'.format(
             athlete_id=athlete_id))
+        return True
+
+    @classmethod
+    def release(cls, messages):
+        # clears the pending flag of athletes whose recompute message was
+        # never sent, so the next change queues it again
+        for message in messages:
+            athlete_id = message["MessageAttributes"]["AthleteId"]["StringValue"]
+            print('releasing recent peaks for {athlete_id}'.format(athlete_id=athlete_id))
+            AthleteStamp.clear(athlete_id, AthleteStamp.RECOMPUTE_PENDING)
 
     @classmethod
     def divide_chunks(cls, l, n):
@@ -33,24 +69,45 @@ class RecentAthletePeak():
             yield l[i:i + n]
 
     @classmethod
-    def bulk_save(cls, data):
-
-        peak_chunks = list(cls.divide_chunks(list(data.keys()), 20))
-        for chunk in peak_chunks:
-            print('chunk:', chunk)
-            with recent_peaks_table.batch_writer() as batch:
-                for key in chunk:
-                    batch.put_item(Item={
-                        'athlete_id': data[key][0]['athlete_id'],
-                        'peak_type': key,
-                        'data': data[key]
-                    })
-                    print('put', key)
+    def same_peaks(cls, a, b):
+        # stored rows come back with Decimals where new ones may have strings
+        return json.dumps(a, sort_keys=True, default=str) == json.dumps(b, sort_keys=True, default=str)
+
+    @classmethod
+    def save_changed(cls, athlete_id, data):
+        # writes only the peak types whose recent peaks changed and deletes
+        # the ones that no longer have any, returns the number of changes
+        current = {item['peak_type']: item['data']
+                   for item in cls.fetch(athlete_id)['Items']}
+        changes = 0
+        with recent_peaks_table.batch_writer() as batch:
+            for key, peaks in data.items():
+                if key in current and cls.same_peaks(current[key], peaks):
+                    continue
+                batch.put_item(Item={
+                    'athlete_id': athlete_id,
+                    'peak_type': key,
+                    'data': peaks
+                })
+                print('put', key)
+                changes += 1
+            for key in current:
+                if key not in data:
+                    batch.delete_item(Key={'athlete_id': athlete_id, 'peak_type': key})
+                    print('delete', key)
+                    changes += 1
+        if changes:
+            AthleteStamp.touch(athlete_id, AthleteStamp.RECENT_PEAKS)
+        return changes
 
     @classmethod
     def fetch(cls, athlete_id):
-        peaks_response = recent_peaks_table.query(
-            KeyConditionExpression=Key('athlete_id').eq(
-                athlete_id)
-        )
-        return peaks_response
+        items = []
+        query = {"KeyConditionExpression": Key('athlete_id').eq(athlete_id)}
+        while True:
+            peaks_response = recent_peaks_table.query(**query)
+            items.extend(peaks_response['Items'])
+            if "LastEvaluatedKey" not in peaks_response:
+                break
+            query["ExclusiveStartKey"] = peaks_response["LastEvaluatedKey"]
+        return {"Items": items}
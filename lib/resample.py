@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class TimeBase():
+    # maps streams recorded against strava's "time" stream onto a 1 Hz grid.
+    # gaps up to pause_gap seconds are linearly interpolated, longer gaps are
+    # treated as auto-pause and zero filled (pause_gap=None interpolates all)
+    def __init__(self, time_stream, pause_gap=None):
+        times = np.asarray(time_stream, dtype=np.float64)
+        # drop repeated / out of order timestamps so interp sees increasing x
+        keep = np.ones(len(times), dtype=bool)
+        if len(times) > 1:
+            keep[1:] = np.diff(times) > 0
+        self.length = len(times)
+        self.keep = None if keep.all() else keep
+        self.times = times[keep]
+        self.pause_gap = pause_gap
+
+        self.grid = self.times
+        self.paused = None
+        if len(self.times) > 0:
+            self.grid = np.arange(
+                self.times[0], self.times[-1] + 1, dtype=np.float64)
+        if pause_gap is not None and len(self.times) > 1:
+            gaps = np.diff(self.times)
+            if (gaps > pause_gap).any():
+                segment = np.searchsorted(self.times, self.grid, side="right") - 1
+                segment = np.minimum(segment, len(gaps) - 1)
+                self.paused = (gaps[segment] > pause_gap) & (
+                    self.grid > self.times[segment]) & (
+                    self.grid < self.times[segment + 1])
+
+        self.regular = self.keep is None and len(self.grid) == len(self.times)
+
+    def resample(self, data_stream):
+        if data_stream is None or len(data_stream) != self.length:
+            return None
+        if self.regular:
+            # already one sample per second, hand the stream back untouched
+            values = np.asarray(data_stream)
+            if values.dtype.kind in ("i", "u", "f"):
+                return values
+        try:
+            values = np.asarray(data_stream, dtype=np.float64)
+        except (TypeError, ValueError):
+            # missing samples come through as null, keep them as nan so the
+            # peak engine reports the stream as unsummable
+            values = np.array(
+                [np.nan if v is None else v for v in data_stream], dtype=np.float64)
+        if values.ndim != 1:
+            return None
+        if self.keep is not None:
+            values = values[self.keep]
+        if len(values) == 0:
+            return values
+
+        resampled = np.interp(self.grid, self.times, values)
+        if self.paused is not None:
+            resampled[self.paused] = 0
+        return resampled
@@ -0,0 +1,65 @@
+import boto3
+
+sqs = boto3.client("sqs")
+
+
+class SqsBatchFailure(Exception):
+    pass
+
+
+class SqsBatch():
+    # lets the records of one SQS triggered invocation succeed or fail on
+    # their own. lambda only deletes a batch when the handler returns, so on
+    # partial failure the successful messages are deleted here and the
+    # handler raises, leaving just the failed ones to be redelivered
+    def __init__(self, records):
+        self.records = records
+        self.failed = set()
+
+    def fail(self, message_id):
+        self.failed.add(message_id)
+
+    @classmethod
+    def queue_url(cls, arn):
+        # arn:aws:sqs:{region}:{account}:{name}
+        _, _, _, region, account, name = arn.split(":")
+        return "https://sqs.{region}.amazonaws.com/{account}/{name}".format(
+            region=region, account=account, name=name)
+
+    @classmethod
+    def divide_chunks(cls, l, n):
+        for i in range(0, len(l), n):
+            yield l[i:i + n]
+
+    @classmethod
+    def group_id(cls, record):
+        # MessageGroupId of a FIFO record, None on a standard queue
+        return record.get("attributes", {}).get("MessageGroupId")
+
+    def complete(self):
+        if not self.failed:
+            return
+        # on a FIFO queue the messages behind a failed one in its group are
+        # kept too, deleting them would let them overtake the redelivery
+        failed_groups = set()
+        for r in self.records:
+            group_id = self.group_id(r)
+            if group_id is None:
+                continue
+            if group_id in failed_groups:
+                self.failed.add(r["messageId"])
+            elif r["messageId"] in self.failed:
+                failed_groups.add(group_id)
+        succeeded = [r for r in self.records if r["messageId"] not in self.failed]
+        for chunk in self.divide_chunks(succeeded, 10):
+            sqs.delete_message_batch(
+                QueueUrl=self.queue_url(chunk[0]["eventSourceARN"]),
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": r["receiptHandle"]}
+                    for i, r in enumerate(chunk)
+                ],
+            )
+        print('{failed} of {total} records failed'.format(
+            failed=len(self.failed), total=len(self.records)))
+        raise SqsBatchFailure(
+            "failed messages: {ids}".format(ids=", ".join(sorted(self.failed))))
@@ -0,0 +1,125 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import boto3
+from lib.metrics import span, count
+
+sqs = boto3.client("sqs")
+
+MAX_BATCH_SIZE = 10
+
+
+class SqsProducerError(Exception):
+    pass
+
+
+class SqsBatchProducer():
+    # buffers send_message calls and sends them as send_message_batch calls
+    # of 10, each full batch going out on a small thread pool while the
+    # caller keeps producing. entries that fail are retried with backoff,
+    # the ones never delivered are handed to on_undelivered when flushed.
+    # use as a context manager so whatever is left is flushed on exit:
+    #
+    #   with SqsBatchProducer(queue_url) as producer:
+    #       producer.send(MessageBody=..., MessageAttributes=...)
+    def __init__(self, queue_url, max_workers=4, max_attempts=4, backoff=0.2,
+                 on_undelivered=None):
+        self.queue_url = queue_url
+        self.on_undelivered = on_undelivered
+        self.undelivered = []
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.buffer = []
+        self.futures = []
+        self.lock = Lock()
+        self.sent = 0
+        self.requests = 0
+        self.retries = 0
+
+    def send(self, **message):
+        with self.lock:
+            self.buffer.append(message)
+            if len(self.buffer) < MAX_BATCH_SIZE:
+                return
+            batch, self.buffer = self.buffer, []
+        self.futures.append(self.pool.submit(self.send_batch, batch))
+
+    def send_batch(self, messages):
+        pending = {str(i): m for i, m in enumerate(messages)}
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                with self.lock:
+                    self.retries += len(pending)
+                count("sqs_retries", len(pending))
+            try:
+                with span("sqs_send"):
+                    response = sqs.send_message_batch(
+                        QueueUrl=self.queue_url,
+                        Entries=[dict(Id=i, **m) for i, m in pending.items()],
+                    )
+            except Exception as e:
+                self.give_up(pending)
+                raise SqsProducerError("send failed: {error}".format(error=repr(e)))
+            with self.lock:
+                self.requests += 1
+                self.sent += len(response.get("Successful", []))
+            count("sqs_messages", len(response.get("Successful", [])))
+            failed = response.get("Failed", [])
+            if not failed:
+                return
+            pending = {f["Id"]: pending[f["Id"]] for f in failed}
+            if any(f.get("SenderFault") for f in failed):
+                # malformed entries won't get better by retrying
+                self.give_up(pending)
+                raise SqsProducerError("rejected entries: {failed}".format(failed=failed))
+        self.give_up(pending)
+        raise SqsProducerError("{num} entries failed after {attempts} attempts".format(
+            num=len(pending), attempts=self.max_attempts))
+
+    def flush(self):
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        if batch:
+            self.futures.append(self.pool.submit(self.send_batch, batch))
+        futures, self.futures = self.futures, []
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except SqsProducerError as e:
+                errors.append(e)
+        with self.lock:
+            undelivered, self.undelivered = self.undelivered, []
+        if undelivered and self.on_undelivered is not None:
+            self.on_undelivered(undelivered)
+        if errors:
+            raise SqsProducerError("; ".join(str(e) for e in errors))
+
+    def give_up(self, pending):
+        with self.lock:
+            self.undelivered.extend(pending.values())
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # still deliver what was produced before the error
+            try:
+                self.close()
+            except SqsProducerError as e:
+                print('failed flushing sqs producer', e)
+        return False
+
+    def stats(self):
+        return {"sent": self.sent, "requests": self.requests, "retries": self.retries}
@@ -1,12 +1,14 @@
 from stravalib.client import Client as StravaClient
 from config import Config
+from lib.rate_limiter import strava_rate_limiter
+from lib.http_session import strava_session
 import boto3
 import json
 from datetime import datetime, timedelta
 
 s3_client = boto3.client("s3")
 sqs = boto3.client("sqs")
-config = Config()
+config = Config.instance()
 
 
 class StravaActivity():
@@ -29,30 +31,43 @@ class StravaActivity():
         print('saving activity to {bucket}:{key}'.format(
             bucket=config.strava_api_s3_bucket, key=activity_filename))
 
-    def enqueueStreamFetch(self):
-        # print(self.data)
-        response = sqs.send_message(
-            QueueUrl=config.strava_api_queue_url,
+    def stream_fetch_message(self, fingerprint=None):
+        attributes = {
+            "Job": {"DataType": "String", "StringValue": "FETCH_STRAVA_STREAM"},
+            "AthleteId": {"DataType": "String", "StringValue": str(self.data.athlete.id)},
+            "UserId": {"DataType": "String", "StringValue": str(self.user_id)},
+            "ActivityId": {"DataType": "String", "StringValue": str(self.data.id)},
+        }
+        # recorded in the ledger once the streams are saved
+        if fingerprint is not None:
+            attributes["Fingerprint"] = {"DataType": "String", "StringValue": fingerprint}
+        return dict(
             DelaySeconds=0,
-            MessageAttributes={
-                "Job": {"DataType": "String", "StringValue": "FETCH_STRAVA_STREAM"},
-                "AthleteId": {"DataType": "String", "StringValue": str(self.data.athlete.id)},
-                "UserId": {"DataType": "String", "StringValue": str(self.user_id)},
-                "ActivityId": {"DataType": "String", "StringValue": str(self.data.id)},
-            },
+            MessageAttributes=attributes,
             MessageBody=(
                 "Get strava athlete stream for {athlete_id} for activity {activity_id}".format(
                     athlete_id=self.data.athlete.id,
                     activity_id=self.data.id
                 )
             ),
-            MessageGroupId="STRAVA-API"
+            MessageGroupId="STRAVA-API-{athlete_id}".format(
+                athlete_id=self.data.athlete.id)
         )
-        return response
+
+    def enqueueStreamFetch(self, producer=None, fingerprint=None):
+        # with a producer the message joins its next send_message_batch
+        message = self.stream_fetch_message(fingerprint)
+        if producer is not None:
+            producer.send(**message)
+            return None
+        return sqs.send_message(QueueUrl=config.strava_api_queue_url, **message)
 
     @classmethod
-    def fetch(cls, athlete, before=None, after=None, limit=50):
-        strava_client = StravaClient()
+    def fetch(cls, athlete, before=None, after=None, limit=None):
+        # stravalib pages through /athlete/activities at its maximum page
+        # size of 200 until the window is exhausted, a limit caps the total
+        strava_client = StravaClient(rate_limiter=strava_rate_limiter,
+                                     requests_session=strava_session)
         strava_client.access_token = athlete.access_token
 
         before = datetime.now() if before is None else before
@@ -62,7 +77,7 @@ class StravaActivity():
         activities_res = strava_client.get_activities(
             before=before,
             after=after,
-            limit=50)
+            limit=limit)
 
         activities = []
         for activity_res in activities_res:
@@ -1,17 +1,27 @@
 import boto3
 from config import Config
 from datetime import datetime, timedelta
-import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from lib.cache import LRUCache
+from lib.http_session import strava_session
 
-config = Config()
+config = Config.instance()
 dynamodb = boto3.resource("dynamodb", config.aws_region)
 strava_auth_table = dynamodb.Table(config.strava_auth_table)
 
+# access tokens per user_id, dropped this long before strava expires them
+TOKEN_EXPIRY_MARGIN = 300
+access_tokens = LRUCache(1024)
+token_locks = {}
+token_locks_lock = Lock()
+
 
 class StravaAthlete():
-    def __init__(self, user_id, refresh_token=None, access_token=None, athlete_id=None, expires_at=None, last_sync_at=None):
+    def __init__(self, user_id, refresh_token=None, access_token=None, athlete_id=None, expires_at=None, last_sync_at=None, backfill=None):
         self.user_id = user_id
+        self.backfill = backfill
         self.refresh_token = refresh_token
         self.access_token = access_token
         self.athlete_id = athlete_id
@@ -21,19 +31,80 @@ class StravaAthlete():
             self.get_access_token()
 
     def save(self):
-        response = strava_auth_table.put_item(
-            Item={
-                'user_id': self.user_id,
-                'refresh_token': self.refresh_token,
-                'access_token': self.access_token,
-                'athlete_id': self.athlete_id,
-                'expires_at': self.expires_at,
-                'last_sync_at': int(self.last_sync_at)
+        # update rather than put so attributes written elsewhere, like the
+        # backfill checkpoint, survive
+        response = strava_auth_table.update_item(
+            Key={'user_id': self.user_id},
+            UpdateExpression="SET refresh_token = :refresh_token, access_token = :access_token, "
+                             "athlete_id = :athlete_id, expires_at = :expires_at, "
+                             "last_sync_at = :last_sync_at",
+            ExpressionAttributeValues={
+                ':refresh_token': self.refresh_token,
+                ':access_token': self.access_token,
+                ':athlete_id': self.athlete_id,
+                ':expires_at': self.expires_at,
+                ':last_sync_at': int(self.last_sync_at)
             }
         )
         print(response)
         return True
 
+    def save_sync(self):
+        # only last_sync_at, a token refreshed while the sync ran is saved
+        # by whoever refreshed it and mustn't be overwritten with this one
+        strava_auth_table.update_item(
+            Key={'user_id': self.user_id},
+            UpdateExpression="SET last_sync_at = :last_sync_at",
+            ExpressionAttributeValues={':last_sync_at': int(self.last_sync_at)}
+        )
+
+    def save_backfill(self, backfill):
+        strava_auth_table.update_item(
+            Key={'user_id': self.user_id},
+            UpdateExpression="SET backfill = :backfill",
+            ExpressionAttributeValues={':backfill': backfill}
+        )
+        self.backfill = backfill
+
+    def load_backfill(self):
+        # the checkpoint is written by other invocations, always read it fresh
+        res = strava_auth_table.get_item(
+            Key={'user_id': self.user_id},
+            ProjectionExpression="backfill",
+            ConsistentRead=True,
+        )
+        self.backfill = res.get("Item", {}).get("backfill")
+        return self.backfill
+
+    @classmethod
+    def token_lock(cls, user_id):
+        with token_locks_lock:
+            return token_locks.setdefault(user_id, Lock())
+
+    @classmethod
+    def remember(cls, athlete):
+        access_tokens.set(athlete.user_id, {
+            "access_token": athlete.access_token,
+            "refresh_token": athlete.refresh_token,
+            "athlete_id": athlete.athlete_id,
+            "expires_at": athlete.expires_at,
+        }, expires_at=float(athlete.expires_at) - TOKEN_EXPIRY_MARGIN)
+
+    @classmethod
+    def cached(cls, user_id):
+        # an athlete with a valid token, without touching dynamo while the
+        # cached token lasts. single flight, concurrent callers for the same
+        # user wait on the one loading / refreshing and reuse its token
+        entry = access_tokens.get(user_id)
+        if entry is None:
+            with cls.token_lock(user_id):
+                entry = access_tokens.get(user_id)
+                if entry is None:
+                    athlete = StravaAthlete(user_id)
+                    cls.remember(athlete)
+                    return athlete
+        return StravaAthlete(user_id, **entry)
+
     def __str__(self):
         return json.dumps(self.__dict__, default=str)
 
@@ -45,6 +116,7 @@ class StravaAthlete():
         self.expires_at = res["Item"]["expires_at"]
         if "last_sync_at" in res["Item"]:
             self.last_sync_at = res["Item"]["last_sync_at"]
+        self.backfill = res["Item"].get("backfill")
 
         if (datetime.now().timestamp() < self.expires_at):
             print('access token still valid', self.access_token)
@@ -54,7 +126,7 @@ class StravaAthlete():
         return self.fetch_new_token()
 
     def refresh_token_strava(self):
-        raw_res = requests.post(
+        raw_res = strava_session.post(
             "{url}/oauth/token".format(url=config.strava_api_uri),
             data={
                 "client_id": config.strava_client_id,
@@ -72,13 +144,15 @@ class StravaAthlete():
         print("updating token for {athlete_id}".format(
             athlete_id=self.athlete_id))
 
-        token_update_res = strava_auth_table.put_item(
-            Item={
-                "user_id": self.user_id,
-                "access_token": strava_res["access_token"],
-                "refresh_token": strava_res["refresh_token"],
-                "expires_at": strava_res["expires_at"],
-                "athlete_id": str(self.athlete_id),
+        token_update_res = strava_auth_table.update_item(
+            Key={"user_id": self.user_id},
+            UpdateExpression="SET access_token = :access_token, refresh_token = :refresh_token, "
+                             "expires_at = :expires_at, athlete_id = :athlete_id",
+            ExpressionAttributeValues={
+                ":access_token": strava_res["access_token"],
+                ":refresh_token": strava_res["refresh_token"],
+                ":expires_at": strava_res["expires_at"],
+                ":athlete_id": str(self.athlete_id),
             }
         )
         print(token_update_res)
@@ -89,14 +163,24 @@ class StravaAthlete():
         return self.access_token
 
     @classmethod
-    def get_all(cls):
-        results = []
-        response = strava_auth_table.scan()
-        for strava_creds in response['Items']:
-            if 'access_token' not in strava_creds or strava_creds['access_token'] is None:
-                continue
-            last_sync_at = strava_creds['last_sync_at'] if 'last_sync_at' in strava_creds else 1436029687
+    def scan_segment(cls, segment, total_segments):
+        items = []
+        scan = {"Segment": segment, "TotalSegments": total_segments}
+        while True:
+            response = strava_auth_table.scan(**scan)
+            items.extend(response['Items'])
+            if "LastEvaluatedKey" not in response:
+                break
+            scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        return items
 
+    @classmethod
+    def from_item(cls, strava_creds):
+        if 'access_token' not in strava_creds or strava_creds['access_token'] is None:
+            return None
+        last_sync_at = strava_creds['last_sync_at'] if 'last_sync_at' in strava_creds else 1436029687
+        try:
+            # refreshes the token over http if it has expired
             athlete = StravaAthlete(
                 access_token=strava_creds['access_token'],
                 user_id=strava_creds['user_id'],
@@ -104,6 +188,25 @@ class StravaAthlete():
                 expires_at=strava_creds['expires_at'],
                 athlete_id=strava_creds['athlete_id'],
                 last_sync_at=last_sync_at,
+                backfill=strava_creds.get('backfill'),
             )
-            results.append(athlete)
+            cls.remember(athlete)
+            return athlete
+        except Exception as e:
+            print('unable to load athlete {user_id}: {error}'.format(
+                user_id=strava_creds['user_id'], error=repr(e)))
+            return None
+
+    @classmethod
+    def get_all(cls):
+        # parallel scan of every segment, each paged to the end, then the
+        # athletes built (and expired tokens refreshed) on the same pool
+        segments = config.strava_auth_scan_segments
+        with ThreadPoolExecutor(max_workers=max(segments, config.strava_sync_workers)) as pool:
+            items = [item for segment in pool.map(
+                lambda segment: cls.scan_segment(segment, segments), range(segments))
+                for item in segment]
+            athletes = list(pool.map(cls.from_item, items))
+        results = [athlete for athlete in athletes if athlete is not None]
+        print('loaded {num} of {total} athletes'.format(num=len(results), total=len(items)))
         return results
@@ -1,7 +1,7 @@
 import boto3
 from config import Config
 
-config = Config()
+config = Config.instance()
 sqs = boto3.client("sqs")
 
 class EnqStravaApiActivities():
@@ -9,9 +9,8 @@ class EnqStravaApiActivities():
         self.user_id = user_id
         self.athlete_id = athlete_id
 
-    def queue(self, before, after):
-        response = sqs.send_message(
-            QueueUrl=config.strava_api_queue_url,
+    def message(self, before, after, backfill=False):
+        message = dict(
             DelaySeconds=0,
             MessageAttributes={
                 "Job": {"DataType": "String", "StringValue": "FETCH_STRAVA_ACTIVITY"},
@@ -27,6 +26,18 @@ class EnqStravaApiActivities():
                     after=after.strftime("%m/%d/%Y")
                 )
             ),
-            MessageGroupId="STRAVA-API"
+            MessageGroupId="STRAVA-API-{athlete_id}".format(
+                athlete_id=self.athlete_id)
         )
-        return response
+        if backfill:
+            # windows planned by BackfillPlanner, which chains the next one
+            message["MessageAttributes"]["Backfill"] = {
+                "DataType": "String", "StringValue": "true"}
+        return message
+
+    def queue(self, before, after, producer=None, backfill=False):
+        message = self.message(before, after, backfill=backfill)
+        if producer is not None:
+            producer.send(**message)
+            return None
+        return sqs.send_message(QueueUrl=config.strava_api_queue_url, **message)
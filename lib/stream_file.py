@@ -0,0 +1,193 @@
+import json
+import struct
+import zlib
+import boto3
+import numpy as np
+from config import Config
+from lib.stream_json import StreamJsonDecoder
+from lib.metrics import span, count
+
+config = Config.instance()
+s3_client = boto3.client("s3")
+
+# columnar stream file (little endian):
+#   prefix:  magic "STRM", version u8, header length u32
+#   header:  utf8 json {"columns": [{name, dtype, shape, offset, size,
+#            compression}]}, offsets relative to the end of the header
+#   columns: one block per stream, zlib compressed unless that didn't help
+# columns are written in COLUMN_ORDER so the ones process_streams reads sit
+# next to each other and come back in a single ranged GET
+MAGIC = b"STRM"
+VERSION = 1
+PREFIX = struct.Struct("<4sBI")
+COLUMN_ORDER = ["time", "heartrate", "watts", "velocity_smooth"]
+# first ranged read, big enough for the header and the hot columns of most
+# rides so a typical activity costs a single GET
+INITIAL_READ_BYTES = 256 * 1024
+FORMAT_EXTENSION = "bin"
+LEGACY_EXTENSION = "json"
+
+
+def encode_column(values):
+    arr = np.asarray(values)
+    if arr.dtype.kind == "O":
+        # null samples are stored as nan
+        arr = np.array(values, dtype=object)
+        arr[np.equal(arr, None)] = np.nan
+        arr = arr.astype(np.float64)
+    elif arr.dtype.kind in ("i", "u"):
+        small = len(arr) == 0 or (arr.min() >= -2 ** 31 and arr.max() < 2 ** 31)
+        arr = arr.astype(np.int32 if small else np.int64)
+    elif arr.dtype.kind == "f":
+        arr = arr.astype(np.float64)
+    arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder("<"))
+    raw = arr.tobytes()
+    compressed = zlib.compress(raw, 6)
+    if len(compressed) < len(raw) * 0.9:
+        return arr, compressed, "zlib"
+    return arr, raw, "none"
+
+
+class StreamFile():
+    @classmethod
+    def filename(cls, athlete_id, activity_id, extension=FORMAT_EXTENSION):
+        return "streams_{athlete_id}_{activity_id}.{extension}".format(
+            athlete_id=athlete_id, activity_id=activity_id, extension=extension)
+
+    @classmethod
+    def to_bytes(cls, streams):
+        names = [n for n in COLUMN_ORDER if n in streams]
+        names += sorted(n for n in streams if n not in COLUMN_ORDER)
+        columns = []
+        blocks = []
+        offset = 0
+        for name in names:
+            arr, block, compression = encode_column(streams[name])
+            columns.append({
+                "name": name,
+                "dtype": arr.dtype.str,
+                "shape": list(arr.shape),
+                "offset": offset,
+                "size": len(block),
+                "compression": compression,
+            })
+            blocks.append(block)
+            offset += len(block)
+        header = json.dumps({"columns": columns}, separators=(",", ":")).encode("utf8")
+        return b"".join([PREFIX.pack(MAGIC, VERSION, len(header)), header] + blocks)
+
+    @classmethod
+    def is_stream_file(cls, data):
+        return bytes(data[:len(MAGIC)]) == MAGIC
+
+    @classmethod
+    def read_header(cls, data):
+        magic, version, header_len = PREFIX.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a stream file")
+        end = PREFIX.size + header_len
+        if len(data) < end:
+            return None, end
+        header = json.loads(bytes(data[PREFIX.size:end]).decode("utf8"))
+        return header, end
+
+    @classmethod
+    def decode_column(cls, column, block):
+        if column["compression"] == "zlib":
+            block = zlib.decompress(block)
+        # frombuffer gives a read only view onto the (decompressed) bytes
+        arr = np.frombuffer(block, dtype=np.dtype(column["dtype"]))
+        return arr.reshape(column["shape"])
+
+    @classmethod
+    def wanted_columns(cls, header, columns=None):
+        return [c for c in header["columns"]
+                if columns is None or c["name"] in columns]
+
+    @classmethod
+    def decode_columns(cls, data, data_start, wanted):
+        buf = memoryview(data)
+        streams = {}
+        for column in wanted:
+            start = data_start + column["offset"]
+            streams[column["name"]] = cls.decode_column(
+                column, buf[start:start + column["size"]])
+        return streams
+
+    @classmethod
+    def from_bytes(cls, data, columns=None):
+        header, data_start = cls.read_header(data)
+        if header is None:
+            raise ValueError("truncated stream file")
+        return cls.decode_columns(
+            data, data_start, cls.wanted_columns(header, columns))
+
+    @classmethod
+    def get_range(cls, bucket, key, start, end=None):
+        # returns the body and the total object size from Content-Range
+        byte_range = "bytes={start}-{end}".format(
+            start=start, end="" if end is None else end)
+        with span("s3_get"):
+            response = s3_client.get_object(Bucket=bucket, Key=key, Range=byte_range)
+            body = response["Body"].read()
+        count("s3_bytes", len(body))
+        total = int(response["ContentRange"].split("/")[-1])
+        return body, total
+
+    @classmethod
+    def fetch(cls, bucket, key, columns=None):
+        # reads the header from the first ranged GET, then fetches whatever
+        # part of the requested columns that GET didn't already cover
+        head, total = cls.get_range(bucket, key, 0, INITIAL_READ_BYTES - 1)
+        if not cls.is_stream_file(head):
+            if total > len(head):
+                head += cls.get_range(bucket, key, len(head))[0]
+            return cls.from_legacy(head, columns)
+
+        header, data_start = cls.read_header(head)
+        if header is None:
+            head += cls.get_range(bucket, key, len(head), data_start - 1)[0]
+            header, data_start = cls.read_header(head)
+
+        wanted = cls.wanted_columns(header, columns)
+        if not wanted:
+            return {}
+        span_end = data_start + max(c["offset"] + c["size"] for c in wanted)
+        if span_end > len(head):
+            head += cls.get_range(bucket, key, len(head), span_end - 1)[0]
+        return cls.decode_columns(head, data_start, wanted)
+
+    @classmethod
+    def from_legacy(cls, data, columns=None):
+        with span("json_decode"):
+            streams = json.loads(data)
+        if columns is None:
+            return streams
+        return {name: streams[name] for name in columns if name in streams}
+
+    @classmethod
+    def load(cls, bucket, key, columns=None):
+        if key.endswith("." + LEGACY_EXTENSION):
+            with span("s3_get"):
+                response = s3_client.get_object(Bucket=bucket, Key=key)
+            count("s3_bytes", response["ContentLength"])
+            if columns is None:
+                return cls.from_legacy(response["Body"].read())
+            # stream the body, decoding only the requested columns. the
+            # span includes reading the body, the two are interleaved
+            with span("json_decode"):
+                return StreamJsonDecoder(response["Body"], columns).decode()
+        return cls.fetch(bucket, key, columns)
+
+    @classmethod
+    def save(cls, streams, athlete_id, activity_id):
+        streams_filename = cls.filename(athlete_id, activity_id)
+        s3_client.put_object(
+            Body=cls.to_bytes(streams),
+            Bucket=config.strava_api_s3_bucket,
+            Key=streams_filename,
+            ContentType="application/octet-stream",
+        )
+        print('saving streams to {bucket}:{key}'.format(
+            bucket=config.strava_api_s3_bucket, key=streams_filename))
+        return streams_filename
@@ -0,0 +1,186 @@
+import codecs
+import json
+import re
+from array import array
+import numpy as np
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\r\n"
+STRUCTURAL = re.compile(r'[\[\]{}"]')
+SCALAR_END = re.compile(r'[,\]}\s]')
+
+
+class StreamJsonDecoder():
+    # incrementally decodes a legacy streams_*.json body ({"time": [...],
+    # "watts": [...], ...}) keeping only the requested keys. flat numeric
+    # arrays are parsed a chunk at a time straight into array('d') and handed
+    # back as numpy views, everything else is skipped without being built,
+    # and reading stops as soon as every requested key has been seen
+    def __init__(self, body, keys, chunk_size=CHUNK_SIZE):
+        self.body = body
+        self.keys = set(keys)
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.mark = None
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.body.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            self.buf += self.decoder.decode(b"", final=True)
+            return False
+        # drop what has been consumed, keeping anything from the mark onwards
+        keep_from = self.pos if self.mark is None else self.mark
+        self.buf = self.buf[keep_from:] + self.decoder.decode(data)
+        self.pos -= keep_from
+        if self.mark is not None:
+            self.mark = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("expected {char!r} at offset {pos}".format(
+                char=char, pos=self.pos))
+        self.pos += 1
+
+    def find(self, pattern_or_char, start):
+        # search the buffer from start, reading more until there is a match
+        while True:
+            if isinstance(pattern_or_char, str):
+                idx = self.buf.find(pattern_or_char, start)
+                if idx != -1:
+                    return idx
+            else:
+                match = pattern_or_char.search(self.buf, start)
+                if match:
+                    return match.start()
+            start = len(self.buf)
+            offset = self.pos
+            if not self.fill():
+                return -1
+            start -= offset - self.pos
+
+    def string_end(self, start):
+        # index of the closing quote of the string opening at start
+        idx = start + 1
+        while True:
+            idx = self.find('"', idx)
+            if idx == -1:
+                raise ValueError("unterminated string")
+            backslashes = 0
+            while self.buf[idx - 1 - backslashes] == "\\":
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return idx
+            idx += 1
+
+    def read_string(self):
+        self.peek()
+        self.mark = self.pos
+        end = self.string_end(self.pos)
+        value = json.loads(self.buf[self.mark:end + 1])
+        self.pos = end + 1
+        self.mark = None
+        return value
+
+    def skip_value(self, capture=False):
+        char = self.peek()
+        self.mark = self.pos if capture else None
+        if char in "[{":
+            depth = 0
+            idx = self.pos
+            while True:
+                idx = self.find(STRUCTURAL, idx)
+                if idx == -1:
+                    raise ValueError("unterminated value")
+                token = self.buf[idx]
+                if token == '"':
+                    self.pos = idx
+                    idx = self.string_end(idx)
+                elif token in "[{":
+                    depth += 1
+                else:
+                    depth -= 1
+                idx += 1
+                self.pos = idx
+                if depth == 0:
+                    break
+        elif char == '"':
+            self.pos = self.string_end(self.pos) + 1
+        else:
+            end = self.find(SCALAR_END, self.pos)
+            self.pos = len(self.buf) if end == -1 else end
+
+        text = None
+        if capture:
+            text = self.buf[self.mark:self.pos]
+            self.mark = None
+        return text
+
+    def read_numeric_array(self):
+        self.expect("[")
+        values = array("d")
+        while True:
+            end = self.buf.find("]", self.pos)
+            if end != -1:
+                self.parse_numbers(self.buf[self.pos:end], values)
+                self.pos = end + 1
+                return np.frombuffer(values, dtype=np.float64)
+            cut = self.buf.rfind(",", self.pos)
+            if cut != -1:
+                self.parse_numbers(self.buf[self.pos:cut], values)
+                self.pos = cut + 1
+            if not self.fill():
+                raise ValueError("unterminated array")
+
+    def parse_numbers(self, text, values):
+        # null is a missing sample, boolean streams (moving) come back as
+        # 1.0 / 0.0. anything else that isn't a number is an error
+        text = text.strip()
+        if not text:
+            return
+        text = text.replace("null", "nan").replace("true", "1").replace("false", "0")
+        try:
+            values.extend(map(float, text.split(",")))
+        except ValueError:
+            raise ValueError("non numeric value in stream array near offset {pos}".format(
+                pos=self.pos))
+
+    def decode(self):
+        streams = {}
+        self.expect("{")
+        while self.peek() not in ("}", None) and len(streams) < len(self.keys):
+            key = self.read_string()
+            self.expect(":")
+            if key not in self.keys:
+                self.skip_value()
+            elif self.peek() == "[":
+                # look past the bracket to tell flat arrays from nested ones
+                self.mark = self.pos
+                self.pos += 1
+                nested = self.peek() in ("[", "{")
+                self.pos = self.mark
+                self.mark = None
+                if nested:
+                    streams[key] = json.loads(self.skip_value(capture=True))
+                else:
+                    streams[key] = self.read_numeric_array()
+            else:
+                streams[key] = json.loads(self.skip_value(capture=True))
+            if self.peek() == ",":
+                self.pos += 1
+        return streams
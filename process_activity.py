@@ -1,6 +1,7 @@
 import boto3
 import os
 import json
+from lib.metrics import span, count, instrument
 
 
 S3_BUCKET = os.getenv("BUCKET").split(".")[0]
@@ -10,29 +11,42 @@ dynamo_client = boto3.client("dynamodb")
 s3_client = boto3.client("s3")
 
 
+@instrument
 def main(event, context):
     # print(event, context)
     for record in event["Records"]:
         filename = record["s3"]["object"]["key"]
-        response = s3_client.get_object(Bucket=S3_BUCKET, Key=filename)
-        res_body = json.load(response["Body"])
+        with span("s3_get"):
+            response = s3_client.get_object(Bucket=S3_BUCKET, Key=filename)
+            raw = response["Body"].read()
+        count("s3_bytes", len(raw))
+        with span("json_decode"):
+            res_body = json.loads(raw)
         athlete_id = int(filename.split("_")[1])
         activity_id = int(filename.split("_")[2].split(".")[0])
 
-        resp = dynamo_client.put_item(
-            TableName=ACTIVITIES_TABLE,
-            Item={
-                "athlete_id": {"S": str(athlete_id)},
-                "activity_id": {"S": str(activity_id)},
-                "start_date_local": {"S": res_body["start_date_local"]},
-                "name": {"S": res_body["name"]},
-                "distance": {"N": str(res_body["distance"])},
-                "type": {"S": res_body["type"]},
-                "trainer": {"S": str(res_body["trainer"])},
-                "elapsed_time": {"S": res_body["elapsed_time"]},
-                "suffer_score": {"N": str(res_body["suffer_score"])},
-            },
-        )
+        # an update so the sync's fingerprint on the same item is kept
+        with span("dynamodb_write"):
+            resp = dynamo_client.update_item(
+                TableName=ACTIVITIES_TABLE,
+                Key={
+                    "athlete_id": {"S": str(athlete_id)},
+                    "activity_id": {"S": str(activity_id)},
+                },
+                UpdateExpression="SET start_date_local = :start_date_local, #name = :name, "
+                                 "distance = :distance, #type = :type, trainer = :trainer, "
+                                 "elapsed_time = :elapsed_time, suffer_score = :suffer_score",
+                ExpressionAttributeNames={"#name": "name", "#type": "type"},
+                ExpressionAttributeValues={
+                    ":start_date_local": {"S": res_body["start_date_local"]},
+                    ":name": {"S": res_body["name"]},
+                    ":distance": {"N": str(res_body["distance"])},
+                    ":type": {"S": res_body["type"]},
+                    ":trainer": {"S": str(res_body["trainer"])},
+                    ":elapsed_time": {"S": res_body["elapsed_time"]},
+                    ":suffer_score": {"N": str(res_body["suffer_score"])},
+                },
+            )
         print(resp)
 
         # print(
@@ -1,121 +1,175 @@
 from lib.recent_athlete_peak import RecentAthletePeak
 import boto3
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import Config
 from pprint import pprint
 from lib.activity_peak import ActivityPeak
+from lib.mean_max_curve import MeanMaxCurve
+from lib.peak_engine import calc_peaks
+from lib.resample import TimeBase
+from lib.sqs_batch import SqsBatch
+from lib.sqs_producer import SqsBatchProducer
+from lib.stream_file import StreamFile
+from lib.metrics import span, count, instrument
 
-config = Config()
+config = Config.instance()
 PEAK_DURATIONS = [5, 60, 300, 600, 1200, 3600, 5400]
 TYPE = {"rowing": ["Rowing"], "cycling": ["VirtualRide", "Ride"]}
+STATISTICS = ["heartrate", "watts", "velocity_smooth"]
 dynamo_client = boto3.client("dynamodb")
 s3_client = boto3.client("s3")
 
 
-def fill_values(time_stream, data_stream):
-    new_data_stream = []
-    if len(time_stream) != len(data_stream):
-        return None
-    if len(time_stream) == len(data_stream):
-        return data_stream
-    for i in range(0, len(time_stream) - 1):
-        if i == len(time_stream):
-            continue
-        new_data_stream.append(data_stream[i])
-        time_diff = time_stream[i + 1] - time_stream[i]
-        if time_diff > 1:
-            data_diff = data_stream[i + 1] - data_stream[i]
-            for j in range(1, time_diff):
-                new_data_stream.append(
-                    data_stream[i] + ((data_diff / time_diff) * j))
-    return new_data_stream
+def fill_values(time_stream, data_stream, pause_gap=None):
+    return TimeBase(time_stream, pause_gap).resample(data_stream)
 
 
 def calc_peak(num_seconds, data_stream, activity_id):
-    if len(data_stream) == 0:
-        return 0
-    if num_seconds > len(data_stream):
-        return None
-    sums = []
-    for w in range(len(data_stream)):
-        if w + num_seconds > len(data_stream):
-            break
+    return calc_peaks([num_seconds], data_stream, activity_id)[num_seconds]
 
-        try:
-            sums.append(sum(data_stream[w: w + num_seconds]))
-        except:
-            print("unable to sum datastream for {}".format(activity_id))
-            return 0
-    peak_total = sorted(sums)[-1]
-    return peak_total / num_seconds
 
+def parse_stream_key(filename):
+    athlete_id = int(filename.split("_")[1])
+    activity_id = int(filename.split("_")[2].split(".")[0])
+    return athlete_id, activity_id
 
-def main(event, context):
-    for record in event["Records"]:
-        # print(record)
-        s3_events = json.loads(record['body'])
-        if "Records" not in s3_events:
-            print('test event', record['body'])
+
+def load_stream_files(s3_bucket, filename):
+    # both GETs for one activity, run on the fetch pool
+    athlete_id, activity_id = parse_stream_key(filename)
+    activity_filename = "activity_{athlete_id}_{activity_id}.json".format(
+        athlete_id=athlete_id, activity_id=activity_id)
+    with span("s3_get"):
+        activity_raw_response = s3_client.get_object(
+            Bucket=s3_bucket, Key=activity_filename
+        )
+        activity_raw = activity_raw_response["Body"].read()
+    count("s3_bytes", len(activity_raw))
+    with span("json_decode"):
+        activity_res_body = json.loads(activity_raw)
+    res_body = StreamFile.load(
+        s3_bucket, filename, columns=["time"] + STATISTICS)
+
+    print('load stream file for {athlete_id} and activity: {activity_id}'.format(
+        athlete_id=athlete_id, activity_id=activity_id))
+    return athlete_id, activity_id, activity_res_body, res_body
+
+
+def build_peaks(athlete_id, activity_id, activity_res_body, res_body):
+    with span("resample"):
+        time_base = TimeBase(res_body["time"], config.pause_gap_seconds)
+
+    peaks_to_push = []
+    normalized_streams = {}
+    for statistic in STATISTICS:
+        if statistic not in res_body:
             continue
+        data_stream = res_body[statistic]
+        with span("resample"):
+            normalized_stream = time_base.resample(data_stream)
+        normalized_streams[statistic] = normalized_stream
+        with span("peak_compute"):
+            peak_values = calc_peaks(
+                PEAK_DURATIONS, normalized_stream, activity_id)
+        for duration in PEAK_DURATIONS:
+            peak_value = peak_values[duration]
+            if peak_value is None:
+                continue
+            elapsed_time = activity_res_body["elapsed_time"] if activity_res_body["elapsed_time"] is not None else ""
+
+            item = {
+                "peak_id": "{activity_id}_{statistic}_{duration}".format(
+                    activity_id=activity_id, statistic=statistic, duration=duration),
+                "peak_type": "{type}_{statistic}_{duration}".format(
+                    type=activity_res_body["type"], statistic=statistic, duration=str(duration)),
+                "attribute": statistic,
+                "value": str(peak_value),
+                "activity_id": str(activity_id),
+                "athlete_id": str(athlete_id),
+                "duration": str(duration),
+                "start_date_local": activity_res_body["start_date_local"],
+                "name": activity_res_body["name"],
+                "type": activity_res_body["type"],
+                "trainer": str(activity_res_body["trainer"]),
+                "elapsed_time": elapsed_time,
+            }
 
-        for s3event in s3_events['Records']:
-            s3_bucket = s3event['s3']['bucket']['name']
-            filename = s3event['s3']['object']['key']
-
-            activity_filename = "activity_{}".format(
-                "_".join(filename.split("_")[1:]))
-            response = s3_client.get_object(Bucket=s3_bucket, Key=filename)
-            activity_raw_response = s3_client.get_object(
-                Bucket=s3_bucket, Key=activity_filename
-            )
-            activity_res_body = json.load(activity_raw_response["Body"])
-            res_body = json.load(response["Body"])
-
-            athlete_id = int(filename.split("_")[1])
-            activity_id = int(filename.split("_")[2].split(".")[0])
-            print('load json file for {athlete_id} and activity: {activity_id}'.format(
-                athlete_id=athlete_id, activity_id=activity_id))
-            if "time" not in res_body:
-                print('time metric not found')
+            if activity_res_body["distance"] is not None:
+                item["distance"] = str(activity_res_body["distance"])
+            if activity_res_body["suffer_score"] is not None:
+                item["suffer_score"] = str(activity_res_body["suffer_score"])
+            peaks_to_push.append(item)
+    return peaks_to_push, normalized_streams
+
+
+def process_stream_files(athlete_id, activity_id, activity_res_body, res_body, producer=None):
+    # returns the saved ActivityPeak, its digests still to be saved once the
+    # recompute message it queued has gone out
+    if "time" not in res_body:
+        print('time metric not found')
+        return None
+    peaks_to_push, normalized_streams = build_peaks(
+        athlete_id, activity_id, activity_res_body, res_body)
+    # pprint(peaks_to_push)
+    MeanMaxCurve.from_streams(
+        normalized_streams, extra=PEAK_DURATIONS).save(athlete_id, activity_id)
+    activity_peak = ActivityPeak(peaks_to_push)
+    saved = activity_peak.save(save_digests=False)
+    # an unchanged reprocess doesn't need the athlete's peaks recomputed
+    if saved["written"]:
+        RecentAthletePeak.enqueue(athlete_id, producer=producer)
+    return activity_peak
+
+
+@instrument
+def main(event, context):
+    # prefetch the stream and activity files for every record in the batch
+    # on a thread pool, computing and saving peaks as each download lands.
+    # records fail independently, see SqsBatch.complete. the recent peaks
+    # messages go out batched, and only once they are all sent are the
+    # peaks digests saved: a record redelivered after a failed send finds
+    # its rows unsaved, writes them again and queues the recompute again
+    batch = SqsBatch(event["Records"])
+    pending = {}
+    saved = []
+    with SqsBatchProducer(config.recent_athlete_peaks_to_s3,
+                          on_undelivered=RecentAthletePeak.release) as producer, \
+            ThreadPoolExecutor(max_workers=config.process_streams_workers) as pool:
+        for record in event["Records"]:
+            # print(record)
+            s3_events = json.loads(record['body'])
+            if "Records" not in s3_events:
+                print('test event', record['body'])
                 continue
-            time_stream = res_body["time"]
-
-            peaks_to_push = []
-            for statistic in ["heartrate", "watts", "velocity_smooth"]:
-                for duration in PEAK_DURATIONS:
-                    if statistic not in res_body:
-                        continue
-                    data_stream = res_body[statistic]
-                    normalized_stream = fill_values(time_stream, data_stream)
-                    peak_value = calc_peak(
-                        duration, normalized_stream, activity_id)
-                    if peak_value is None:
-                        continue
-                    elapsed_time = activity_res_body["elapsed_time"] if activity_res_body["elapsed_time"] is not None else ""
-
-                    item = {
-                        "peak_id": "{activity_id}_{statistic}_{duration}".format(
-                            activity_id=activity_id, statistic=statistic, duration=duration),
-                        "peak_type": "{type}_{statistic}_{duration}".format(
-                            type=activity_res_body["type"], statistic=statistic, duration=str(duration)),
-                        "attribute": statistic,
-                        "value": str(peak_value),
-                        "activity_id": str(activity_id),
-                        "athlete_id": str(athlete_id),
-                        "duration": str(duration),
-                        "start_date_local": activity_res_body["start_date_local"],
-                        "name": activity_res_body["name"],
-                        "type": activity_res_body["type"],
-                        "trainer": str(activity_res_body["trainer"]),
-                        "elapsed_time": elapsed_time,
-                    }
-
-                    if activity_res_body["distance"] is not None:
-                        item["distance"] = str(activity_res_body["distance"])
-                    if activity_res_body["suffer_score"] is not None:
-                        item["suffer_score"] = str(activity_res_body["suffer_score"])
-                    peaks_to_push.append(item)
-            # pprint(peaks_to_push)
-            activity_peak = ActivityPeak(peaks_to_push).save()
-            RecentAthletePeak.enqueue(athlete_id)
+
+            for s3event in s3_events['Records']:
+                s3_bucket = s3event['s3']['bucket']['name']
+                filename = s3event['s3']['object']['key']
+                future = pool.submit(load_stream_files, s3_bucket, filename)
+                pending[future] = (record["messageId"], filename)
+
+        for future in as_completed(pending):
+            message_id, filename = pending[future]
+            try:
+                activity_peak = process_stream_files(*future.result(), producer=producer)
+                if activity_peak is not None:
+                    saved.append((message_id, activity_peak))
+                count("activities")
+            except Exception as e:
+                count("failed_activities")
+                print('failed to process {filename}: {error}'.format(
+                    filename=filename, error=repr(e)))
+                batch.fail(message_id)
+        producer.flush()
+
+    for message_id, activity_peak in saved:
+        if message_id in batch.failed:
+            continue
+        try:
+            activity_peak.save_digests()
+        except Exception as e:
+            print('failed to save peaks digests: {error}'.format(error=repr(e)))
+            batch.fail(message_id)
+    batch.complete()
     return True
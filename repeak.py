@@ -0,0 +1,321 @@
+# recomputes the peaks of every stored activity, for when PEAK_DURATIONS or
+# the peak math changed and the stream files already in the bucket need to
+# go through again. stream files are listed from the bucket, or a local
+# mirror of it (e.g. `aws s3 sync`), and grouped by athlete. decoding and
+# peak computation fan out over a process pool while this process writes
+# each athlete's peaks once all of their activities are in, through
+# ActivityPeak.replace, which only writes rows that changed and deletes the
+# ones that no longer exist. finished athletes are checkpointed so an
+# interrupted run picks up where it stopped.
+#
+#   python repeak.py [--mirror DIR] [--athlete ID ...] [--workers N]
+#   python repeak.py --restart          # ignore the checkpoint
+#   python repeak.py --backfill-value-sort
+#
+# --backfill-value-sort recomputes nothing, it adds the peaks_value index
+# key to the listed athletes' rows written before that index existed, which
+# graph.py doesn't see until then. run it once after deploying the index.
+# the checkpoint is only reused for the same peak settings, a run after
+# another change to PEAK_DURATIONS starts from the beginning
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from config import Config
+import process_streams
+from process_streams import PEAK_DURATIONS, STATISTICS, build_peaks, parse_stream_key
+from lib.activity_peak import ActivityPeak
+from lib.mean_max_curve import MeanMaxCurve
+from lib.metrics import metrics, span
+from lib.recent_athlete_peak import RecentAthletePeak
+from lib.sqs_producer import SqsBatchProducer
+from lib.stream_file import StreamFile, FORMAT_EXTENSION, LEGACY_EXTENSION
+
+config = Config.instance()
+STREAMS_PREFIX = "streams_"
+CHECKPOINT_FILE = "repeak.checkpoint.json"
+# activities queued per worker, enough to keep the pool busy while the
+# parent is writing without holding many athletes' peaks at once
+TASKS_PER_WORKER = 4
+
+
+def settings():
+    # what the peaks depend on, a checkpoint is only valid for the same
+    return {
+        "peak_durations": PEAK_DURATIONS,
+        "statistics": STATISTICS,
+        "pause_gap_seconds": config.pause_gap_seconds,
+    }
+
+
+def add_stream_key(athletes, key):
+    # streams_{athlete_id}_{activity_id}.{bin,json}, the columnar file wins
+    # when an activity has both
+    name = os.path.basename(key)
+    extension = name.rsplit(".", 1)[-1]
+    if not name.startswith(STREAMS_PREFIX) or extension not in (FORMAT_EXTENSION, LEGACY_EXTENSION):
+        return
+    athlete_id, activity_id = parse_stream_key(name)
+    activities = athletes.setdefault(athlete_id, {})
+    if activity_id not in activities or extension == FORMAT_EXTENSION:
+        activities[activity_id] = key
+
+
+def list_bucket(bucket, athlete_ids=None):
+    prefixes = [STREAMS_PREFIX] if not athlete_ids else [
+        "{prefix}{athlete_id}_".format(prefix=STREAMS_PREFIX, athlete_id=athlete_id)
+        for athlete_id in athlete_ids]
+    athletes = {}
+    for prefix in prefixes:
+        query = {"Bucket": bucket, "Prefix": prefix}
+        while True:
+            res = process_streams.s3_client.list_objects_v2(**query)
+            for obj in res.get("Contents", []):
+                add_stream_key(athletes, obj["Key"])
+            if not res.get("IsTruncated"):
+                break
+            query["ContinuationToken"] = res["NextContinuationToken"]
+    return athletes
+
+
+def list_mirror(mirror, athlete_ids=None):
+    athletes = {}
+    for name in os.listdir(mirror):
+        add_stream_key(athletes, name)
+    if athlete_ids:
+        athletes = {a: athletes[a] for a in athlete_ids if a in athletes}
+    return athletes
+
+
+def load_mirror_files(mirror, filename):
+    # the local counterpart of process_streams.load_stream_files
+    athlete_id, activity_id = parse_stream_key(filename)
+    activity_filename = "activity_{athlete_id}_{activity_id}.json".format(
+        athlete_id=athlete_id, activity_id=activity_id)
+    with span("file_read"):
+        with open(os.path.join(mirror, activity_filename)) as f:
+            activity_raw = f.read()
+        with open(os.path.join(mirror, filename), "rb") as f:
+            data = f.read()
+    with span("json_decode"):
+        activity_res_body = json.loads(activity_raw)
+    columns = ["time"] + STATISTICS
+    if StreamFile.is_stream_file(data):
+        res_body = StreamFile.from_bytes(data, columns)
+    else:
+        res_body = StreamFile.from_legacy(data, columns)
+    return athlete_id, activity_id, activity_res_body, res_body
+
+
+def init_worker(verbose):
+    # per activity prints from process_streams would bury the progress lines
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+
+
+def compute_activity(source, filename, save_curves):
+    # runs in a pool process: load, resample and compute one activity's
+    # peaks, returning the rows for the parent to write along with the cpu
+    # time and the time spent per span
+    metrics.reset()
+    started = time.process_time()
+    kind, location = source
+    if kind == "mirror":
+        loaded = load_mirror_files(location, filename)
+    else:
+        loaded = process_streams.load_stream_files(location, filename)
+    athlete_id, activity_id, activity_res_body, res_body = loaded
+    rows = None
+    if "time" in res_body:
+        rows, normalized_streams = build_peaks(*loaded)
+        if save_curves:
+            MeanMaxCurve.from_streams(
+                normalized_streams, extra=PEAK_DURATIONS).save(athlete_id, activity_id)
+    spans = {name: s["total_ms"] for name, s in metrics.summary()["spans"].items()}
+    return athlete_id, activity_id, rows, time.process_time() - started, spans
+
+
+class Checkpoint():
+    # finished athletes and their totals, rewritten after each athlete
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.done = {}
+        if restart or not os.path.exists(path):
+            return
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get("settings") != settings():
+            print('checkpoint {path} is for other peak settings, starting over'.format(path=path))
+            return
+        self.done = saved["done"]
+
+    def is_done(self, athlete_id):
+        return str(athlete_id) in self.done
+
+    def mark(self, athlete_id, totals):
+        self.done[str(athlete_id)] = totals
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"settings": settings(), "done": self.done}, f)
+        os.replace(tmp, self.path)
+
+
+class Repeak():
+    def __init__(self, source, athletes, checkpoint, workers, save_curves=True, verbose=False):
+        self.source = source
+        self.athletes = athletes
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.save_curves = save_curves
+        self.verbose = verbose
+        self.pending = {}
+        self.rows = {}
+        self.failed = {}
+        self.totals = {"athletes": 0, "activities": 0, "skipped_activities": 0,
+                       "failed_activities": 0, "written": 0, "deleted": 0, "unchanged": 0}
+        self.cpu_seconds = 0.0
+        self.spans = {}
+
+    def tasks(self):
+        for athlete_id in sorted(self.athletes):
+            if self.checkpoint.is_done(athlete_id):
+                continue
+            activities = self.athletes[athlete_id]
+            self.pending[athlete_id] = set(activities)
+            self.rows[athlete_id] = {}
+            for activity_id in sorted(activities):
+                yield athlete_id, activity_id, activities[activity_id]
+
+    def run(self):
+        started = time.perf_counter()
+        # spawned workers make their own boto3 clients rather than inheriting
+        # this process's connections
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker, initargs=(self.verbose,))
+        tasks = self.tasks()
+        futures = {}
+        with pool, SqsBatchProducer(config.recent_athlete_peaks_to_s3,
+                                    on_undelivered=RecentAthletePeak.release) as producer:
+            while True:
+                for athlete_id, activity_id, filename in tasks:
+                    future = pool.submit(compute_activity, self.source, filename, self.save_curves)
+                    futures[future] = (athlete_id, activity_id, filename)
+                    if len(futures) >= self.workers * TASKS_PER_WORKER:
+                        break
+                if not futures:
+                    break
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    athlete_id, activity_id, filename = futures.pop(future)
+                    self.collect(future, athlete_id, activity_id, filename)
+                    if not self.pending[athlete_id]:
+                        self.write(athlete_id, producer)
+        self.report(time.perf_counter() - started)
+        return not self.failed
+
+    def collect(self, future, athlete_id, activity_id, filename):
+        self.pending[athlete_id].discard(activity_id)
+        try:
+            _, _, rows, cpu_seconds, spans = future.result()
+        except Exception as e:
+            self.totals["failed_activities"] += 1
+            self.failed.setdefault(athlete_id, []).append(activity_id)
+            print('failed to process {filename}: {error}'.format(
+                filename=filename, error=repr(e)))
+            return
+        self.cpu_seconds += cpu_seconds
+        for name, ms in spans.items():
+            self.spans[name] = self.spans.get(name, 0) + ms
+        if rows is None:
+            # no time stream, process_streams skips these too
+            self.totals["skipped_activities"] += 1
+            return
+        self.totals["activities"] += 1
+        self.rows[athlete_id][activity_id] = rows
+
+    def write(self, athlete_id, producer):
+        # activities that failed keep their current peaks, and the athlete
+        # stays out of the checkpoint so the next run tries them again
+        rows_by_activity = self.rows.pop(athlete_id)
+        del self.pending[athlete_id]
+        rows = [row for activity_rows in rows_by_activity.values() for row in activity_rows]
+        saved = ActivityPeak(rows).replace(athlete_id, rows_by_activity.keys())
+        if saved["written"] or saved["deleted"]:
+            RecentAthletePeak.enqueue(str(athlete_id), producer=producer)
+        self.totals["athletes"] += 1
+        self.totals["written"] += saved["written"]
+        self.totals["deleted"] += saved["deleted"]
+        self.totals["unchanged"] += saved["skipped"]
+        print('{athlete_id}: {activities} activities, {written} peaks written, {deleted} deleted, '
+              '{skipped} unchanged{failed}'.format(
+                  athlete_id=athlete_id, activities=len(rows_by_activity),
+                  failed=", {n} failed".format(n=len(self.failed[athlete_id]))
+                  if athlete_id in self.failed else "", **saved))
+        if athlete_id not in self.failed:
+            self.checkpoint.mark(athlete_id, dict(saved, activities=len(rows_by_activity)))
+
+    def report(self, elapsed):
+        activities = self.totals["activities"]
+        rate = activities / elapsed if elapsed else 0
+        print('{athletes} athletes, {activities} activities in {elapsed:.1f} s: '
+              '{rate:.1f} activities/s, {per_worker:.1f}/s per core over {workers} workers, '
+              '{per_cpu:.1f}/s per cpu second'.format(
+                  elapsed=elapsed, rate=rate, per_worker=rate / self.workers,
+                  workers=self.workers,
+                  per_cpu=activities / self.cpu_seconds if self.cpu_seconds else 0,
+                  **self.totals))
+        print('peak rows: {written} written, {deleted} deleted, {unchanged} unchanged; '
+              'activities: {skipped_activities} without a time stream, '
+              '{failed_activities} failed'.format(**self.totals))
+        if self.spans and activities:
+            print('worker ms per activity: ' + ', '.join(
+                '{name} {ms:.1f}'.format(name=name, ms=ms / activities)
+                for name, ms in sorted(self.spans.items())))
+        if self.failed:
+            print('athletes with failures, not checkpointed: {ids}'.format(
+                ids=", ".join(str(a) for a in sorted(self.failed))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="recompute peaks from the stored stream files")
+    parser.add_argument("--bucket", default=config.strava_api_s3_bucket)
+    parser.add_argument("--mirror", help="local directory with a copy of the bucket")
+    parser.add_argument("--athlete", type=int, action="append", dest="athlete_ids",
+                        help="only these athletes, may be repeated")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint")
+    parser.add_argument("--no-curves", dest="save_curves", action="store_false",
+                        help="leave the mean max curve files as they are")
+    parser.add_argument("--verbose", action="store_true", help="show the workers' output")
+    parser.add_argument("--backfill-value-sort", action="store_true",
+                        help="only add value_sort to existing peak rows")
+    args = parser.parse_args(argv)
+
+    if args.mirror:
+        source = ("mirror", args.mirror)
+        athletes = list_mirror(args.mirror, args.athlete_ids)
+    else:
+        source = ("bucket", args.bucket)
+        athletes = list_bucket(args.bucket, args.athlete_ids)
+    if args.backfill_value_sort:
+        updated = sum(ActivityPeak.backfill_value_sort(str(athlete_id))
+                      for athlete_id in sorted(athletes))
+        print('value_sort added to {updated} peaks of {athletes} athletes'.format(
+            updated=updated, athletes=len(athletes)))
+        return 0
+    checkpoint = Checkpoint(args.checkpoint, args.restart)
+    print('{athletes} athletes, {activities} stream files, {done} athletes already done'.format(
+        athletes=len(athletes), activities=sum(len(a) for a in athletes.values()),
+        done=sum(1 for a in athletes if checkpoint.is_done(a))))
+    ok = Repeak(source, athletes, checkpoint, max(1, args.workers),
+                save_curves=args.save_curves, verbose=args.verbose).run()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
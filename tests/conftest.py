@@ -0,0 +1,45 @@
+# the handlers and lib modules read Config when they are imported, so the
+# environment is set before any test module imports them
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_ENV = {
+    "STRAVA_AUTH_TABLE": "test-strava-auth",
+    "RECENT_ATHLETE_PEAKS_TABLE": "test-recent-athlete-peak",
+    "LEADERBOARD_TABLE": "test-leaderboard",
+    "RATE_LIMIT_TABLE": "test-rate-limit",
+    "STRAVA_API_QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/0/test-strava-api.fifo",
+    "SQS_QUEUE_URL": "https://sqs.us-east-1.amazonaws.com/0/test-backfill",
+    "RECENT_ATHLETE_PEAKS_QUEUE": "https://sqs.us-east-1.amazonaws.com/0/test-recent.fifo",
+    "PEAKS_TABLE": "test-peaks",
+    "ACTIVITIES_TABLE": "test-activities",
+    "BUCKET": "test-bucket",
+    "USER_POOL": "test-pool",
+    "USER_POOL_CLIENT_ID": "test-client",
+    "USER_POOL_ID": "us-east-1_test",
+    "COGNITO_LOGIN_URL": "https://login.example.com/login",
+    "COGNITO_URL": "https://login.example.com",
+    "URL": "http://localhost:3000/test/",
+    "STAGE": "test",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "test",
+    "AWS_SECRET_ACCESS_KEY": "test",
+    "XRAY_ENABLED": "false",
+}
+
+for name, value in TEST_ENV.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def aws(tmp_path):
+    # a fresh set of local stand-ins, installed over the module level
+    # clients and tables of everything imported so far
+    from config import Config
+    from tests.local_aws import LocalAws
+    return LocalAws(Config.instance(), str(tmp_path)).install()
@@ -0,0 +1,1193 @@
+# local stand-ins for the AWS services the pipeline runs on, close enough
+# to the real apis that the handlers run unmodified against them:
+#
+#   FsBucket      s3 client over a directory, with prefix notifications to a queue
+#   LocalSqs      sqs client holding standard and FIFO queues in memory
+#   SqliteDynamo  dynamodb resource whose tables live in one sqlite file
+#   ParameterStore  ssm client serving fixed parameters
+#   LocalAws      all of the above set up like serverless.yml, and install()
+#
+# they enforce what DynamoDB and SQS would: condition expressions, FIFO
+# ordering and deduplication, batch limits, number types and page sizes,
+# so a flow that only works locally fails here the way it would deployed.
+# the tests, the benchmarks and the end-to-end harness all run on them
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import uuid
+import zlib
+from bisect import bisect_right
+from datetime import datetime, timezone
+from threading import Lock, RLock
+
+from boto3.dynamodb.conditions import AttributeBase, ConditionBase
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGION = "us-east-1"
+# queues only the bucket notifications feed, so not in Config
+STREAMS_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/0/bench-peaks-S3-to-dynamo"
+PEAKS_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/0/bench-recent-athlete-peaks"
+# dynamodb limits
+MAX_ITEM_BYTES = 400 * 1024
+MAX_PAGE_BYTES = 1024 * 1024
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+# sqs limits
+MAX_BATCH_ENTRIES = 10
+MAX_MESSAGE_BYTES = 256 * 1024
+DEDUPLICATION_SECONDS = 5 * 60
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class NoSuchKey(ClientError):
+    def __init__(self, key):
+        super(NoSuchKey, self).__init__(
+            {"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist.",
+                       "Key": key}}, "GetObject")
+
+
+class FsBucket():
+    # objects are files under root/<bucket>/<key>. notify() mirrors the
+    # bucket's NotificationConfiguration, sending an s3 event record for
+    # every object created under a prefix
+    class exceptions():
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, root):
+        self.root = root
+        self.notifications = []
+        self.lock = Lock()
+        self.puts = 0
+        self.gets = 0
+        self.bytes_read = 0
+
+    def notify(self, prefix, sqs, queue_url):
+        self.notifications.append((prefix, sqs, queue_url))
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf8")
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so a concurrent reader never sees half a file
+        tmp = "{path}.{id}.tmp".format(path=path, id=uuid.uuid4().hex)
+        with open(tmp, "wb") as f:
+            f.write(Body)
+        os.replace(tmp, path)
+        with self.lock:
+            self.puts += 1
+        etag = hashlib.md5(Body).hexdigest()
+        for prefix, sqs, queue_url in self.notifications:
+            if Key.startswith(prefix):
+                sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(
+                    self.event_record(Bucket, Key, len(Body), etag)))
+        return {"ETag": '"{etag}"'.format(etag=etag)}
+
+    def event_record(self, bucket, key, size, etag):
+        return {"Records": [{
+            "eventVersion": "2.1",
+            "eventSource": "aws:s3",
+            "eventName": "ObjectCreated:Put",
+            "eventTime": datetime.now(timezone.utc).isoformat(),
+            "s3": {
+                "bucket": {"name": bucket, "arn": "arn:aws:s3:::{name}".format(name=bucket)},
+                "object": {"key": key, "size": size, "eTag": etag},
+            },
+        }]}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        path = self.path(Bucket, Key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise NoSuchKey(Key)
+        total = len(data)
+        response = {}
+        if Range:
+            start, end = Range[len("bytes="):].split("-")
+            start = int(start)
+            end = total - 1 if end == "" else min(int(end), total - 1)
+            if start >= total:
+                raise client_error("InvalidRange", "The requested range is not satisfiable",
+                                   "GetObject")
+            data = data[start:end + 1]
+            response["ContentRange"] = "bytes {start}-{end}/{total}".format(
+                start=start, end=end, total=total)
+        with self.lock:
+            self.gets += 1
+            self.bytes_read += len(data)
+        response.update(
+            Body=StreamingBody(io.BytesIO(data), len(data)),
+            ContentLength=len(data),
+            LastModified=datetime.fromtimestamp(os.path.getmtime(path), timezone.utc),
+        )
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, StartAfter=None,
+                        MaxKeys=1000, **kwargs):
+        # keys in utf8 order, paged like s3 with an opaque continuation token
+        base = os.path.join(self.root, Bucket)
+        keys = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), base).replace(os.sep, "/")
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+        after = ContinuationToken or StartAfter
+        if after:
+            keys = [k for k in keys if k > after]
+        page = keys[0:MaxKeys]
+        response = {
+            "Name": Bucket,
+            "Prefix": Prefix,
+            "KeyCount": len(page),
+            "MaxKeys": MaxKeys,
+            "IsTruncated": len(keys) > MaxKeys,
+            "Contents": [{
+                "Key": key,
+                "Size": os.path.getsize(self.path(Bucket, key)),
+                "LastModified": datetime.fromtimestamp(
+                    os.path.getmtime(self.path(Bucket, key)), timezone.utc),
+            } for key in page],
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+
+class Message():
+    def __init__(self, body, attributes, group_id, deduplication_id, visible_at):
+        self.message_id = str(uuid.uuid4())
+        self.body = body
+        self.attributes = attributes or {}
+        self.group_id = group_id
+        self.deduplication_id = deduplication_id
+        self.sent_at = time.time()
+        self.visible_at = visible_at
+        self.first_received_at = None
+        self.receive_count = 0
+        self.receipt_handle = None
+        self.in_flight = False
+
+    def record(self, arn, region):
+        # the shape lambda hands an sqs triggered handler
+        attributes = {
+            "ApproximateReceiveCount": str(self.receive_count),
+            "SentTimestamp": str(int(self.sent_at * 1000)),
+            "ApproximateFirstReceiveTimestamp": str(int(self.first_received_at * 1000)),
+        }
+        if self.group_id is not None:
+            attributes["MessageGroupId"] = self.group_id
+            attributes["MessageDeduplicationId"] = self.deduplication_id
+        return {
+            "messageId": self.message_id,
+            "receiptHandle": self.receipt_handle,
+            "body": self.body,
+            "attributes": attributes,
+            "messageAttributes": {
+                name: {"stringValue": value.get("StringValue"), "dataType": value["DataType"],
+                       "stringListValues": [], "binaryListValues": []}
+                for name, value in self.attributes.items()
+            },
+            "md5OfBody": hashlib.md5(self.body.encode("utf8")).hexdigest(),
+            "eventSource": "aws:sqs",
+            "eventSourceARN": arn,
+            "awsRegion": region,
+        }
+
+
+class Queue():
+    def __init__(self, name, url, fifo=False, content_deduplication=False, delay_seconds=0,
+                 max_receives=3):
+        self.name = name
+        self.url = url
+        self.fifo = fifo
+        self.content_deduplication = content_deduplication
+        self.delay_seconds = delay_seconds
+        self.max_receives = max_receives
+        self.messages = []
+        self.dead_letters = []
+        self.deduplication = {}
+        self.sent = 0
+        self.deduplicated = 0
+
+    @property
+    def arn(self):
+        # https://sqs.{region}.amazonaws.com/{account}/{name}
+        _, _, host, account, name = self.url.split("/")[0:5]
+        return "arn:aws:sqs:{region}:{account}:{name}".format(
+            region=host.split(".")[1], account=account, name=name)
+
+    def depth(self, now):
+        visible = delayed = in_flight = 0
+        for message in self.messages:
+            if message.in_flight:
+                in_flight += 1
+            elif message.visible_at > now:
+                delayed += 1
+            else:
+                visible += 1
+        return {"visible": visible, "delayed": delayed, "in_flight": in_flight}
+
+
+class LocalSqs():
+    # queues by name, so the url a handler rebuilds from eventSourceARN
+    # (see SqsBatch.queue_url) finds the same queue. receive() and release()
+    # are the harness's side of the lambda event source mapping
+    def __init__(self, region="us-east-1"):
+        self.region = region
+        self.queues = {}
+        self.lock = Lock()
+
+    def create_queue(self, url, **attributes):
+        name = url.rstrip("/").split("/")[-1]
+        self.queues[name] = Queue(name, url, fifo=name.endswith(".fifo"), **attributes)
+        return self.queues[name]
+
+    def queue(self, url):
+        name = url.rstrip("/").split("/")[-1]
+        if name not in self.queues:
+            raise client_error("AWS.SimpleQueueService.NonExistentQueue",
+                               "The specified queue does not exist.", "SendMessage")
+        return self.queues[name]
+
+    def enqueue(self, queue, now, MessageBody, MessageAttributes=None, DelaySeconds=None,
+                MessageGroupId=None, MessageDeduplicationId=None, **kwargs):
+        size = len(MessageBody.encode("utf8")) + sum(
+            len(name) + len(value.get("StringValue", "")) + len(value["DataType"])
+            for name, value in (MessageAttributes or {}).items())
+        if size > MAX_MESSAGE_BYTES:
+            raise client_error("InvalidParameterValue",
+                               "Message must be shorter than 262144 bytes.", "SendMessage")
+        delay = queue.delay_seconds
+        if queue.fifo:
+            if MessageGroupId is None:
+                raise client_error("MissingParameter",
+                                   "The request must contain the parameter MessageGroupId.",
+                                   "SendMessage")
+            if DelaySeconds:
+                raise client_error("InvalidParameterValue",
+                                   "Value {delay} for parameter DelaySeconds is invalid. "
+                                   "Reason: FIFO queues don't support per-message delays.".format(
+                                       delay=DelaySeconds), "SendMessage")
+            if MessageDeduplicationId is None:
+                if not queue.content_deduplication:
+                    raise client_error(
+                        "InvalidParameterValue",
+                        "The queue should either have ContentBasedDeduplication enabled "
+                        "or MessageDeduplicationId provided explicitly", "SendMessage")
+                MessageDeduplicationId = hashlib.sha256(MessageBody.encode("utf8")).hexdigest()
+            # a duplicate within the window is accepted and dropped
+            if queue.deduplication.get(MessageDeduplicationId, 0) > now - DEDUPLICATION_SECONDS:
+                queue.deduplicated += 1
+                return hashlib.md5(MessageBody.encode("utf8")).hexdigest(), None
+            queue.deduplication[MessageDeduplicationId] = now
+        elif DelaySeconds is not None:
+            delay = DelaySeconds
+        message = Message(MessageBody, MessageAttributes, MessageGroupId,
+                          MessageDeduplicationId, now + delay)
+        queue.messages.append(message)
+        queue.sent += 1
+        return hashlib.md5(MessageBody.encode("utf8")).hexdigest(), message.message_id
+
+    def send_message(self, QueueUrl, **message):
+        with self.lock:
+            md5, message_id = self.enqueue(self.queue(QueueUrl), time.time(), **message)
+        return {"MD5OfMessageBody": md5, "MessageId": message_id or str(uuid.uuid4())}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if not Entries:
+            raise client_error("AWS.SimpleQueueService.EmptyBatchRequest",
+                               "There should be at least one SendMessageBatchRequestEntry "
+                               "in the request.", "SendMessageBatch")
+        if len(Entries) > MAX_BATCH_ENTRIES:
+            raise client_error("AWS.SimpleQueueService.TooManyEntriesInBatchRequest",
+                               "Maximum number of entries per request are 10.",
+                               "SendMessageBatch")
+        if len(set(e["Id"] for e in Entries)) != len(Entries):
+            raise client_error("AWS.SimpleQueueService.BatchEntryIdsNotDistinct",
+                               "Id must be distinct among batch entries.", "SendMessageBatch")
+        successful, failed = [], []
+        with self.lock:
+            queue = self.queue(QueueUrl)
+            now = time.time()
+            for entry in Entries:
+                entry = dict(entry)
+                entry_id = entry.pop("Id")
+                try:
+                    md5, message_id = self.enqueue(queue, now, **entry)
+                except ClientError as e:
+                    failed.append({"Id": entry_id, "SenderFault": True,
+                                   "Code": e.response["Error"]["Code"],
+                                   "Message": e.response["Error"]["Message"]})
+                    continue
+                successful.append({"Id": entry_id, "MD5OfMessageBody": md5,
+                                   "MessageId": message_id or str(uuid.uuid4())})
+        return {"Successful": successful, "Failed": failed}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self.lock:
+            if not self.delete(self.queue(QueueUrl), ReceiptHandle):
+                raise client_error("ReceiptHandleIsInvalid",
+                                   "The input receipt handle is invalid.", "DeleteMessage")
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        with self.lock:
+            queue = self.queue(QueueUrl)
+            for entry in Entries:
+                if self.delete(queue, entry["ReceiptHandle"]):
+                    successful.append({"Id": entry["Id"]})
+                else:
+                    failed.append({"Id": entry["Id"], "SenderFault": True,
+                                   "Code": "ReceiptHandleIsInvalid",
+                                   "Message": "The input receipt handle is invalid."})
+        return {"Successful": successful, "Failed": failed}
+
+    def delete(self, queue, receipt_handle):
+        for i, message in enumerate(queue.messages):
+            if message.in_flight and message.receipt_handle == receipt_handle:
+                del queue.messages[i]
+                return True
+        return False
+
+    def receive(self, url, max_messages):
+        # visible messages oldest first. a FIFO group with a message in
+        # flight or still delayed is held back, so groups stay in order
+        with self.lock:
+            queue = self.queue(url)
+            now = time.time()
+            blocked = set()
+            received = []
+            for message in queue.messages:
+                if len(received) >= max_messages:
+                    break
+                if queue.fifo and message.group_id in blocked:
+                    continue
+                if message.in_flight or message.visible_at > now:
+                    if queue.fifo:
+                        blocked.add(message.group_id)
+                    continue
+                message.in_flight = True
+                message.receive_count += 1
+                message.receipt_handle = uuid.uuid4().hex
+                if message.first_received_at is None:
+                    message.first_received_at = now
+                received.append(message)
+            return received
+
+    def release(self, url, messages, delay):
+        # the visibility timeout running out on messages a handler didn't
+        # delete. past max_receives they go to the queue's dead letters
+        with self.lock:
+            queue = self.queue(url)
+            now = time.time()
+            for message in messages:
+                if message not in queue.messages or not message.in_flight:
+                    continue
+                message.in_flight = False
+                message.visible_at = now + delay
+                if message.receive_count >= queue.max_receives:
+                    queue.messages.remove(message)
+                    queue.dead_letters.append(message)
+
+    def next_visible_at(self):
+        with self.lock:
+            waiting = [m.visible_at for q in self.queues.values() for m in q.messages
+                       if not m.in_flight]
+            return min(waiting) if waiting else None
+
+    def depth(self):
+        with self.lock:
+            now = time.time()
+            return {name: queue.depth(now) for name, queue in self.queues.items()}
+
+
+class ParameterStore():
+    # ssm client, enough for Config.fetch_secrets
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.calls = 0
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self.calls += 1
+        return {
+            "Parameters": [{"Name": n, "Value": self.parameters[n]}
+                           for n in Names if n in self.parameters],
+            "InvalidParameters": [n for n in Names if n not in self.parameters],
+        }
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.calls += 1
+        if Name not in self.parameters:
+            raise client_error("ParameterNotFound", Name, "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+
+# condition and update expressions. both the strings handlers pass and
+# boto3 condition objects are turned into the same tree:
+#
+#   ("path", name) ("value", v) ("size", operand)
+#   ("cmp", op, a, b) ("between", a, lo, hi) ("in", a, [operands])
+#   ("fn", name, [operands]) ("AND", a, b) ("OR", a, b) ("NOT", a)
+#
+# paths are top level attribute names only, the handlers don't use nested ones
+TOKEN = re.compile(r"\s*(<>|<=|>=|[=<>(),+-]|[#:]?[A-Za-z_][\w.]*|\d+)")
+COMPARATORS = ("=", "<>", "<", "<=", ">", ">=")
+FUNCTIONS = ("attribute_exists", "attribute_not_exists", "attribute_type", "begins_with",
+             "contains")
+
+
+class ExpressionParser():
+    def __init__(self, expression, names=None, values=None):
+        self.tokens = TOKEN.findall(expression)
+        if "".join(self.tokens) != re.sub(r"\s+", "", expression):
+            raise client_error("ValidationException",
+                               "Invalid expression: {e}".format(e=expression), "Expression")
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+        self.used_names = set()
+        self.used_values = set()
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise client_error("ValidationException", "Invalid expression: unexpected end",
+                               "Expression")
+        self.position += 1
+        return token
+
+    def expect(self, token):
+        if self.next() != token:
+            raise client_error("ValidationException",
+                               "Invalid expression: expected {t}".format(t=token), "Expression")
+
+    def keyword(self, word):
+        token = self.peek()
+        return token is not None and token.upper() == word
+
+    def condition(self):
+        tree = self.or_condition()
+        if self.peek() is not None:
+            raise client_error("ValidationException", "Invalid expression: unexpected {t}".format(
+                t=self.peek()), "Expression")
+        return tree
+
+    def or_condition(self):
+        left = self.and_condition()
+        while self.keyword("OR"):
+            self.next()
+            left = ("OR", left, self.and_condition())
+        return left
+
+    def and_condition(self):
+        left = self.not_condition()
+        while self.keyword("AND"):
+            self.next()
+            left = ("AND", left, self.not_condition())
+        return left
+
+    def not_condition(self):
+        if self.keyword("NOT"):
+            self.next()
+            return ("NOT", self.not_condition())
+        return self.comparison()
+
+    def comparison(self):
+        if self.peek() == "(":
+            self.next()
+            tree = self.or_condition()
+            self.expect(")")
+            return tree
+        if self.peek() in FUNCTIONS and self.peek(1) == "(":
+            name = self.next()
+            return ("fn", name, self.arguments())
+        left = self.operand()
+        if self.peek() in COMPARATORS:
+            return ("cmp", self.next(), left, self.operand())
+        if self.keyword("BETWEEN"):
+            self.next()
+            low = self.operand()
+            if not self.keyword("AND"):
+                raise client_error("ValidationException", "Invalid BETWEEN", "Expression")
+            self.next()
+            return ("between", left, low, self.operand())
+        if self.keyword("IN"):
+            self.next()
+            return ("in", left, self.arguments())
+        raise client_error("ValidationException", "Invalid expression near {t}".format(
+            t=self.peek()), "Expression")
+
+    def arguments(self):
+        self.expect("(")
+        arguments = [self.value_operand()]
+        while self.peek() == ",":
+            self.next()
+            arguments.append(self.value_operand())
+        self.expect(")")
+        return arguments
+
+    def operand(self):
+        token = self.peek()
+        if token == "size" and self.peek(1) == "(":
+            self.next()
+            return ("size", self.arguments()[0])
+        if token in ("if_not_exists", "list_append") and self.peek(1) == "(":
+            self.next()
+            return ("fn", token, self.arguments())
+        token = self.next()
+        if token.startswith(":"):
+            if token not in self.values:
+                raise client_error("ValidationException",
+                                   "An expression attribute value used in expression is not "
+                                   "defined; attribute value: {t}".format(t=token), "Expression")
+            self.used_values.add(token)
+            return ("value", self.values[token])
+        if token.startswith("#"):
+            if token not in self.names:
+                raise client_error("ValidationException",
+                                   "An expression attribute name used in the document path is "
+                                   "not defined; attribute name: {t}".format(t=token),
+                                   "Expression")
+            self.used_names.add(token)
+            return ("path", self.names[token])
+        return ("path", token)
+
+    def value_operand(self):
+        # an update value may be `a + b`
+        left = self.operand()
+        if self.peek() in ("+", "-"):
+            return ("arith", self.next(), left, self.operand())
+        return left
+
+    def update(self):
+        actions = []
+        while self.peek() is not None:
+            action = self.next().upper()
+            if action not in ("SET", "REMOVE", "ADD", "DELETE"):
+                raise client_error("ValidationException", "Invalid UpdateExpression: {t}".format(
+                    t=action), "UpdateItem")
+            while True:
+                path = self.operand()
+                if action == "SET":
+                    self.expect("=")
+                    actions.append((action, path[1], self.value_operand()))
+                elif action == "REMOVE":
+                    actions.append((action, path[1], None))
+                else:
+                    actions.append((action, path[1], self.operand()))
+                if self.peek() != ",":
+                    break
+                self.next()
+        return actions
+
+    def projection(self):
+        paths = [self.operand()[1]]
+        while self.peek() == ",":
+            self.next()
+            paths.append(self.operand()[1])
+        return paths
+
+
+def condition_tree(condition):
+    # a boto3 Key(...) / Attr(...) condition as an expression tree
+    expression = condition.get_expression()
+    operator = expression["operator"]
+    operands = [condition_tree(v) if isinstance(v, ConditionBase)
+                else ("path", v.name) if isinstance(v, AttributeBase)
+                else ("value", v) for v in expression["values"]]
+    if operator in ("AND", "OR"):
+        return (operator, operands[0], operands[1])
+    if operator == "NOT":
+        return ("NOT", operands[0])
+    if operator in COMPARATORS:
+        return ("cmp", operator, operands[0], operands[1])
+    if operator == "BETWEEN":
+        return ("between", operands[0], operands[1], operands[2])
+    if operator == "IN":
+        return ("in", operands[0], [("value", v) for v in operands[1][1]])
+    return ("fn", operator, operands)
+
+
+def normalize(value):
+    # what the value reads back as once stored: ints become Decimal and
+    # floats are refused, as boto3 does
+    return deserializer.deserialize(serializer.serialize(value))
+
+
+def kind(value):
+    return serializer.serialize(value).popitem()[0]
+
+
+MISSING = object()
+
+
+def resolve(operand, item):
+    tag = operand[0]
+    if tag == "path":
+        return item.get(operand[1], MISSING)
+    if tag == "value":
+        return operand[1]
+    if tag == "size":
+        value = resolve(operand[1], item)
+        return MISSING if value is MISSING else normalize(len(value))
+    if tag == "arith":
+        left, right = resolve(operand[2], item), resolve(operand[3], item)
+        if left is MISSING or right is MISSING:
+            raise client_error("ValidationException",
+                               "The provided expression refers to an attribute that does not "
+                               "exist in the item", "UpdateItem")
+        return left + right if operand[1] == "+" else left - right
+    if tag == "fn" and operand[1] == "if_not_exists":
+        value = resolve(operand[2][0], item)
+        return resolve(operand[2][1], item) if value is MISSING else value
+    if tag == "fn" and operand[1] == "list_append":
+        return list(resolve(operand[2][0], item)) + list(resolve(operand[2][1], item))
+    raise client_error("ValidationException", "Unsupported operand {o}".format(o=tag),
+                       "Expression")
+
+
+def compare(op, left, right):
+    # values of different types never compare, except as not equal
+    if left is MISSING or right is MISSING or kind(left) != kind(right):
+        return op == "<>" and left is not MISSING
+    return {
+        "=": lambda: left == right, "<>": lambda: left != right,
+        "<": lambda: left < right, "<=": lambda: left <= right,
+        ">": lambda: left > right, ">=": lambda: left >= right,
+    }[op]()
+
+
+def evaluate(tree, item):
+    tag = tree[0]
+    if tag == "AND":
+        return evaluate(tree[1], item) and evaluate(tree[2], item)
+    if tag == "OR":
+        return evaluate(tree[1], item) or evaluate(tree[2], item)
+    if tag == "NOT":
+        return not evaluate(tree[1], item)
+    if tag == "cmp":
+        return compare(tree[1], resolve(tree[2], item), resolve(tree[3], item))
+    if tag == "between":
+        value = resolve(tree[1], item)
+        return compare(">=", value, resolve(tree[2], item)) and \
+            compare("<=", value, resolve(tree[3], item))
+    if tag == "in":
+        value = resolve(tree[1], item)
+        return any(compare("=", value, resolve(o, item)) for o in tree[2])
+    name, operands = tree[1], tree[2]
+    if name == "attribute_exists":
+        return operands[0][1] in item
+    if name == "attribute_not_exists":
+        return operands[0][1] not in item
+    value = resolve(operands[0], item)
+    if value is MISSING:
+        return False
+    if name == "begins_with":
+        prefix = resolve(operands[1], item)
+        return kind(value) == kind(prefix) and value.startswith(prefix)
+    if name == "contains":
+        return resolve(operands[1], item) in value
+    if name == "attribute_type":
+        return kind(value) == resolve(operands[1], item)
+    raise client_error("ValidationException", "Unsupported function {f}".format(f=name),
+                       "Expression")
+
+
+def encode(item):
+    return json.dumps({k: serializer.serialize(v) for k, v in item.items()}, sort_keys=True)
+
+
+def decode(text):
+    return {k: deserializer.deserialize(v) for k, v in json.loads(text).items()}
+
+
+def encode_key(value):
+    return json.dumps(serializer.serialize(value), sort_keys=True)
+
+
+class SqliteBatchWriter():
+    # buffers 25 writes per BatchWriteItem like boto3's batch_writer, and
+    # like DynamoDB refuses a batch that names the same key twice unless
+    # overwrite_by_pkeys is given, which keeps the last write per key
+    def __init__(self, table, overwrite_by_pkeys=None):
+        self.table = table
+        self.overwrite_by_pkeys = overwrite_by_pkeys
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        while self.buffer:
+            self.flush()
+        return False
+
+    def put_item(self, Item):
+        self.add(("put", normalize(Item)))
+
+    def delete_item(self, Key):
+        self.add(("delete", normalize(Key)))
+
+    def add(self, request):
+        if self.overwrite_by_pkeys:
+            key = self.table.key(request[1])
+            self.buffer = [r for r in self.buffer if self.table.key(r[1]) != key]
+        self.buffer.append(request)
+        if len(self.buffer) >= BATCH_WRITE_SIZE:
+            self.flush()
+
+    def flush(self):
+        batch, self.buffer = self.buffer[0:BATCH_WRITE_SIZE], self.buffer[BATCH_WRITE_SIZE:]
+        keys = [self.table.key(r[1]) for r in batch]
+        if len(set(keys)) != len(keys):
+            raise client_error("ValidationException",
+                               "Provided list of item keys contains duplicates",
+                               "BatchWriteItem")
+        self.table.write_batch(batch)
+
+
+class SqliteTable():
+    # one sqlite table per dynamodb table, items stored in dynamodb's own
+    # attribute value json. indexes maps a GSI name to its (hash, range)
+    def __init__(self, store, name, hash_key, range_key=None, indexes=None):
+        self.store = store
+        self.name = self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.indexes = indexes or {}
+        self.stats = {"reads": 0, "writes": 0, "batch_writes": 0, "condition_failures": 0}
+        # sorted query results by (index, direction, condition) for the
+        # store generation they were read at, so paging through a large
+        # partition doesn't decode and sort it again for every page
+        self.query_cache = {}
+        store.execute('CREATE TABLE IF NOT EXISTS "{name}" '
+                      '(pk TEXT NOT NULL, sk TEXT NOT NULL, item TEXT NOT NULL, '
+                      'PRIMARY KEY (pk, sk))'.format(name=name))
+
+    def key(self, item):
+        for attribute in (self.hash_key, self.range_key):
+            if attribute is not None and attribute not in item:
+                raise client_error("ValidationException",
+                                   "One or more parameter values were invalid: Missing the key "
+                                   "{a} in the item".format(a=attribute), "PutItem")
+        return (encode_key(item[self.hash_key]),
+                encode_key(item[self.range_key]) if self.range_key else "")
+
+    def load(self, key):
+        row = self.store.fetchone(
+            'SELECT item FROM "{name}" WHERE pk = ? AND sk = ?'.format(name=self.name), key)
+        return decode(row[0]) if row else None
+
+    def store_item(self, item):
+        encoded = encode(item)
+        if len(encoded) > MAX_ITEM_BYTES:
+            raise client_error("ValidationException",
+                               "Item size has exceeded the maximum allowed size", "PutItem")
+        self.store.execute('INSERT OR REPLACE INTO "{name}" (pk, sk, item) VALUES (?, ?, ?)'.format(
+            name=self.name), self.key(item) + (encoded,))
+
+    def remove_item(self, key):
+        self.store.execute('DELETE FROM "{name}" WHERE pk = ? AND sk = ?'.format(
+            name=self.name), key)
+
+    def truncate(self):
+        # drops every item, for benchmarks that start each run empty
+        with self.store.lock:
+            self.store.execute('DELETE FROM "{name}"'.format(name=self.name))
+            self.store.commit()
+
+    def check(self, current, condition, names, values, operation):
+        if condition is None:
+            return
+        if isinstance(condition, str):
+            tree = ExpressionParser(condition, names, values).condition()
+        else:
+            tree = condition_tree(condition)
+        if not evaluate(tree, current or {}):
+            self.stats["condition_failures"] += 1
+            raise client_error("ConditionalCheckFailedException",
+                               "The conditional request failed", operation)
+
+    def project(self, item, projection, names):
+        if projection is None:
+            return item
+        paths = ExpressionParser(projection, names).projection()
+        return {k: v for k, v in item.items() if k in paths}
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None,
+                 ConsistentRead=False, **kwargs):
+        key = self.key(normalize(Key))
+        with self.store.lock:
+            self.stats["reads"] += 1
+            item = self.load(key)
+        if item is None:
+            return {"ResponseMetadata": {}}
+        return {"Item": self.project(item, ProjectionExpression, ExpressionAttributeNames),
+                "ResponseMetadata": {}}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        item = normalize(Item)
+        values = normalize(ExpressionAttributeValues or {})
+        with self.store.lock:
+            self.stats["writes"] += 1
+            self.check(self.load(self.key(item)), ConditionExpression,
+                       ExpressionAttributeNames, values, "PutItem")
+            self.store_item(item)
+            self.store.commit()
+        return {"ResponseMetadata": {}}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        key = self.key(normalize(Key))
+        values = normalize(ExpressionAttributeValues or {})
+        with self.store.lock:
+            self.stats["writes"] += 1
+            self.check(self.load(key), ConditionExpression,
+                       ExpressionAttributeNames, values, "DeleteItem")
+            self.remove_item(key)
+            self.store.commit()
+        return {"ResponseMetadata": {}}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ReturnValues="NONE", **kwargs):
+        key_item = normalize(Key)
+        key = self.key(key_item)
+        values = normalize(ExpressionAttributeValues or {})
+        actions = ExpressionParser(UpdateExpression, ExpressionAttributeNames, values).update()
+        with self.store.lock:
+            self.stats["writes"] += 1
+            current = self.load(key)
+            self.check(current, ConditionExpression, ExpressionAttributeNames, values,
+                       "UpdateItem")
+            before = dict(current or key_item)
+            item = dict(before)
+            # every value is computed from the item as it was before the update
+            for action, path, operand in actions:
+                if path in (self.hash_key, self.range_key):
+                    raise client_error("ValidationException",
+                                       "Cannot update attribute {p}. This attribute is part of "
+                                       "the key".format(p=path), "UpdateItem")
+                if action == "SET":
+                    item[path] = resolve(operand, before)
+                elif action == "REMOVE":
+                    item.pop(path, None)
+                elif action == "ADD":
+                    value = resolve(operand, before)
+                    if isinstance(value, set):
+                        item[path] = set(before.get(path, set())) | value
+                    else:
+                        item[path] = before.get(path, 0) + value
+                else:
+                    item[path] = set(before.get(path, set())) - resolve(operand, before)
+                    if not item[path]:
+                        del item[path]
+            self.store_item(item)
+            self.store.commit()
+        response = {"ResponseMetadata": {}}
+        if ReturnValues == "ALL_NEW":
+            response["Attributes"] = item
+        elif ReturnValues == "ALL_OLD" and current is not None:
+            response["Attributes"] = current
+        return response
+
+    def write_batch(self, batch):
+        with self.store.lock:
+            self.stats["batch_writes"] += 1
+            self.stats["writes"] += len(batch)
+            for action, item in batch:
+                if action == "put":
+                    self.store_item(item)
+                else:
+                    self.remove_item(self.key(item))
+            self.store.commit()
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return SqliteBatchWriter(self, overwrite_by_pkeys)
+
+    def sort_key(self, index_name):
+        if index_name is None:
+            return self.hash_key, self.range_key
+        if index_name not in self.indexes:
+            raise client_error("ValidationException",
+                               "The table does not have the specified index: {i}".format(
+                                   i=index_name), "Query")
+        return self.indexes[index_name]
+
+    def page(self, items, order, exclusive_start_key, limit, projection, names, key_attributes,
+             keys=None):
+        # the next page after exclusive_start_key, cut at limit items or
+        # 1MB of data, whichever comes first. keys, if given, are order()
+        # of the already sorted items
+        if exclusive_start_key is not None:
+            start = order(normalize(exclusive_start_key))
+            if keys is None:
+                keys = [order(i) for i in items]
+            items = items[bisect_right(keys, start):]
+        page, size = [], 0
+        for item in items:
+            if limit is not None and len(page) >= limit:
+                break
+            if size >= MAX_PAGE_BYTES:
+                break
+            page.append(item)
+            size += len(encode(item))
+        response = {
+            "Items": [dict(self.project(i, projection, names)) for i in page],
+            "Count": len(page),
+            "ScannedCount": len(page),
+            "ResponseMetadata": {},
+        }
+        if page and len(page) < len(items):
+            response["LastEvaluatedKey"] = {a: page[-1][a] for a in key_attributes}
+        return response
+
+    def query(self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, Limit=None,
+              ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, ConsistentRead=False, **kwargs):
+        if ConsistentRead and IndexName is not None:
+            raise client_error("ValidationException",
+                               "Consistent reads are not supported on global secondary indexes",
+                               "Query")
+        if isinstance(KeyConditionExpression, str):
+            tree = ExpressionParser(KeyConditionExpression, ExpressionAttributeNames,
+                                    normalize(ExpressionAttributeValues or {})).condition()
+        else:
+            tree = condition_tree(KeyConditionExpression)
+        index_hash, index_range = self.sort_key(IndexName)
+
+        def order(item):
+            primary = (item.get(self.hash_key), item.get(self.range_key)) \
+                if self.range_key else (item.get(self.hash_key),)
+            return (item[index_range],) + primary if index_range else primary
+        page_order = order if ScanIndexForward else (lambda i: Reverse(order(i)))
+
+        cache_key = (IndexName, ScanIndexForward, repr(tree))
+        with self.store.lock:
+            self.stats["reads"] += 1
+            generation, items, keys = self.query_cache.get(cache_key, (None, None, None))
+            if generation != self.store.generation:
+                hash_value = self.hash_equality(tree, index_hash)
+                if index_hash == self.hash_key and hash_value is not MISSING:
+                    rows = self.store.fetchall('SELECT item FROM "{name}" WHERE pk = ?'.format(
+                        name=self.name), (encode_key(hash_value),))
+                else:
+                    rows = self.store.fetchall('SELECT item FROM "{name}"'.format(name=self.name))
+                items = [decode(row[0]) for row in rows]
+                # an item without the index keys isn't in the index
+                items = [i for i in items if index_hash in i
+                         and (index_range is None or index_range in i) and evaluate(tree, i)]
+                items.sort(key=order, reverse=not ScanIndexForward)
+                keys = [page_order(i) for i in items]
+                self.query_cache[cache_key] = (self.store.generation, items, keys)
+        key_attributes = set(a for a in (self.hash_key, self.range_key, index_hash, index_range)
+                             if a is not None)
+        return self.page(items, page_order, ExclusiveStartKey, Limit, ProjectionExpression,
+                         ExpressionAttributeNames, key_attributes, keys)
+
+    def hash_equality(self, tree, attribute):
+        if tree[0] == "AND":
+            found = self.hash_equality(tree[1], attribute)
+            return found if found is not MISSING else self.hash_equality(tree[2], attribute)
+        if tree[0] == "cmp" and tree[1] == "=" and tree[2] == ("path", attribute):
+            return tree[3][1]
+        return MISSING
+
+    def scan(self, Segment=None, TotalSegments=None, ExclusiveStartKey=None, Limit=None,
+             ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        with self.store.lock:
+            self.stats["reads"] += 1
+            rows = self.store.fetchall(
+                'SELECT pk, item FROM "{name}" ORDER BY pk, sk'.format(name=self.name))
+        if TotalSegments:
+            rows = [r for r in rows if zlib.crc32(r[0].encode("utf8")) % TotalSegments == Segment]
+        items = [decode(r[1]) for r in rows]
+
+        def order(item):
+            return self.key(item)
+        key_attributes = [a for a in (self.hash_key, self.range_key) if a is not None]
+        return self.page(items, order, ExclusiveStartKey, Limit, ProjectionExpression,
+                         ExpressionAttributeNames, key_attributes)
+
+
+class Reverse():
+    # inverts the ordering of a sort tuple, for ScanIndexForward=False pages
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class SqliteDynamo():
+    # dynamodb resource over one sqlite database, shared by every thread
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.lock = RLock()
+        self.in_transaction = False
+        self.tables = {}
+        # bumped by every write, tells the query caches they are stale
+        self.generation = 0
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            self.generation += 1
+            if not self.in_transaction:
+                self.connection.execute("BEGIN")
+                self.in_transaction = True
+            self.connection.execute(sql, parameters)
+
+    def commit(self):
+        with self.lock:
+            if self.in_transaction:
+                self.connection.execute("COMMIT")
+                self.in_transaction = False
+
+    def fetchone(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchone()
+
+    def fetchall(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def create_table(self, name, hash_key, range_key=None, indexes=None):
+        self.tables[name] = SqliteTable(self, name, hash_key, range_key, indexes)
+        self.commit()
+        return self.tables[name]
+
+    def Table(self, name):
+        if name not in self.tables:
+            raise client_error("ResourceNotFoundException",
+                               "Requested resource not found: Table: {n} not found".format(n=name),
+                               "DescribeTable")
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        keys = sum(len(request["Keys"]) for request in RequestItems.values())
+        if keys > BATCH_GET_SIZE:
+            raise client_error("ValidationException",
+                               "Too many items requested for the BatchGetItem call",
+                               "BatchGetItem")
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            table_keys = [table.key(normalize(k)) for k in request["Keys"]]
+            if len(set(table_keys)) != len(table_keys):
+                raise client_error("ValidationException",
+                                   "Provided list of item keys contains duplicates",
+                                   "BatchGetItem")
+            with self.lock:
+                table.stats["reads"] += 1
+                items = [table.load(k) for k in table_keys]
+            responses[name] = [
+                table.project(i, request.get("ProjectionExpression"),
+                              request.get("ExpressionAttributeNames"))
+                for i in items if i is not None]
+        return {"Responses": responses, "UnprocessedKeys": {}, "ResponseMetadata": {}}
+
+    def stats(self):
+        return {name: dict(table.stats) for name, table in self.tables.items()}
+
+
+class LocalAws():
+    # the bucket, queues and tables of serverless.yml on the stand-ins
+    # above, named from Config, all kept under workdir. install() points
+    # the repo's module-level clients and tables at them
+    def __init__(self, config, workdir, max_receives=3):
+        self.config = config
+        self.s3 = FsBucket(os.path.join(workdir, "bucket"))
+        self.sqs = LocalSqs(REGION)
+        self.ssm = ParameterStore({"STRAVA_CLIENT_ID": "local", "STRAVA_CLIENT_SECRET": "local"})
+        self.dynamodb = SqliteDynamo(os.path.join(workdir, "tables.db"))
+
+        self.sqs.create_queue(config.backfill_athlete_queue, max_receives=max_receives)
+        self.sqs.create_queue(config.strava_api_queue_url, content_deduplication=True,
+                              max_receives=max_receives)
+        self.sqs.create_queue(config.recent_athlete_peaks_to_s3, content_deduplication=True,
+                              delay_seconds=config.peaks_recompute_quiet_seconds,
+                              max_receives=max_receives)
+        self.sqs.create_queue(STREAMS_QUEUE_URL, max_receives=max_receives)
+        self.sqs.create_queue(PEAKS_QUEUE_URL, max_receives=max_receives)
+        self.s3.notify("streams_", self.sqs, STREAMS_QUEUE_URL)
+        self.s3.notify("peaks_", self.sqs, PEAKS_QUEUE_URL)
+
+        self.strava_auth = self.dynamodb.create_table(config.strava_auth_table, "user_id")
+        self.activities = self.dynamodb.create_table(
+            config.activities_table, "athlete_id", "activity_id")
+        self.recent = self.dynamodb.create_table(
+            config.recent_athlete_peaks_table, "athlete_id", "peak_type")
+        self.leaderboard = self.dynamodb.create_table(
+            config.athlete_leaderboard_table, "athlete_id", "peak_type")
+        self.rate_limit = self.dynamodb.create_table(
+            config.rate_limit_table or "bench-rate-limit", "limiter_id")
+        self.peaks = self.dynamodb.create_table(config.athlete_peaks_table, "athlete_id", "peak_id",
+                                                indexes={
+            "peaks_type": ("athlete_id", "peak_type"),
+            "peaks_value": ("athlete_id", "value_sort"),
+        })
+
+    def install(self):
+        # every boto3 client or table a module of this repo holds at module
+        # level, found by type so new modules are picked up too. stand-ins
+        # an earlier LocalAws installed are replaced the same way
+        from lib.rate_limiter import strava_rate_limiter
+        replacements = {"S3": self.s3, "SQS": self.sqs, "SSM": self.ssm,
+                        "dynamodb.ServiceResource": self.dynamodb,
+                        "FsBucket": self.s3, "LocalSqs": self.sqs,
+                        "ParameterStore": self.ssm, "SqliteDynamo": self.dynamodb}
+        for module in list(sys.modules.values()):
+            path = getattr(module, "__file__", None) or ""
+            if not path.startswith(ROOT) or module.__name__.startswith(("benchmarks", "tests")):
+                continue
+            for name, value in list(vars(module).items()):
+                kind = type(value).__name__
+                if kind in ("dynamodb.Table", "SqliteTable"):
+                    setattr(module, name, self.dynamodb.Table(value.name))
+                elif kind in replacements:
+                    setattr(module, name, replacements[kind])
+        # the shared limiter keeps its table on the store, without
+        # RATE_LIMIT_TABLE it counts in memory
+        if getattr(strava_rate_limiter.store, "table", None) is not None:
+            strava_rate_limiter.store.table = self.rate_limit
+        self.config._ssm_client = self.ssm
+        return self
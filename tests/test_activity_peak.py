@@ -0,0 +1,95 @@
+import random
+from decimal import Decimal
+
+from lib.activity_peak import ActivityPeak
+from lib.athlete_leaderboard import AthleteLeaderboard
+
+ATHLETE_ID = "101"
+
+
+def test_encode_value_sorts_like_the_numbers():
+    rng = random.Random(13)
+    values = [0.0, -0.0, 1e-300, -1e-300, 1.0, -1.0, 1e300, -1e300, 250.5, -250.5]
+    values += [rng.uniform(-1e6, 1e6) for _ in range(500)]
+    values += [float(rng.randint(-2000, 2000)) for _ in range(500)]
+    encoded = sorted(values, key=ActivityPeak.encode_value)
+    assert encoded == sorted(values)
+    assert ActivityPeak.encode_value(-0.5) < ActivityPeak.encode_value(0) < \
+        ActivityPeak.encode_value(0.5)
+    assert ActivityPeak.encode_value(Decimal("300.25")) == ActivityPeak.encode_value(300.25)
+
+
+def peak_row(activity_id, statistic, duration, value):
+    return {
+        "peak_id": "{activity_id}_{statistic}_{duration}".format(
+            activity_id=activity_id, statistic=statistic, duration=duration),
+        "peak_type": "Ride_{statistic}_{duration}".format(
+            statistic=statistic, duration=duration),
+        "attribute": statistic,
+        "value": str(value),
+        "activity_id": str(activity_id),
+        "athlete_id": ATHLETE_ID,
+        "duration": str(duration),
+        "start_date_local": "2026-10-01T08:00:00",
+        "name": "Ride {}".format(activity_id),
+        "type": "Ride",
+        "trainer": "False",
+        "elapsed_time": 3600,
+        "distance": "30000.0",
+    }
+
+
+def test_save_skips_rows_the_digest_has(aws):
+    rows = [peak_row(1, "watts", 5, 500), peak_row(1, "watts", 60, 320)]
+    assert ActivityPeak(rows).save() == {"written": 2, "skipped": 0}
+    assert ActivityPeak(rows).save() == {"written": 0, "skipped": 2}
+
+    changed = [peak_row(1, "watts", 5, 510), peak_row(1, "watts", 60, 320)]
+    assert ActivityPeak(changed).save() == {"written": 1, "skipped": 1}
+    item = aws.peaks.get_item(Key={"athlete_id": ATHLETE_ID, "peak_id": "1_watts_5"})["Item"]
+    assert item["value"] == Decimal("510")
+    assert item["value_sort"] == ActivityPeak.value_sort("Ride_watts_5", 510)
+
+
+def test_save_writes_again_until_the_digests_are_saved(aws):
+    rows = [peak_row(1, "watts", 5, 500), peak_row(1, "watts", 60, 320)]
+    assert ActivityPeak(rows).save(save_digests=False) == {"written": 2, "skipped": 0}
+    # a retry after the caller failed before save_digests writes them again
+    activity_peak = ActivityPeak(rows)
+    assert activity_peak.save(save_digests=False) == {"written": 2, "skipped": 0}
+    activity_peak.save_digests()
+    assert ActivityPeak(rows).save() == {"written": 0, "skipped": 2}
+
+
+def test_save_keeps_the_leaderboard_in_order(aws):
+    ActivityPeak([peak_row(1, "watts", 5, 400)]).save()
+    ActivityPeak([peak_row(2, "watts", 5, 600)]).save()
+    ActivityPeak([peak_row(3, "watts", 5, 500)]).save()
+    board = AthleteLeaderboard.fetch(ATHLETE_ID)["ride_watts_5"]
+    assert [p["activity_id"] for p in board] == ["2", "3", "1"]
+
+
+def test_replace_deletes_rows_the_dataset_no_longer_has(aws):
+    ActivityPeak([peak_row(1, "watts", 5, 400), peak_row(1, "watts", 5400, 200)]).save()
+    result = ActivityPeak([peak_row(1, "watts", 5, 400)]).replace(ATHLETE_ID, ["1"])
+    assert result == {"written": 0, "deleted": 1, "skipped": 1}
+    assert ActivityPeak.peak_ids_by_activity(ATHLETE_ID) == {"1": {"1_watts_5"}}
+    assert set(AthleteLeaderboard.fetch(ATHLETE_ID)) == {"ride_watts_5"}
+
+
+def test_leaderboard_seeds_types_saved_before_the_boards(aws):
+    # peaks stored before leaderboards existed, then one new watts save
+    for row in (peak_row(1, "watts", 5, 400), peak_row(1, "heartrate", 5, 180)):
+        aws.peaks.put_item(Item=ActivityPeak.to_item(row))
+    ActivityPeak([peak_row(2, "watts", 5, 300)]).save()
+    assert set(AthleteLeaderboard.fetch(ATHLETE_ID)) == {"ride_watts_5"}
+
+    boards = ActivityPeak.get_leaderboard(ATHLETE_ID)
+    assert set(boards) == set(ActivityPeak.get_top(ATHLETE_ID)) == {
+        "ride_watts_5", "ride_heartrate_5"}
+    assert [p["peak_id"] for p in boards["ride_watts_5"]] == ["1_watts_5", "2_watts_5"]
+    # seeded once, later reads come straight from the boards
+    ActivityPeak([peak_row(3, "heartrate", 5, 190)]).save()
+    boards = ActivityPeak.get_leaderboard(ATHLETE_ID)
+    assert [p["peak_id"] for p in boards["ride_heartrate_5"]] == [
+        "3_heartrate_5", "1_heartrate_5"]
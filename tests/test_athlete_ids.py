@@ -0,0 +1,18 @@
+import pytest
+
+from lib.athlete_ids import forget_athlete_id, get_athlete_id
+
+
+def test_lookup_is_cached_until_forgotten(aws):
+    aws.strava_auth.put_item(Item={"user_id": "u-athlete-ids", "athlete_id": "101"})
+    assert get_athlete_id("u-athlete-ids") == "101"
+
+    aws.strava_auth.put_item(Item={"user_id": "u-athlete-ids", "athlete_id": "202"})
+    assert get_athlete_id("u-athlete-ids") == "101"
+    forget_athlete_id("u-athlete-ids")
+    assert get_athlete_id("u-athlete-ids") == "202"
+
+
+def test_user_without_strava_auth(aws):
+    with pytest.raises(KeyError):
+        get_athlete_id("u-no-auth")
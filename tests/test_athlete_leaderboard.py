@@ -0,0 +1,38 @@
+from decimal import Decimal
+
+from lib.athlete_leaderboard import AthleteLeaderboard, LEADERBOARD_SIZE
+
+ATHLETE_ID = "101"
+
+
+def peak(peak_id, value):
+    return {"peak_id": peak_id, "value": Decimal(value)}
+
+
+def test_merge_peaks_truncates_and_replaces_by_peak_id():
+    current = [peak("p{}".format(i), 1000 - i) for i in range(LEADERBOARD_SIZE)]
+    merged = AthleteLeaderboard.merge_peaks(current, [peak("new", 995), peak("p0", 1)])
+    assert len(merged) == LEADERBOARD_SIZE
+    assert [p["peak_id"] for p in merged[:6]] == ["p1", "p2", "p3", "p4", "p5", "new"]
+    assert "p0" not in [p["peak_id"] for p in merged]
+    assert [p["value"] for p in merged] == sorted([p["value"] for p in merged], reverse=True)
+
+
+def test_merge_seeds_a_missing_board(aws):
+    seeded = [peak("a", 400), peak("b", 380), peak("c", 360)]
+    assert AthleteLeaderboard.merge(ATHLETE_ID, "Ride_watts_5", [peak("d", 200)],
+                                    seed=lambda: seeded)
+    board = AthleteLeaderboard.fetch(ATHLETE_ID)["ride_watts_5"]
+    assert [p["peak_id"] for p in board] == ["a", "b", "c", "d"]
+
+
+def test_merge_only_writes_changes(aws):
+    AthleteLeaderboard.merge(ATHLETE_ID, "ride_watts_5", [peak("a", 400)])
+    assert not AthleteLeaderboard.merge(ATHLETE_ID, "ride_watts_5", [peak("a", 400)])
+    # seed is only for a board that doesn't exist yet
+    assert AthleteLeaderboard.merge(ATHLETE_ID, "ride_watts_5", [peak("b", 500)],
+                                    seed=lambda: [peak("x", 900)])
+    item = aws.leaderboard.get_item(
+        Key={"athlete_id": ATHLETE_ID, "peak_type": "ride_watts_5"})["Item"]
+    assert [p["peak_id"] for p in item["peaks"]] == ["b", "a"]
+    assert item["version"] == 2
@@ -0,0 +1,56 @@
+import io
+import json
+import urllib.error
+
+from lib import jwks_cache
+from lib.jwks_cache import JwksCache
+
+
+def jwks_body(*kids):
+    return json.dumps({"keys": [
+        {"kty": "oct", "kid": kid, "alg": "HS256", "k": "c2VjcmV0"} for kid in kids
+    ]}).encode("utf-8")
+
+
+class Endpoint():
+    def __init__(self, body):
+        self.body = body
+        self.calls = 0
+
+    def urlopen(self, url, timeout=None):
+        self.calls += 1
+        if isinstance(self.body, Exception):
+            raise self.body
+        return io.BytesIO(self.body)
+
+
+def test_unknown_kid_refetches(monkeypatch):
+    endpoint = Endpoint(jwks_body("a"))
+    monkeypatch.setattr(jwks_cache.urllib.request, "urlopen", endpoint.urlopen)
+    cache = JwksCache("https://example.com/jwks.json", min_refresh_interval=0)
+    assert cache.get("a") is not None
+    endpoint.body = jwks_body("a", "b")
+    assert cache.get("b") is not None
+    assert endpoint.calls == 2
+
+
+def test_failed_refetch_keeps_the_last_good_keys(monkeypatch):
+    endpoint = Endpoint(jwks_body("a"))
+    monkeypatch.setattr(jwks_cache.urllib.request, "urlopen", endpoint.urlopen)
+    cache = JwksCache("https://example.com/jwks.json", min_refresh_interval=0)
+    assert cache.get("a") is not None
+
+    endpoint.body = urllib.error.URLError("timed out")
+    assert cache.get("b") is None
+    endpoint.body = b"<html>bad gateway</html>"
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+
+def test_failed_fetch_waits_out_the_refresh_interval(monkeypatch):
+    endpoint = Endpoint(urllib.error.URLError("timed out"))
+    monkeypatch.setattr(jwks_cache.urllib.request, "urlopen", endpoint.urlopen)
+    cache = JwksCache("https://example.com/jwks.json", min_refresh_interval=60)
+    assert cache.get("a") is None
+    assert cache.get("a") is None
+    assert endpoint.calls == 1
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from lib.mean_max_curve import MeanMaxCurve
+from lib.peak_engine import calc_peaks, curve_durations, mean_max_curve
+
+
+def curves():
+    rng = np.random.default_rng(5)
+    return MeanMaxCurve.from_streams({
+        "watts": rng.integers(0, 800, 3000),
+        "heartrate": rng.normal(140, 10, 3000),
+        "velocity_smooth": None,
+    }, extra=(300, 1200))
+
+
+def test_round_trip():
+    original = curves()
+    restored = MeanMaxCurve.from_bytes(original.to_bytes())
+    assert set(restored.curves) == {"watts", "heartrate"}
+    for statistic, (durations, values) in original.curves.items():
+        restored_durations, restored_values = restored.curves[statistic]
+        assert restored_durations.tolist() == durations.tolist()
+        # values are stored as float32
+        assert restored_values == pytest.approx(values, rel=1e-6)
+
+
+def test_value_at_is_exact_at_stored_durations():
+    rng = np.random.default_rng(5)
+    watts = rng.integers(0, 800, 3000)
+    curve = MeanMaxCurve.from_streams({"watts": watts}, extra=(300, 1200))
+    peaks = calc_peaks([1, 300, 1200, 3000], watts, "a1")
+    for duration, peak in peaks.items():
+        assert curve.value_at("watts", duration) == pytest.approx(peak)
+    assert curve.value_at("watts", 3001) is None
+    assert curve.value_at("watts", 0) is None
+    assert curve.value_at("cadence", 60) is None
+
+
+def test_rejects_other_files():
+    with pytest.raises(ValueError):
+        MeanMaxCurve.from_bytes(b"STRM\x01\x00\x00")
+
+
+def test_mean_max_curve_matches_calc_peaks():
+    rng = np.random.default_rng(3)
+    stream = rng.integers(0, 900, 4000)
+    durations, values = mean_max_curve(stream, extra=(300, 1200))
+    assert durations[0] == 1 and durations[-1] == len(stream)
+    assert 300 in durations and 1200 in durations
+    peaks = calc_peaks([int(d) for d in durations], stream, "a1")
+    for duration, value in zip(durations, values):
+        assert value == pytest.approx(peaks[int(duration)])
+
+
+def test_curve_durations_dense_then_sparse():
+    durations = curve_durations(7200)
+    assert list(durations[:60]) == list(range(1, 61))
+    assert (np.diff(durations) > 0).all()
+    assert durations[-1] == 7200
+    assert len(durations) < 200
+    assert len(curve_durations(0)) == 0
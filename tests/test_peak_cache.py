@@ -0,0 +1,35 @@
+from lib.athlete_stamp import AthleteStamp
+from lib.peak_cache import PeakCache
+
+ATHLETE_ID = "101"
+
+
+def counting_loader(calls):
+    def loader():
+        calls.append(1)
+        return "body {}".format(len(calls))
+    return loader
+
+
+def test_fresh_stamp_is_not_cached(aws):
+    cache = PeakCache(AthleteStamp.PEAKS, ttl=0, settle=60)
+    calls = []
+    AthleteStamp.touch(ATHLETE_ID, AthleteStamp.PEAKS)
+    first, etag, status = cache.get(ATHLETE_ID, ("graph",), counting_loader(calls))
+    assert status == "BYPASS"
+    second, _, status = cache.get(ATHLETE_ID, ("graph",), counting_loader(calls),
+                                  client_etag=etag)
+    # neither served from the cache nor a 304 for the body read first
+    assert (first, second, status) == ("body 1", "body 2", "BYPASS")
+
+
+def test_settled_stamp_is_cached(aws):
+    cache = PeakCache(AthleteStamp.PEAKS, ttl=0, settle=60)
+    calls = []
+    AthleteStamp.touch(ATHLETE_ID, AthleteStamp.PEAKS, AthleteStamp.now() - 61000)
+    assert cache.get(ATHLETE_ID, ("graph",), counting_loader(calls))[2] == "MISS"
+    value, etag, status = cache.get(ATHLETE_ID, ("graph",), counting_loader(calls))
+    assert (value, status, len(calls)) == ("body 1", "REVALIDATED", 1)
+    other = PeakCache(AthleteStamp.PEAKS, ttl=0, settle=60)
+    assert other.get(ATHLETE_ID, ("graph",), counting_loader(calls),
+                     client_etag=etag) == (None, etag, "REVALIDATED")
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from lib.peak_engine import calc_peaks
+
+DURATIONS = [1, 5, 60, 300, 600, 1200, 3600, 5400]
+
+
+def baseline_calc_peak(num_seconds, data_stream, activity_id):
+    # process_streams.calc_peak before the prefix sum engine, the reference
+    # calc_peaks has to keep matching
+    if len(data_stream) == 0:
+        return 0
+    if num_seconds > len(data_stream):
+        return None
+    sums = []
+    for w in range(len(data_stream)):
+        if w + num_seconds > len(data_stream):
+            break
+
+        try:
+            sums.append(sum(data_stream[w: w + num_seconds]))
+        except:  # noqa: E722
+            print("unable to sum datastream for {}".format(activity_id))
+            return 0
+    peak_total = sorted(sums)[-1]
+    return peak_total / num_seconds
+
+
+def random_streams():
+    rng = np.random.default_rng(11)
+    for length in (1, 4, 59, 301, 1500):
+        yield [int(v) for v in rng.integers(0, 1200, length)]
+        yield [float(v) for v in rng.normal(150, 40, length)]
+    yield [0] * 400
+    yield [-3, 5, -2, 8, 0, 1]
+
+
+@pytest.mark.parametrize("stream", list(random_streams()), ids=lambda s: str(len(s)))
+def test_calc_peaks_matches_baseline(stream):
+    durations = [d for d in DURATIONS if d <= 600] + [len(stream), len(stream) + 1]
+    peaks = calc_peaks(durations, stream, "a1")
+    for duration in durations:
+        expected = baseline_calc_peak(duration, stream, "a1")
+        if expected is None:
+            assert peaks[duration] is None
+        else:
+            assert peaks[duration] == pytest.approx(expected, rel=1e-9, abs=1e-9)
+
+
+def test_calc_peaks_edge_cases():
+    assert calc_peaks([5, 60], [], "a1") == {5: 0, 60: 0}
+    assert calc_peaks([5], None, "a1") == {5: None}
+    # a stream with missing samples can't be summed, like the baseline
+    assert calc_peaks([1, 2], [100, None, 200], "a1") == {
+        1: baseline_calc_peak(1, [100, None, 200], "a1"),
+        2: baseline_calc_peak(2, [100, None, 200], "a1"),
+    }
+    assert calc_peaks([1], np.array([1.0, np.nan]), "a1") == {1: 0}
+
+
+def test_calc_peaks_takes_numpy_streams():
+    stream = np.arange(100, dtype=np.int32)
+    assert calc_peaks([10], stream, "a1") == {10: pytest.approx(94.5)}
+
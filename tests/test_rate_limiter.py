@@ -0,0 +1,79 @@
+import pytest
+
+from lib.rate_limiter import (
+    LONG_WINDOW, SHORT_WINDOW, DynamoRateLimitStore, LocalRateLimitStore,
+    RateLimitExceeded, StravaRateLimiter, window_starts,
+)
+
+DAY = 20000 * LONG_WINDOW
+
+
+class Clock():
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture(params=["dynamo", "local"])
+def store(request, aws):
+    if request.param == "local":
+        return LocalRateLimitStore()
+    store = DynamoRateLimitStore(aws.rate_limit.name)
+    store.table = aws.rate_limit
+    return store
+
+
+def test_window_starts():
+    assert window_starts(DAY + SHORT_WINDOW + 10) == (DAY + SHORT_WINDOW, DAY)
+
+
+def test_short_window_rolls_over(store):
+    clock = Clock(DAY + 10)
+    limiter = StravaRateLimiter(store, short_limit=3, long_limit=100,
+                                clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        assert limiter.acquire() == 0
+    # the fourth request waits for the next quarter hour
+    assert limiter.acquire() == SHORT_WINDOW - 10
+    usage = store.usage("strava")
+    assert int(usage["short_window"]) == DAY + SHORT_WINDOW
+    assert int(usage["short_count"]) == 1
+    assert int(usage["long_count"]) == 4
+
+
+def test_long_window_rolls_over(store):
+    clock = Clock(DAY + LONG_WINDOW - 60)
+    limiter = StravaRateLimiter(store, short_limit=10, long_limit=2,
+                                clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter.acquire() == 60
+    usage = store.usage("strava")
+    assert int(usage["long_window"]) == DAY + LONG_WINDOW
+    assert int(usage["long_count"]) == 1
+    assert int(usage["short_count"]) == 1
+
+
+def test_max_wait_gives_up(store):
+    clock = Clock(DAY)
+    limiter = StravaRateLimiter(store, short_limit=1, long_limit=10, max_wait=60,
+                                clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire()
+
+
+def test_headers_raise_the_counts(store):
+    clock = Clock(DAY)
+    limiter = StravaRateLimiter(store, short_limit=600, long_limit=30000,
+                                clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    limiter({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,500"})
+    assert limiter.short_limit == 100
+    assert int(store.usage("strava")["long_count"]) == 500
+    assert limiter.acquire() == SHORT_WINDOW
@@ -0,0 +1,41 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from config import Config
+from lib.athlete_stamp import AthleteStamp
+from lib.recent_athlete_peak import RecentAthletePeak
+from lib.sqs_producer import SqsBatchProducer, SqsProducerError
+
+config = Config.instance()
+
+ATHLETE_ID = "101"
+
+
+def pending_at(athlete_id):
+    return AthleteStamp.fetch(athlete_id, AthleteStamp.RECOMPUTE_PENDING)
+
+
+def test_enqueue_claims_once(aws):
+    assert RecentAthletePeak.enqueue(ATHLETE_ID)
+    assert pending_at(ATHLETE_ID)
+    assert not RecentAthletePeak.enqueue(ATHLETE_ID)
+    assert RecentAthletePeak.enqueue(ATHLETE_ID, force=True)
+
+
+def test_enqueue_releases_the_claim_when_the_send_fails(aws):
+    del aws.sqs.queues[config.recent_athlete_peaks_to_s3.split("/")[-1]]
+    with pytest.raises(ClientError):
+        RecentAthletePeak.enqueue(ATHLETE_ID)
+    assert not pending_at(ATHLETE_ID)
+
+
+def test_producer_releases_the_claims_it_could_not_send(aws):
+    producer = SqsBatchProducer(config.recent_athlete_peaks_to_s3,
+                                on_undelivered=RecentAthletePeak.release)
+    assert RecentAthletePeak.enqueue(ATHLETE_ID, producer=producer)
+    assert RecentAthletePeak.enqueue("102", producer=producer)
+    del aws.sqs.queues[config.recent_athlete_peaks_to_s3.split("/")[-1]]
+    with pytest.raises(SqsProducerError):
+        producer.close()
+    assert not pending_at(ATHLETE_ID)
+    assert not pending_at("102")
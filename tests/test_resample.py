@@ -0,0 +1,46 @@
+import numpy as np
+
+from lib.resample import TimeBase
+
+
+def test_regular_stream_is_returned_untouched():
+    watts = np.array([100, 200, 300, 400])
+    resampled = TimeBase([0, 1, 2, 3]).resample(watts)
+    assert resampled is watts
+
+
+def test_short_gaps_are_interpolated():
+    time_base = TimeBase([0, 1, 4, 5], pause_gap=30)
+    resampled = time_base.resample([100, 100, 400, 400])
+    assert list(resampled) == [100, 100, 200, 300, 400, 400]
+
+
+def test_long_gaps_are_zero_filled():
+    time_base = TimeBase([0, 1, 40, 41], pause_gap=30)
+    resampled = time_base.resample([100, 200, 300, 400])
+    assert len(resampled) == 42
+    assert list(resampled[:2]) == [100, 200]
+    assert (resampled[2:40] == 0).all()
+    assert list(resampled[40:]) == [300, 400]
+
+
+def test_pause_gap_none_interpolates_everything():
+    resampled = TimeBase([0, 10]).resample([0, 100])
+    assert list(resampled) == [float(v) for v in range(0, 101, 10)]
+
+
+def test_repeated_timestamps_are_dropped():
+    time_base = TimeBase([0, 1, 1, 2], pause_gap=30)
+    assert list(time_base.resample([10, 20, 99, 30])) == [10, 20, 30]
+
+
+def test_missing_samples_become_nan():
+    resampled = TimeBase([0, 2]).resample([100, None])
+    assert resampled[0] == 100
+    assert np.isnan(resampled[1:]).all()
+
+
+def test_stream_of_another_length_is_rejected():
+    time_base = TimeBase([0, 1, 2])
+    assert time_base.resample([1, 2]) is None
+    assert time_base.resample(None) is None
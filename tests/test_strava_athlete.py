@@ -0,0 +1,20 @@
+import time
+
+from lib.strava_athlete import StravaAthlete
+
+
+def test_save_sync_leaves_the_tokens_alone(aws):
+    expires_at = int(time.time()) + 3600
+    aws.strava_auth.put_item(Item={
+        "user_id": "u1", "athlete_id": 101, "refresh_token": "refresh-2",
+        "access_token": "access-2", "expires_at": expires_at, "last_sync_at": 0})
+    # read before a concurrent refresh saved access-2
+    athlete = StravaAthlete("u1", refresh_token="refresh-1", access_token="access-1",
+                            athlete_id=101, expires_at=expires_at - 60)
+    athlete.last_sync_at = 1700000000.5
+    athlete.save_sync()
+    item = aws.strava_auth.get_item(Key={"user_id": "u1"})["Item"]
+    assert item["access_token"] == "access-2"
+    assert item["refresh_token"] == "refresh-2"
+    assert item["expires_at"] == expires_at
+    assert item["last_sync_at"] == 1700000000
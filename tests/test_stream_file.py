@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from lib.stream_file import COLUMN_ORDER, StreamFile
+
+STREAMS = {
+    "latlng": [[51.5, -0.12], [51.6, -0.13], [51.7, -0.14]],
+    "watts": [120, 0, 350],
+    "heartrate": [140, 141, None],
+    "velocity_smooth": [5.5, 6.25, 7.0],
+    "time": [0, 1, 3],
+    "moving": [True, False, True],
+}
+
+
+def test_round_trip():
+    streams = StreamFile.from_bytes(StreamFile.to_bytes(STREAMS))
+    assert set(streams) == set(STREAMS)
+    assert streams["watts"].tolist() == STREAMS["watts"]
+    assert streams["time"].tolist() == STREAMS["time"]
+    assert streams["velocity_smooth"].tolist() == STREAMS["velocity_smooth"]
+    assert streams["latlng"].tolist() == STREAMS["latlng"]
+    assert streams["moving"].tolist() == STREAMS["moving"]
+    # missing samples come back as nan
+    assert streams["heartrate"][:2].tolist() == [140, 141]
+    assert np.isnan(streams["heartrate"][2])
+
+
+def test_hot_columns_come_first():
+    data = StreamFile.to_bytes(STREAMS)
+    header, _ = StreamFile.read_header(data)
+    names = [c["name"] for c in header["columns"]]
+    assert names[:len(COLUMN_ORDER)] == COLUMN_ORDER
+
+
+def test_only_requested_columns_are_decoded():
+    data = StreamFile.to_bytes(STREAMS)
+    assert set(StreamFile.from_bytes(data, columns=["time", "watts", "cadence"])) == {
+        "time", "watts"}
+
+
+def test_large_integers_keep_their_precision():
+    streams = StreamFile.from_bytes(StreamFile.to_bytes({"time": [0, 2 ** 40]}))
+    assert streams["time"].tolist() == [0, 2 ** 40]
+
+
+def test_rejects_other_files():
+    assert not StreamFile.is_stream_file(b"{\"time\": []}")
+    with pytest.raises(ValueError):
+        StreamFile.from_bytes(b"MMC1\x01\x00\x00\x00\x00")
@@ -0,0 +1,62 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from lib.stream_json import StreamJsonDecoder
+
+STREAMS = {
+    "latlng": [[51.5, -0.12], [51.6, -0.13], [51.7, -0.14]],
+    "watts": [120, 0, 350],
+    "heartrate": [140, 141, None],
+    "velocity_smooth": [5.5, 6.25, 7.0],
+    "time": [0, 1, 3],
+    "moving": [True, False, True],
+}
+
+
+def decode(streams, keys, chunk_size):
+    body = io.BytesIO(json.dumps(streams).encode("utf8"))
+    return StreamJsonDecoder(body, keys, chunk_size=chunk_size).decode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64 * 1024])
+def test_json_decoder_matches_json_loads(chunk_size):
+    keys = ["time", "watts", "heartrate", "latlng", "velocity_smooth"]
+    streams = decode(STREAMS, keys, chunk_size)
+    assert set(streams) == set(keys)
+    assert streams["time"].tolist() == STREAMS["time"]
+    assert streams["watts"].tolist() == STREAMS["watts"]
+    assert streams["velocity_smooth"].tolist() == STREAMS["velocity_smooth"]
+    assert streams["latlng"] == STREAMS["latlng"]
+    assert streams["heartrate"][:2].tolist() == [140, 141]
+    assert np.isnan(streams["heartrate"][2])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 64 * 1024])
+def test_json_decoder_skips_unrequested_keys(chunk_size):
+    streams = {
+        "name": "a \"quoted\" ride \\ [with] {brackets}",
+        "laps": [{"splits": [1, 2, {"x": "]"}]}],
+        "watts": [1.5, -2e3, 0],
+        "empty": [],
+    }
+    decoded = decode(streams, ["watts", "empty", "cadence"], chunk_size)
+    assert set(decoded) == {"watts", "empty"}
+    assert decoded["watts"].tolist() == [1.5, -2000.0, 0.0]
+    assert decoded["empty"].tolist() == []
+
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 64 * 1024])
+def test_json_decoder_reads_boolean_streams(chunk_size):
+    decoded = decode({"moving": [True, False, True], "time": [0, 1, 2]},
+                     ["moving", "time"], chunk_size)
+    assert decoded["moving"].tolist() == [1.0, 0.0, 1.0]
+    assert decoded["time"].tolist() == [0, 1, 2]
+
+
+def test_json_decoder_rejects_strings_in_flat_arrays():
+    with pytest.raises(ValueError):
+        decode({"watts": ["a", "b"]}, ["watts"], 64 * 1024)